@@ -0,0 +1,441 @@
+'''The offline benchmark of the polling pipeline.
+
+It runs a local fake github server with synthetic repos, polls them through
+`Notification.update_repo_stars` or `tasks.handle_repos` against a local redis
+and a sqlite (or any other DATABASE_URL) database and writes the results as json:
+
+    python benchmark.py --repos 1000 10000 --cycles 3 --output benchmark.json
+
+The fake server has only the rest api, so the large repos are tracked only by
+the stars count. LARGE_REPO_STARS is above --stars-max by default, so every repo
+is diffed by its stargazers pages.
+'''
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import threading
+import time
+from aiohttp import web
+
+
+BASE_STARRED_AT = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeRepo:
+    '''The repo with the synthetic stargazers. The stargazers are ids from the range
+    without the removed ones, so the memory doesn't depend on the stars count.'''
+
+    def __init__(self, stars_count: int) -> None:
+        self.next_id = stars_count
+        self.removed_ids = []
+        self.version = 0
+
+
+    @property
+    def stars_count(self) -> int:
+        '''The number of stargazers'''
+        return self.next_id - len(self.removed_ids)
+
+
+    def get_star_id(self, index: int) -> int:
+        '''Get id of the stargazer by its position'''
+        star_id = index
+        while True:
+            next_star_id = index + bisect_right(self.removed_ids, star_id)
+            if next_star_id == star_id:
+                return star_id
+
+            star_id = next_star_id
+
+
+    def change(self, added: int, removed: int):
+        '''Add new stargazers and remove the random existing ones'''
+        for _ in range(removed):
+            if self.stars_count == 0:
+                break
+
+            star_id = self.get_star_id(random.randrange(self.stars_count))
+            self.removed_ids.insert(bisect_right(self.removed_ids, star_id), star_id)
+
+        self.next_id += added
+        self.version += 1
+
+
+    def get_page(self, page: int, size: int):
+        '''Get the page of stargazers in the github api format'''
+        first_index = (page - 1) * size
+        last_index = min(first_index + size, self.stars_count)
+
+        items = []
+        for index in range(first_index, last_index):
+            star_id = self.get_star_id(index)
+            starred_at = BASE_STARRED_AT + timedelta(seconds=star_id)
+            items.append({
+                'user': {'login': f'user{star_id}'},
+                'starred_at': starred_at.strftime('%Y-%m-%dT%H:%M:%SZ')
+            })
+
+        return items
+
+
+class FakeGithubServer:
+    '''The fake github rest api serving the synthetic repos in the background thread'''
+
+    def __init__(self, repos, port: int) -> None:
+        self.repos = repos
+        self.port = port
+        self.loop = None
+        self.thread = None
+        self.reset_stats()
+
+
+    def reset_stats(self):
+        '''Reset the requests counters'''
+        self.requests = 0
+        self.pages = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+
+
+    def __respond(self, request: web.Request, content, etag: str) -> web.Response:
+        self.requests += 1
+        headers = {
+            'ETag': etag,
+            'X-RateLimit-Remaining': '1000000',
+            'X-RateLimit-Reset': str(int(time.time()) + 3600)
+        }
+
+        if request.headers.get('If-None-Match') == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers=headers)
+
+        body = json.dumps(content)
+        self.bytes_sent += len(body)
+        return web.Response(text=body, content_type='application/json', headers=headers)
+
+
+    async def __get_repo(self, request: web.Request) -> web.Response:
+        repo = self.repos[request.match_info['name']]
+        return self.__respond(request,
+                              {'stargazers_count': repo.stars_count},
+                              f'"{repo.version}"')
+
+
+    async def __get_stargazers(self, request: web.Request) -> web.Response:
+        repo = self.repos[request.match_info['name']]
+        page = int(request.query.get('page', 1))
+        size = int(request.query.get('per_page', 30))
+
+        self.pages += 1
+        return self.__respond(request,
+                              repo.get_page(page, size),
+                              f'"{repo.version}-{page}-{size}"')
+
+
+    def __run(self, started: threading.Event):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        app = web.Application()
+        app.router.add_get('/repos/{owner}/{name}', self.__get_repo)
+        app.router.add_get('/repos/{owner}/{name}/stargazers', self.__get_stargazers)
+
+        runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(runner.setup())
+        self.loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', self.port).start())
+        started.set()
+
+        self.loop.run_forever()
+        self.loop.run_until_complete(runner.cleanup())
+        self.loop.close()
+
+
+    def start(self):
+        '''Start serving'''
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.__run, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+
+
+    def stop(self):
+        '''Stop serving'''
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def parse_args():
+    '''Parse the command line arguments'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repos', type=int, nargs='+', default=[1000],
+                        help='numbers of repos to benchmark')
+    parser.add_argument('--stars-min', type=int, default=100)
+    parser.add_argument('--stars-max', type=int, default=100000)
+    parser.add_argument('--large-repo-stars', type=int,
+                        help='repos with more stars only poll the count, above --stars-max '
+                             'by default')
+    parser.add_argument('--changed-repos', type=float, default=0.1,
+                        help='the share of repos changed in every cycle')
+    parser.add_argument('--added-stars', type=float, default=0.01,
+                        help='the share of stars added to the changed repo')
+    parser.add_argument('--removed-stars', type=float, default=0.001,
+                        help='the share of stars removed from the changed repo')
+    parser.add_argument('--cycles', type=int, default=3,
+                        help='polling cycles, the first one initializes repos')
+    parser.add_argument('--mode', choices=['repo', 'batch'], default='repo',
+                        help='poll by Notification.update_repo_stars or tasks.handle_repos')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--redis-db', type=int, default=15,
+                        help='the redis database which is flushed by the benchmark')
+    parser.add_argument('--database-url', default='sqlite:///benchmark.sqlite')
+    parser.add_argument('--storage-stars', type=int, default=1000000,
+                        help='stars for the storage format benchmark, 0 to skip it')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark.json')
+    return parser.parse_args()
+
+
+def generate_repos(repos_number: int, stars_min: int, stars_max: int):
+    '''Generate repos with the log uniform distribution of stars'''
+    return {
+        f'repo{index}': FakeRepo(int(stars_min * (stars_max / stars_min) ** random.random()))
+        for index in range(repos_number)
+    }
+
+
+def get_percentiles(values):
+    '''Get latency percentiles'''
+    if len(values) == 0:
+        return {}
+
+    values = sorted(values)
+    return {
+        'p50': values[int(len(values) * 0.5)],
+        'p95': values[int(len(values) * 0.95)],
+        'p99': values[int(len(values) * 0.99)],
+        'max': values[-1],
+        'mean': statistics.mean(values)
+    }
+
+
+def get_commit() -> str:
+    '''Get the benchmarked commit'''
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_storage_benchmark(stars_number: int):
+    '''Compare the legacy list of json stars, the legacy set of logins and the stars buckets
+    by redis memory and decode time'''
+    # pylint: disable=import-outside-toplevel
+    from notification import Notification, StarItem, get_stars_bucket, get_stars_buckets_count
+
+    redis_connection = Notification().redis_connection
+    redis_connection.flushdb()
+
+    repo = FakeRepo(stars_number)
+    stars = []
+    for index in range(stars_number):
+        star_id = repo.get_star_id(index)
+        starred_at = BASE_STARRED_AT + timedelta(seconds=star_id)
+        stars.append({'login': f'user{star_id}', 'starred_at': starred_at.isoformat()})
+
+    buckets_count = get_stars_buckets_count(stars_number)
+    buckets = [{} for _ in range(buckets_count)]
+    for star in stars:
+        star_item = StarItem.from_dict(star)
+        buckets[get_stars_bucket(star_item.login, buckets_count)][star_item.login] = \
+            star_item.get_stored_starred_at()
+    bucket_keys = [f'benchmark_stars_bucket_{bucket}' for bucket in range(buckets_count)]
+
+    with redis_connection.pipeline(transaction=False) as pipe:
+        for chunk_start in range(0, stars_number, 1000):
+            chunk = stars[chunk_start:chunk_start + 1000]
+            pipe.rpush('benchmark_legacy_stars', *[json.dumps(star) for star in chunk])
+            pipe.sadd('benchmark_stars', *[star['login'] for star in chunk])
+        for bucket_key, bucket in zip(bucket_keys, buckets):
+            if len(bucket) > 0:
+                pipe.hset(bucket_key, mapping=bucket)
+        pipe.execute()
+
+    started_time = time.perf_counter()
+    legacy_logins = [StarItem.from_json(item).login
+                     for item in redis_connection.lrange('benchmark_legacy_stars', 0, -1)]
+    legacy_decode_seconds = time.perf_counter() - started_time
+
+    started_time = time.perf_counter()
+    logins = [login.decode() for login in redis_connection.smembers('benchmark_stars')]
+    decode_seconds = time.perf_counter() - started_time
+
+    started_time = time.perf_counter()
+    with redis_connection.pipeline(transaction=False) as pipe:
+        for bucket_key in bucket_keys:
+            pipe.hgetall(bucket_key)
+        buckets_stars = [StarItem.from_stored(login, starred_at)
+                         for bucket in pipe.execute()
+                         for login, starred_at in bucket.items()]
+    buckets_decode_seconds = time.perf_counter() - started_time
+
+    assert set(legacy_logins) == set(logins)
+    assert set(legacy_logins) == {star.login for star in buckets_stars}
+
+    per_million = 1000000 / stars_number
+    results = {
+        'stars': stars_number,
+        'legacy_list': {
+            'redis_bytes_per_million': redis_connection.memory_usage(
+                'benchmark_legacy_stars', samples=0) * per_million,
+            'decode_seconds_per_million': legacy_decode_seconds * per_million
+        },
+        'logins_set': {
+            'redis_bytes_per_million': redis_connection.memory_usage(
+                'benchmark_stars', samples=0) * per_million,
+            'decode_seconds_per_million': decode_seconds * per_million
+        },
+        'stars_buckets': {
+            'buckets': buckets_count,
+            'encoding': (redis_connection.object('encoding', bucket_keys[0]) or b'').decode(),
+            'redis_bytes_per_million': sum(
+                redis_connection.memory_usage(bucket_key, samples=0) or 0
+                for bucket_key in bucket_keys) * per_million,
+            'decode_seconds_per_million': buckets_decode_seconds * per_million
+        }
+    }
+    print(json.dumps({'storage': results}))
+
+    redis_connection.flushdb()
+    return results
+
+
+def run_scale(args, repos_number: int):
+    '''Benchmark the number of repos'''
+    # pylint: disable=import-outside-toplevel
+    import settings
+    from models import Base, Repo, User, association_table, engine, session_factory
+    from notification import Notification
+
+    repos = generate_repos(repos_number, args.stars_min, args.stars_max)
+    server = FakeGithubServer(repos, args.port)
+    server.start()
+
+    notification = Notification()
+    notification.redis_connection.flushdb()
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with session_factory() as session:
+        session.execute(Repo.__table__.insert(),
+                        [{'url': f'https://github.com/bench/{name}'} for name in repos])
+        session.execute(User.__table__.insert(), [{'teleg_user_id': 1}])
+        user_id = session.query(User.id).scalar()
+        repo_ids = [repo_id for repo_id, in session.query(Repo.id).order_by(Repo.id)]
+        session.execute(association_table.insert(),
+                        [{'user_id': user_id, 'repo_id': repo_id} for repo_id in repo_ids])
+        session.commit()
+
+    cycles = []
+    for cycle in range(args.cycles):
+        if cycle > 0:
+            for repo in random.sample(list(repos.values()),
+                                      int(len(repos) * args.changed_repos)):
+                repo.change(added=max(1, int(repo.stars_count * args.added_stars)),
+                            removed=int(repo.stars_count * args.removed_stars))
+
+        # Make every repo due for the update
+        with session_factory() as session:
+            session.query(Repo)\
+                .filter(Repo.last_updated_time.isnot(None))\
+                .update({Repo.last_updated_time: datetime(2000, 1, 1)})
+            session.commit()
+
+        server.reset_stats()
+        latencies = []
+        changed = 0
+        started_time = time.perf_counter()
+
+        if args.mode == 'repo':
+            for repo_id in repo_ids:
+                repo_started_time = time.perf_counter()
+                result = notification.update_repo_stars(repo_id)
+                latencies.append(time.perf_counter() - repo_started_time)
+                changed += int(result.need_to_handle())
+        else:
+            from tasks import handle_repos
+            for chunk_start in range(0, len(repo_ids), settings.REPOS_BATCH_SIZE):
+                chunk = repo_ids[chunk_start:chunk_start + settings.REPOS_BATCH_SIZE]
+                chunk_started_time = time.perf_counter()
+                results = handle_repos(chunk)
+                latencies.append((time.perf_counter() - chunk_started_time) / len(chunk))
+                changed += sum(result['added'] + result['removed'] > 0
+                               for result in results.values())
+
+        seconds = time.perf_counter() - started_time
+        cycles.append({
+            'cycle': cycle,
+            'seconds': seconds,
+            'changed_repos': changed,
+            'repo_latency_seconds': get_percentiles(latencies),
+            'requests': server.requests,
+            'pages': server.pages,
+            'pages_per_second': server.pages / seconds,
+            'not_modified': server.not_modified,
+            'bytes_decoded': server.bytes_sent,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'redis_used_memory': notification.redis_connection.info('memory')['used_memory']
+        })
+        print(json.dumps({'repos': repos_number, **cycles[-1]}))
+
+    server.stop()
+
+    return {
+        'repos': repos_number,
+        'stars': sum(repo.stars_count for repo in repos.values()),
+        'cycles': cycles
+    }
+
+
+def main():
+    '''Run the benchmark'''
+    args = parse_args()
+    random.seed(args.seed)
+
+    os.environ['GITHUB_API_URL'] = f'http://127.0.0.1:{args.port}'
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ['REDIS_DB'] = str(args.redis_db)
+    os.environ.setdefault('GITHUB_MAX_REQUESTS_PER_SECOND', '1000000')
+    os.environ['LARGE_REPO_STARS'] = str(args.large_repo_stars or args.stars_max + 1)
+
+    # pylint: disable=import-outside-toplevel
+    import worker_resources
+
+    try:
+        results = {
+            'commit': get_commit(),
+            'mode': args.mode,
+            'args': vars(args),
+            'storage': run_storage_benchmark(args.storage_stars) if args.storage_stars > 0
+                       else None,
+            'scales': [run_scale(args, repos_number) for repos_number in args.repos]
+        }
+    finally:
+        # The github session, the redis pools and the database engine are closed
+        # like at the worker exit
+        worker_resources.shutdown_process()
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+'''The module with the bot state shared between the bot replicas'''
+import settings
+
+
+class BotState:
+    '''Keeps the conversational state of users and the handled updates in redis,
+    so any bot replica can handle any update'''
+
+    def __init__(self, redis_connection) -> None:
+        self.redis_connection = redis_connection
+
+
+    async def set_unsubscribe(self, teleg_user_id: int):
+        '''Wait for the repo url for unsubscribing from the user'''
+        await self.redis_connection.set(self.__get_unsubscribe_key(teleg_user_id), 1,
+                                        ex=settings.BOT_STATE_SECONDS)
+
+
+    async def pop_unsubscribe(self, teleg_user_id: int) -> bool:
+        '''Clean the unsubscribe state and return whether it was set'''
+        return await self.redis_connection.delete(self.__get_unsubscribe_key(teleg_user_id)) > 0
+
+
+    async def mark_update(self, update_id: int) -> bool:
+        '''Mark the update as handled. Returns False if it's already handled'''
+        marked = await self.redis_connection.set(f'bot_update_{update_id}', 1,
+                                                 nx=True,
+                                                 ex=settings.BOT_UPDATE_DEDUP_SECONDS)
+        return bool(marked)
+
+
+    async def unmark_update(self, update_id: int):
+        '''Forget the update, so it's handled again when it's repeated'''
+        await self.redis_connection.delete(f'bot_update_{update_id}')
+
+
+    @staticmethod
+    def __get_unsubscribe_key(teleg_user_id: int) -> str:
+        return f'bot_unsubscribe_{teleg_user_id}'
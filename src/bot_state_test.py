@@ -0,0 +1,65 @@
+import asyncio
+import unittest
+from redis import asyncio as aioredis
+import settings
+from bot_state import BotState
+
+
+class BotStateTestCase(unittest.TestCase):
+    @staticmethod
+    def create_redis_connection():
+        '''Connect to the dedicated test db'''
+        return aioredis.Redis(host=settings.REDIS_HOST,
+                              port=settings.REDIS_PORT,
+                              db=settings.TEST_REDIS_DB)
+
+
+    def run_with_state(self, action):
+        '''Run the action with the bot state on the flushed test db'''
+        async def run():
+            redis_connection = self.create_redis_connection()
+            await redis_connection.flushdb()
+            try:
+                return await action(BotState(redis_connection))
+            finally:
+                await redis_connection.flushdb()
+                await redis_connection.close()
+
+        return asyncio.run(run())
+
+
+    def test_mark_update_once(self):
+        # Arrange
+        async def mark_twice(bot_state: BotState):
+            return [await bot_state.mark_update(1), await bot_state.mark_update(1)]
+
+        # Act
+        marked = self.run_with_state(mark_twice)
+
+        # Assert
+        assert marked == [True, False]
+
+    def test_unmark_update(self):
+        # Arrange
+        async def mark_after_unmark(bot_state: BotState):
+            await bot_state.mark_update(1)
+            await bot_state.unmark_update(1)
+            return await bot_state.mark_update(1)
+
+        # Act
+        marked = self.run_with_state(mark_after_unmark)
+
+        # Assert
+        assert marked
+
+    def test_pop_unsubscribe(self):
+        # Arrange
+        async def pop_twice(bot_state: BotState):
+            await bot_state.set_unsubscribe(1)
+            return [await bot_state.pop_unsubscribe(1), await bot_state.pop_unsubscribe(1)]
+
+        # Act
+        popped = self.run_with_state(pop_twice)
+
+        # Assert
+        assert popped == [True, False]
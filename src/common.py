@@ -1,6 +1,11 @@
 from dataclasses import dataclass
 from typing import List
 from urllib.parse import urlparse
+import settings
+
+# The max length of the telegram message text
+TELEGRAM_MESSAGE_LIMIT = 4096
+
 
 @dataclass
 class ApiUrlsRepoResult:
@@ -17,19 +22,26 @@ def get_api_repo_url_from_repo_url(repo_url: str) -> ApiUrlsRepoResult:
     '''Get stars api repo url basing on the github api repo'''
     parsed_url = urlparse(repo_url)
 
-    api_repo_url = f'https://api.github.com/repos{parsed_url.path}'
-    api_repo_stars_url = f'https://api.github.com/repos{parsed_url.path}/stargazers'
+    api_repo_url = f'{settings.GITHUB_API_URL}/repos{parsed_url.path}'
+    api_repo_stars_url = f'{settings.GITHUB_API_URL}/repos{parsed_url.path}/stargazers'
 
     return ApiUrlsRepoResult(api_repo_url=api_repo_url, api_repo_stars_url=api_repo_stars_url)
 
 
 def generate_notification_message(repo_url: str,
                                   added_stars_subscribers: List[str],
-                                  removed_stars_subscribers: List[str]) -> str:
+                                  removed_stars_subscribers: List[str],
+                                  removed_stars_count: int = 0,
+                                  approximate: bool = False,
+                                  added_stars_count: int = 0) -> str:
     '''Generates the notification message'''
 
     message_lines = [f'Repo: {repo_url}', '']
 
+    if approximate:
+        message_lines.append('The repo is large, so the bot is in approximate mode: '
+                             'only the newest subscribers are tracked.')
+
     if len(added_stars_subscribers) > 0:
         new_subscribers = ','.join(added_stars_subscribers)
         message_lines.append(f'New subscribers: {new_subscribers}')
@@ -38,5 +50,35 @@ def generate_notification_message(repo_url: str,
         removed_subscribers = ','.join(removed_stars_subscribers)
         message_lines.append(f'Removed subscribers: {removed_subscribers}')
 
+    if added_stars_count > 0:
+        message_lines.append(f'New subscribers count: {added_stars_count}')
+
+    if removed_stars_count > 0:
+        message_lines.append(f'Removed subscribers count: {removed_stars_count}')
+
     message = get_message_lines(message_lines)
     return message
+
+
+def split_message(message: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    '''Split the message by lines to parts which are not longer than the limit'''
+    parts = []
+    part = None
+
+    for line in message.split('\n'):
+        # The line longer than the limit is cut to chunks
+        chunks = [line[start:start + limit] for start in range(0, len(line), limit)] or ['']
+
+        for chunk in chunks:
+            if part is None:
+                part = chunk
+            elif len(part) + 1 + len(chunk) <= limit:
+                part += '\n' + chunk
+            else:
+                parts.append(part)
+                part = chunk
+
+    if part is not None:
+        parts.append(part)
+
+    return parts
@@ -1,6 +1,6 @@
 from re import A
 import unittest
-from common import get_api_repo_url_from_repo_url
+from common import generate_notification_message, get_api_repo_url_from_repo_url, split_message
 
 class NotificationTestCase(unittest.TestCase):
     def test_get_api_repo_url_from_repo_url(self):
@@ -15,3 +15,38 @@ class NotificationTestCase(unittest.TestCase):
         # Assert:
         assert api_urls_repo_result.api_repo_url == api_repo_url_expected
         assert api_urls_repo_result.api_repo_stars_url == api_repo_stars_url_expected
+
+    def test_split_message_by_lines(self):
+        # Arrange
+        message = 'line1\nline2\nline3'
+
+        # Act
+        parts = split_message(message, limit=11)
+
+        # Assert
+        assert parts == ['line1\nline2', 'line3']
+
+    def test_split_message_with_long_line(self):
+        # Arrange
+        message = 'short\n' + 'x' * 25
+
+        # Act
+        parts = split_message(message, limit=10)
+
+        # Assert
+        assert parts == ['short', 'x' * 10, 'x' * 10, 'x' * 5]
+        assert all(len(part) <= 10 for part in parts)
+
+    def test_generate_notification_message_in_approximate_mode(self):
+        # Arrange
+        url = 'https://github.com/alexpantyukhin/aiohttp-session-mongo'
+
+        # Act
+        message = generate_notification_message(url, ['login1'], [],
+                                                removed_stars_count=2,
+                                                approximate=True)
+
+        # Assert
+        assert 'approximate mode' in message
+        assert 'New subscribers: login1' in message
+        assert 'Removed subscribers count: 2' in message
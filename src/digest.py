@@ -0,0 +1,129 @@
+'''The module with per user digests of notifications'''
+from typing import Dict, List, Tuple
+import json
+import time
+from redis_pool import get_redis_connection
+import settings
+from common import generate_notification_message, split_message
+from outbox import NotificationOutbox
+
+
+DIGESTS_DUE_REDIS_KEY = 'digests_due'
+
+
+def merge_stars_changes(changes: List[Dict]) -> Dict[str, Tuple[List[str], List[str]]]:
+    '''Merge the stars changes of repos in order. The star removed after it's added
+    and the star added after it's removed cancel each other.'''
+    repos_changes = {}
+    for change in changes:
+        added, removed = repos_changes.setdefault(change['repo_url'], ([], []))
+
+        for login in change['added_stars']:
+            if login in removed:
+                removed.remove(login)
+            elif login not in added:
+                added.append(login)
+
+        for login in change['removed_stars']:
+            if login in added:
+                added.remove(login)
+            elif login not in removed:
+                removed.append(login)
+
+    return repos_changes
+
+
+def merge_stars_counts(changes: List[Dict]) -> Dict[str, Tuple[int, int]]:
+    '''Sum the added and removed stars counts of the approximately tracked repos'''
+    repos_counts = {}
+    for change in changes:
+        if change.get('approximate', False):
+            added_count, removed_count = repos_counts.get(change['repo_url'], (0, 0))
+            repos_counts[change['repo_url']] = (
+                added_count + change.get('added_stars_count', 0),
+                removed_count + change.get('removed_stars_count', 0))
+
+    return repos_counts
+
+
+class NotificationDigest:
+    '''Accumulates stars changes for every user in redis during the digest window
+    and sends them as one message'''
+
+    def __init__(self, redis_connection=None, outbox: NotificationOutbox = None) -> None:
+        self.redis_connection = redis_connection or get_redis_connection()
+        self.outbox = outbox or NotificationOutbox(self.redis_connection)
+
+
+    @staticmethod
+    def __get_redis_key(teleg_user_id) -> str:
+        return 'digest_user_' + str(teleg_user_id)
+
+
+    def add(self,
+            teleg_user_ids: List[int],
+            repo_url: str,
+            added_stars: List[str],
+            removed_stars: List[str],
+            removed_stars_count: int = 0,
+            approximate: bool = False,
+            added_stars_count: int = 0):
+        '''Add the repo stars changes to digests of the users'''
+        change = json.dumps({
+            'repo_url': repo_url,
+            'added_stars': added_stars,
+            'removed_stars': removed_stars,
+            'removed_stars_count': removed_stars_count,
+            'added_stars_count': added_stars_count,
+            'approximate': approximate
+        })
+        flush_time = time.time() + settings.DIGEST_SECONDS
+
+        with self.redis_connection.pipeline() as pipe:
+            for teleg_user_id in teleg_user_ids:
+                pipe.rpush(self.__get_redis_key(teleg_user_id), change)
+                pipe.zadd(DIGESTS_DUE_REDIS_KEY, {teleg_user_id: flush_time}, nx=True)
+            pipe.execute()
+
+
+    def __take_changes(self, teleg_user_id: str) -> List[Dict]:
+        redis_key = self.__get_redis_key(teleg_user_id)
+        with self.redis_connection.pipeline() as pipe:
+            pipe.lrange(redis_key, 0, -1)
+            pipe.delete(redis_key)
+            pipe.zrem(DIGESTS_DUE_REDIS_KEY, teleg_user_id)
+            changes, _, _ = pipe.execute()
+
+        return [json.loads(change) for change in changes]
+
+
+    def flush_due(self) -> int:
+        '''Send digests which window is over. Returns the number of sent digests.'''
+        teleg_user_ids = self.redis_connection.zrangebyscore(DIGESTS_DUE_REDIS_KEY, 0, time.time())
+
+        for teleg_user_id in teleg_user_ids:
+            teleg_user_id = teleg_user_id.decode()
+            changes = self.__take_changes(teleg_user_id)
+            repos_changes = merge_stars_changes(changes)
+            repos_counts = merge_stars_counts(changes)
+
+            messages = []
+            for repo_url, (added_stars, removed_stars) in repos_changes.items():
+                approximate = repo_url in repos_counts
+                added_stars_count, removed_stars_count = repos_counts.get(repo_url, (0, 0))
+                if len(added_stars) > 0 or len(removed_stars) > 0 \
+                   or added_stars_count > 0 or removed_stars_count > 0:
+                    messages.append(generate_notification_message(
+                        repo_url,
+                        added_stars,
+                        removed_stars,
+                        removed_stars_count=removed_stars_count,
+                        approximate=approximate,
+                        added_stars_count=added_stars_count))
+            if len(messages) == 0:
+                continue
+
+            for message_part in split_message('\n\n'.join(messages)):
+                self.outbox.put([teleg_user_id], message_part)
+
+        return len(teleg_user_ids)
@@ -0,0 +1,21 @@
+import unittest
+from digest import merge_stars_changes
+
+
+class DigestTestCase(unittest.TestCase):
+    def test_merge_stars_changes(self):
+        # Arrange
+        url_1 = 'https://github.com/alexpantyukhin/aiohttp-session-mongo'
+        url_2 = 'https://github.com/stretchr/testify'
+        changes = [
+            {'repo_url': url_1, 'added_stars': ['login1', 'login2'], 'removed_stars': []},
+            {'repo_url': url_2, 'added_stars': [], 'removed_stars': ['login3']},
+            {'repo_url': url_1, 'added_stars': ['login4'], 'removed_stars': ['login2']},
+        ]
+
+        # Act
+        repos_changes = merge_stars_changes(changes)
+
+        # Assert
+        assert repos_changes[url_1] == (['login1', 'login4'], [])
+        assert repos_changes[url_2] == ([], ['login3'])
@@ -1,50 +1,221 @@
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, List, Optional
+import asyncio
+from urllib.parse import urlparse
 import json
+import time
 import aiohttp
 import settings
+from github_cache import CachedResponse, ResponseCache
+from github_scheduler import GithubRequestScheduler, GithubResponse
+from github_tokens import TokenPool
+from metrics import GITHUB_REQUEST_SECONDS
 
-async def _get_request_content(base_url, page=None, size=None, headers=None):
-    url = base_url
-    params = []
-    if page is not None:
-        params.append(f'page={str(page)}')
 
-    if size is not None:
-        params.append(f'per_page={str(size)}')
+def _get_endpoint(url: str) -> str:
+    path = urlparse(url).path
+    if path.endswith('/graphql'):
+        return 'graphql'
 
-    params_str = '&'.join(params)
-    if len(params) > 0:
-        url += '?' + params_str
+    if path.endswith('/stargazers'):
+        return 'stargazers'
+
+    return 'repo'
+
+
+def _parse_starred_at(starred_at: str) -> datetime:
+    # fromisoformat is much faster than strptime but doesn't accept the Z suffix
+    return datetime.fromisoformat(starred_at.replace('Z', '+00:00'))
+
+
+def _parse_star_item(content: Dict) -> Dict:
+    return {
+        'login': content['user']['login'],
+        'starred_at': _parse_starred_at(content['starred_at'])
+    }
+
+
+class GithubApiError(Exception):
+    '''The github api responded with the error'''
+
+    def __init__(self, url: str, status: int) -> None:
+        super().__init__(f'Github api responded {status} for {url}')
+        self.url = url
+        self.status = status
+
+
+class GithubClient:
+    '''The github api client. It keeps one pooled http session with keep-alive
+    connections for all the requests made on the same event loop.'''
+
+    def __init__(self,
+                 token: str = None,
+                 response_cache: ResponseCache = None,
+                 connections_per_host: int = None,
+                 dns_cache_seconds: int = None,
+                 keepalive_seconds: int = None,
+                 scheduler: GithubRequestScheduler = None) -> None:
+        self.response_cache = response_cache or ResponseCache()
+        if scheduler is None:
+            scheduler = GithubRequestScheduler(TokenPool([token]) if token is not None else None)
+        self.scheduler = scheduler
+        self.connections_per_host = connections_per_host or settings.GITHUB_CONNECTIONS_PER_HOST
+        self.dns_cache_seconds = dns_cache_seconds or settings.GITHUB_DNS_CACHE_SECONDS
+        self.keepalive_seconds = keepalive_seconds or settings.GITHUB_KEEPALIVE_SECONDS
+
+        self._session = None
+        self._session_loop = None
+
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            connector = aiohttp.TCPConnector(limit_per_host=self.connections_per_host,
+                                             ttl_dns_cache=self.dns_cache_seconds,
+                                             keepalive_timeout=self.keepalive_seconds)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._session_loop = loop
+
+        return self._session
+
+
+    async def close(self):
+        '''Close the http session'''
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+        self._session = None
+        self._session_loop = None
+
+
+    def forget_repo_pages(self, repo_url: str):
+        '''Forget the state kept for walking the stargazers pages of the repo.
+        Rest pages are addressed by numbers, so there is nothing to forget.'''
+
+
+    async def get_content(self, base_url, page=None, size=None, headers=None):
+        '''Get the parsed json content by url'''
+        url = base_url
+        params = []
+        if page is not None:
+            params.append(f'page={str(page)}')
+
+        if size is not None:
+            params.append(f'per_page={str(size)}')
+
+        params_str = '&'.join(params)
+        if len(params) > 0:
+            url += '?' + params_str
 
-    if settings.GITHUB_KEY is not None:
         if headers is None:
             headers = {}
 
-        headers['Authorization'] = f'token {settings.GITHUB_KEY}'
+        cache_key = url + '|' + headers.get('Accept', '')
+        cached_response = await self.response_cache.get(cache_key)
+        if cached_response is not None:
+            headers.update(cached_response.get_validation_headers())
+
+        response = await self.scheduler.run(
+            lambda token: self._send_request('GET', url,
+                                             {**headers, **self._get_auth_headers(token)}))
+
+        if response.status == 304 and cached_response is not None:
+            return json.loads(cached_response.content)
+
+        if response.status != 200:
+            raise GithubApiError(url, response.status)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag is not None or last_modified is not None:
+            await self.response_cache.set(cache_key,
+                                          CachedResponse(etag=etag,
+                                                         last_modified=last_modified,
+                                                         content=response.content))
+
+        return json.loads(response.content)
+
+
+    @staticmethod
+    def _get_auth_headers(token: Optional[str]) -> Dict[str, str]:
+        if token is None:
+            return {}
+
+        return {'Authorization': f'token {token}'}
+
+
+    async def _send_request(self,
+                            method: str,
+                            url: str,
+                            headers: Dict[str, str],
+                            json_body=None) -> GithubResponse:
+        started_time = time.perf_counter()
+        async with self._get_session().request(method,
+                                               url,
+                                               headers=headers,
+                                               json=json_body) as response:
             content = await response.text()
-            return json.loads(content)
 
-async def get_repo_stars_count(repo_url: str) -> int:
-    '''Get repos count async'''
-    content = await _get_request_content(repo_url)
-    return content['stargazers_count']
+        GITHUB_REQUEST_SECONDS\
+            .labels(endpoint=_get_endpoint(url), status=response.status)\
+            .observe(time.perf_counter() - started_time)
 
+        return GithubResponse(status=response.status,
+                              headers=response.headers,
+                              content=content)
 
-def __parse_star_item(content: Dict[str, str]) -> Dict[str, str]:
-    return {
-        'login': content['user']['login'],
-        'starred_at': datetime.strptime(content['starred_at'], '%Y-%m-%dT%H:%M:%S%z').isoformat()
-    }
 
-async def get_repo_stargazers_page(repo_url: str, page: int, size:int) -> List[Dict[str, str]]:
-    '''Get repos stars page'''
-    content = await _get_request_content(repo_url,
-                                   page=page,
-                                   size=size,
-                                   headers={'Accept':'application/vnd.github.v3.star+json'})
+    async def get_repo_stars_count(self, repo_url: str) -> int:
+        '''Get repos count async'''
+        content = await self.get_content(repo_url)
+        return content['stargazers_count']
+
+
+    async def get_repo_stargazers_page(self,
+                                       repo_url: str,
+                                       page: int,
+                                       size: int) -> List[Dict]:
+        '''Get repos stars page'''
+        content = await self.get_content(repo_url,
+                                         page=page,
+                                         size=size,
+                                         headers={'Accept':'application/vnd.github.v3.star+json'})
+
+        return list(map(_parse_star_item, content))
 
-    return list(map(__parse_star_item, content))
+
+def create_client() -> GithubClient:
+    '''Create the client of the configured api backend'''
+    if settings.GITHUB_API_BACKEND == 'graphql':
+        from github_graphql import GithubGraphqlClient # pylint: disable=import-outside-toplevel
+        return GithubGraphqlClient()
+
+    return GithubClient()
+
+
+_default_client = None
+
+
+def get_default_client() -> GithubClient:
+    '''Get the client shared by the process. It's created by the first call,
+    so importing the module neither connects to redis nor imports the graphql client.'''
+    global _default_client  # pylint: disable=global-statement
+    if _default_client is None:
+        _default_client = create_client()
+
+    return _default_client
+
+
+async def close_default_client():
+    '''Close the shared client if it's created'''
+    if _default_client is not None:
+        await _default_client.close()
+
+
+async def get_repo_stars_count(repo_url: str) -> int:
+    '''Get repos count async'''
+    return await get_default_client().get_repo_stars_count(repo_url)
+
+async def get_repo_stargazers_page(repo_url: str, page: int, size:int) -> List[Dict]:
+    '''Get repos stars page'''
+    return await get_default_client().get_repo_stargazers_page(repo_url, page, size)
@@ -0,0 +1,124 @@
+'''The module with the cache of github responses validated by ETag/Last-Modified'''
+from dataclasses import dataclass
+from typing import Dict, Optional
+import time
+from redis_pool import get_async_redis_connection
+import settings
+
+
+CACHE_INDEX_REDIS_KEY = 'github_cache_index'
+CACHE_BYTES_REDIS_KEY = 'github_cache_bytes'
+
+# Replaces the cached response, counts its bytes and evicts the least recently used responses
+# while the cache is larger than the limit. KEYS are the index, the bytes counter and
+# the response. ARGV are the cache key, the time, the response size, the cache limit and
+# the response fields. The evicted responses are found by the index, so the keys
+# of the evicted ones aren't declared and the cache needs the single redis instance.
+SET_RESPONSE_SCRIPT = '''
+local old_size = tonumber(redis.call('HGET', KEYS[3], 'size') or 0)
+redis.call('DEL', KEYS[3])
+redis.call('HSET', KEYS[3], 'size', ARGV[3], unpack(ARGV, 5))
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+local cache_bytes = redis.call('INCRBY', KEYS[2], tonumber(ARGV[3]) - old_size)
+
+local max_bytes = tonumber(ARGV[4])
+while cache_bytes > max_bytes do
+    local evicted = redis.call('ZPOPMIN', KEYS[1])
+    if #evicted == 0 then
+        break
+    end
+
+    local evicted_key = 'github_cache_' .. evicted[1]
+    local evicted_size = tonumber(redis.call('HGET', evicted_key, 'size') or 0)
+    redis.call('DEL', evicted_key)
+    cache_bytes = redis.call('DECRBY', KEYS[2], evicted_size)
+end
+
+return cache_bytes
+'''
+
+
+@dataclass
+class CachedResponse:
+    '''The cached response with its validators'''
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content: str
+
+    def get_validation_headers(self) -> Dict[str, str]:
+        '''Get headers for the conditional request'''
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+
+        return headers
+
+
+class ResponseCache:
+    '''The cache of responses shared by all workers through redis. It's bounded by bytes,
+    since the stargazers pages are much larger than other responses.
+    The least recently used responses are evicted first.'''
+
+    def __init__(self, redis_connection=None, max_bytes: int = None) -> None:
+        self.redis_connection = redis_connection
+        self.max_bytes = settings.GITHUB_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.__set_response_script = None
+
+
+    def __get_redis_connection(self):
+        return self.redis_connection or get_async_redis_connection()
+
+
+    @staticmethod
+    def __get_redis_key(key: str) -> str:
+        return 'github_cache_' + key
+
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        '''Get the cached response'''
+        if self.max_bytes <= 0:
+            return None
+
+        # The access time is updated only for the cached keys, so the index stays bounded
+        async with self.__get_redis_connection().pipeline(transaction=False) as pipe:
+            pipe.hgetall(self.__get_redis_key(key))
+            pipe.zadd(CACHE_INDEX_REDIS_KEY, {key: time.time()}, xx=True)
+            cached, _ = await pipe.execute()
+
+        if len(cached) == 0:
+            return None
+
+        etag = cached.get(b'etag')
+        last_modified = cached.get(b'last_modified')
+        return CachedResponse(etag=etag.decode() if etag else None,
+                              last_modified=last_modified.decode() if last_modified else None,
+                              content=cached[b'content'].decode())
+
+
+    async def set(self, key: str, response: CachedResponse):
+        '''Put the response to the cache and evict the oldest ones'''
+        if self.max_bytes <= 0:
+            return
+
+        fields = ['content', response.content]
+        if response.etag is not None:
+            fields.extend(['etag', response.etag])
+
+        if response.last_modified is not None:
+            fields.extend(['last_modified', response.last_modified])
+
+        size = sum(len(field.encode()) for field in fields)
+        if size > self.max_bytes:
+            return
+
+        redis_connection = self.__get_redis_connection()
+        if self.__set_response_script is None:
+            self.__set_response_script = redis_connection.register_script(SET_RESPONSE_SCRIPT)
+
+        await self.__set_response_script(
+            keys=[CACHE_INDEX_REDIS_KEY, CACHE_BYTES_REDIS_KEY, self.__get_redis_key(key)],
+            args=[key, time.time(), size, self.max_bytes, *fields],
+            client=redis_connection)
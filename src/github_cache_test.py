@@ -0,0 +1,67 @@
+import asyncio
+import unittest
+from github_cache import CACHE_BYTES_REDIS_KEY, CACHE_INDEX_REDIS_KEY, CachedResponse, \
+                         ResponseCache
+from redis_pool import close_async_connection_pool, get_redis_connection
+from testing import use_test_redis_db
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        use_test_redis_db()
+        self.redis_connection = get_redis_connection()
+        self.redis_connection.flushdb()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.run_until_complete(close_async_connection_pool())
+        self.loop.close()
+        self.redis_connection.flushdb()
+
+    def run_async(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def test_set_evicts_least_recently_used_by_bytes(self):
+        # Arrange
+        cache = ResponseCache(max_bytes=250)
+        self.run_async(cache.set('first', CachedResponse(etag=None, last_modified=None,
+                                                         content='a' * 100)))
+        self.run_async(cache.set('second', CachedResponse(etag=None, last_modified=None,
+                                                          content='b' * 100)))
+        self.run_async(cache.get('first'))
+
+        # Act
+        self.run_async(cache.set('third', CachedResponse(etag=None, last_modified=None,
+                                                         content='c' * 100)))
+
+        # Assert
+        assert self.run_async(cache.get('first')).content == 'a' * 100
+        assert self.run_async(cache.get('second')) is None
+        assert self.run_async(cache.get('third')).content == 'c' * 100
+        assert int(self.redis_connection.get(CACHE_BYTES_REDIS_KEY)) <= 250
+
+    def test_set_replaces_response_size(self):
+        # Arrange
+        cache = ResponseCache(max_bytes=1000)
+        self.run_async(cache.set('first', CachedResponse(etag='"1"', last_modified=None,
+                                                         content='a' * 100)))
+
+        # Act
+        self.run_async(cache.set('first', CachedResponse(etag=None, last_modified=None,
+                                                         content='a' * 10)))
+
+        # Assert
+        assert int(self.redis_connection.get(CACHE_BYTES_REDIS_KEY)) == len('content') + 10
+        assert self.run_async(cache.get('first')).etag is None
+
+    def test_set_skips_response_larger_than_cache(self):
+        # Arrange
+        cache = ResponseCache(max_bytes=50)
+
+        # Act
+        self.run_async(cache.set('first', CachedResponse(etag=None, last_modified=None,
+                                                         content='a' * 100)))
+
+        # Assert
+        assert self.run_async(cache.get('first')) is None
+        assert self.redis_connection.zcard(CACHE_INDEX_REDIS_KEY) == 0
@@ -0,0 +1,243 @@
+'''The module with the github graphql api client'''
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+import asyncio
+import json
+import settings
+from github_api import GithubApiError, GithubClient, _parse_starred_at
+
+
+GRAPHQL_URL = settings.GITHUB_API_URL + '/graphql'
+
+# The max number of nodes graphql returns by one connection page
+MAX_PAGE_SIZE = 100
+
+STARGAZERS_PAGE_QUERY = '''
+query($owner: String!, $name: String!, $size: Int!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    stargazers(first: $size, after: $after, orderBy: {field: STARRED_AT, direction: ASC}) {
+      edges { starredAt node { login } }
+      pageInfo { endCursor hasNextPage }
+    }
+  }
+}
+'''
+
+NEWEST_STARGAZERS_QUERY = '''
+query($owner: String!, $name: String!, $size: Int!, $before: String) {
+  repository(owner: $owner, name: $name) {
+    stargazers(last: $size, before: $before, orderBy: {field: STARRED_AT, direction: ASC}) {
+      edges { starredAt node { login } }
+      pageInfo { startCursor hasPreviousPage }
+    }
+  }
+}
+'''
+
+
+def _get_repo_owner_and_name(api_repo_url: str) -> Tuple[str, str]:
+    '''Get owner and name from the api repo url or the api stars url'''
+    path_parts = urlparse(api_repo_url).path.strip('/').split('/')
+    repos_index = path_parts.index('repos')
+    return path_parts[repos_index + 1], path_parts[repos_index + 2]
+
+
+def _parse_star_edge(edge: Dict) -> Dict:
+    return {
+        'login': edge['node']['login'],
+        'starred_at': _parse_starred_at(edge['starredAt'])
+    }
+
+
+class GithubGraphqlClient(GithubClient):
+    '''The github client which uses the graphql api. The stars count requests made
+    at the same time are batched to one query for up to 100 repos.'''
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._pending_counts = []
+        # The running loads of counts are referenced, so they aren't garbage collected
+        self._counts_tasks = set()
+        self._pages_cursors = {}
+        self._pages_locks = {}
+
+
+    async def close(self):
+        await super().close()
+        self._pending_counts = []
+        self._pages_cursors = {}
+        self._pages_locks = {}
+
+
+    def forget_repo_pages(self, repo_url: str):
+        '''Forget the cached page cursors of the repo. The cursors are valid only
+        for one walk, the stargazers are shifted by the next sync.'''
+        owner, name = _get_repo_owner_and_name(repo_url)
+        for pages_key in [key for key in self._pages_cursors if key[:2] == (owner, name)]:
+            del self._pages_cursors[pages_key]
+            self._pages_locks.pop(pages_key, None)
+
+
+    @staticmethod
+    def _get_auth_headers(token: Optional[str]) -> Dict[str, str]:
+        if token is None:
+            return {}
+
+        return {'Authorization': f'bearer {token}'}
+
+
+    async def query(self, query: str, variables: Dict) -> Dict:
+        '''Run the graphql query and get the data'''
+        response = await self.scheduler.run(
+            lambda token: self._send_request('POST',
+                                             GRAPHQL_URL,
+                                             self._get_auth_headers(token),
+                                       json_body={'query': query, 'variables': variables}))
+
+        if response.status != 200:
+            raise GithubApiError(GRAPHQL_URL, response.status)
+
+        content = json.loads(response.content)
+        if content.get('data') is None:
+            raise GithubApiError(GRAPHQL_URL, response.status)
+
+        return content['data']
+
+
+    async def get_repos_stars_count(self, repo_urls: List[str]) -> Dict[str, int]:
+        '''Get stars count of up to 100 repos by one query.
+        The missing repos are absent in the result.'''
+        params = []
+        fields = []
+        variables = {}
+        for index, repo_url in enumerate(repo_urls):
+            owner, name = _get_repo_owner_and_name(repo_url)
+            variables[f'owner{index}'] = owner
+            variables[f'name{index}'] = name
+            params.append(f'$owner{index}: String!, $name{index}: String!')
+            fields.append(f'r{index}: repository(owner: $owner{index}, name: $name{index}) '
+                          '{ stargazerCount }')
+
+        data = await self.query(f'query({", ".join(params)}) {{ {" ".join(fields)} }}', variables)
+
+        counts = {}
+        for index, repo_url in enumerate(repo_urls):
+            repository = data.get(f'r{index}')
+            if repository is not None:
+                counts[repo_url] = repository['stargazerCount']
+
+        return counts
+
+
+    async def __load_pending_counts(self):
+        pending_counts = self._pending_counts
+        self._pending_counts = []
+
+        for chunk_start in range(0, len(pending_counts), MAX_PAGE_SIZE):
+            chunk = pending_counts[chunk_start:chunk_start + MAX_PAGE_SIZE]
+            try:
+                counts = await self.get_repos_stars_count(
+                    list({repo_url for repo_url, _ in chunk}))
+            except Exception as error: # pylint: disable=broad-except
+                for _, future in chunk:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            for repo_url, future in chunk:
+                # The future is cancelled when its caller is cancelled
+                if future.done():
+                    continue
+
+                if repo_url in counts:
+                    future.set_result(counts[repo_url])
+                else:
+                    future.set_exception(GithubApiError(repo_url, 404))
+
+
+    def __start_loading_counts(self):
+        task = asyncio.get_running_loop().create_task(self.__load_pending_counts())
+        self._counts_tasks.add(task)
+        task.add_done_callback(self._counts_tasks.discard)
+
+
+    async def get_repo_stars_count(self, repo_url: str) -> int:
+        '''Get repos count. Joins the batch of the concurrent calls.'''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending_counts.append((repo_url, future))
+
+        # The callback runs after all the tasks which are ready now made their calls
+        if len(self._pending_counts) == 1:
+            loop.call_soon(self.__start_loading_counts)
+
+        return await future
+
+
+    async def get_repo_stargazers_page(self,
+                                       repo_url: str,
+                                       page: int,
+                                       size: int) -> List[Dict]:
+        '''Get repos stars page. Graphql pages are reachable only by cursors,
+        so the pages before the requested one are walked once and their cursors cached.'''
+        owner, name = _get_repo_owner_and_name(repo_url)
+        pages_key = (owner, name, size)
+        pages_lock = self._pages_locks.setdefault(pages_key, asyncio.Lock())
+        pages_cursors = self._pages_cursors.setdefault(pages_key, {0: None})
+
+        async with pages_lock:
+            page_number = max(number for number in pages_cursors if number < page)
+            while True:
+                data = await self.query(STARGAZERS_PAGE_QUERY, {
+                    'owner': owner,
+                    'name': name,
+                    'size': size,
+                    'after': pages_cursors[page_number]
+                })
+                stargazers = data['repository']['stargazers']
+                page_number += 1
+                pages_cursors[page_number] = stargazers['pageInfo']['endCursor']
+
+                if page_number == page or not stargazers['pageInfo']['hasNextPage']:
+                    break
+
+        if page_number != page:
+            return []
+
+        return list(map(_parse_star_edge, stargazers['edges']))
+
+
+    async def get_repo_stargazers_since(self,
+                                        repo_url: str,
+                                        since: Optional[datetime],
+                                        limit: Optional[int] = None) -> List[Dict]:
+        '''Get the stargazers starred after the time walking from the newest ones.
+        The limit bounds the number of the newest stargazers.'''
+        owner, name = _get_repo_owner_and_name(repo_url)
+
+        stars = []
+        before = None
+        while True:
+            size = MAX_PAGE_SIZE if limit is None else min(MAX_PAGE_SIZE, limit - len(stars))
+            data = await self.query(NEWEST_STARGAZERS_QUERY, {
+                'owner': owner,
+                'name': name,
+                'size': size,
+                'before': before
+            })
+            stargazers = data['repository']['stargazers']
+
+            for edge in reversed(stargazers['edges']):
+                star = _parse_star_edge(edge)
+                if since is not None and star['starred_at'] <= since:
+                    return list(reversed(stars))
+
+                stars.append(star)
+                if limit is not None and len(stars) >= limit:
+                    return list(reversed(stars))
+
+            if not stargazers['pageInfo']['hasPreviousPage']:
+                return list(reversed(stars))
+
+            before = stargazers['pageInfo']['startCursor']
@@ -0,0 +1,142 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+import unittest
+from github_api import GithubApiError
+from github_graphql import GithubGraphqlClient, NEWEST_STARGAZERS_QUERY, STARGAZERS_PAGE_QUERY
+
+
+REPO_URL = 'https://api.github.com/repos/owner/repo/stargazers'
+
+
+class FakeGraphqlClient(GithubGraphqlClient):
+    '''The graphql client which answers queries by the known repos and records them'''
+
+    def __init__(self, repos_counts: Dict[str, int] = None, logins: List[str] = None) -> None:
+        super().__init__()
+        self.repos_counts = repos_counts or {}
+        self.stars = [{'starredAt': (datetime(2022, 1, 1, tzinfo=timezone.utc)
+                                     + timedelta(days=index)).isoformat(),
+                       'node': {'login': login}}
+                      for index, login in enumerate(logins or [])]
+        self.queries = []
+
+
+    async def query(self, query: str, variables: Dict) -> Dict:
+        self.queries.append((query, variables))
+
+        if query == STARGAZERS_PAGE_QUERY:
+            start = int(variables['after'] or 0)
+            end = start + variables['size']
+            return {'repository': {'stargazers': {
+                'edges': self.stars[start:end],
+                'pageInfo': {'endCursor': str(end), 'hasNextPage': end < len(self.stars)}
+            }}}
+
+        if query == NEWEST_STARGAZERS_QUERY:
+            end = int(variables['before'] or len(self.stars))
+            start = max(end - variables['size'], 0)
+            return {'repository': {'stargazers': {
+                'edges': self.stars[start:end],
+                'pageInfo': {'startCursor': str(start), 'hasPreviousPage': start > 0}
+            }}}
+
+        data = {}
+        for name, value in variables.items():
+            if name.startswith('owner'):
+                index = name[len('owner'):]
+                repo = f'{value}/{variables["name" + index]}'
+                if repo in self.repos_counts:
+                    data[f'r{index}'] = {'stargazerCount': self.repos_counts[repo]}
+
+        return data
+
+
+class GithubGraphqlClientTestCase(unittest.TestCase):
+    def test_get_repo_stars_count_batches_concurrent_calls(self):
+        '''Test the concurrent counts are loaded by one query'''
+
+        # Arrange
+        client = FakeGraphqlClient(repos_counts={'owner/first': 1, 'owner/second': 2})
+
+        async def get_counts():
+            return await asyncio.gather(
+                client.get_repo_stars_count('https://api.github.com/repos/owner/first'),
+                client.get_repo_stars_count('https://api.github.com/repos/owner/second'),
+                client.get_repo_stars_count('https://api.github.com/repos/owner/missing'),
+                return_exceptions=True)
+
+        # Act
+        counts = asyncio.run(get_counts())
+
+        # Assert
+        assert counts[:2] == [1, 2]
+        assert isinstance(counts[2], GithubApiError)
+        assert counts[2].status == 404
+        assert len(client.queries) == 1
+        assert len(client._counts_tasks) == 0
+
+    def test_get_repo_stargazers_page_walks_cursors(self):
+        '''Test the pages before the requested one are walked once'''
+
+        # Arrange
+        client = FakeGraphqlClient(logins=[f'login{index}' for index in range(7)])
+
+        async def get_pages():
+            third_page = await client.get_repo_stargazers_page(REPO_URL, 3, 2)
+            third_page_queries = len(client.queries)
+            fourth_page = await client.get_repo_stargazers_page(REPO_URL, 4, 2)
+            missing_page = await client.get_repo_stargazers_page(REPO_URL, 6, 2)
+            return third_page, third_page_queries, fourth_page, missing_page
+
+        # Act
+        third_page, third_page_queries, fourth_page, missing_page = asyncio.run(get_pages())
+
+        # Assert
+        assert [star['login'] for star in third_page] == ['login4', 'login5']
+        assert third_page_queries == 3
+        assert [star['login'] for star in fourth_page] == ['login6']
+        assert [variables['after'] for _, variables in client.queries[3:4]] == ['6']
+        assert missing_page == []
+
+    def test_forget_repo_pages(self):
+        '''Test the walk starts from the first page after the cursors are forgotten'''
+
+        # Arrange
+        client = FakeGraphqlClient(logins=[f'login{index}' for index in range(4)])
+        asyncio.run(client.get_repo_stargazers_page(REPO_URL, 2, 2))
+
+        # Act
+        client.forget_repo_pages(REPO_URL)
+
+        # Assert
+        assert client._pages_cursors == {}
+        assert client._pages_locks == {}
+
+    def test_get_repo_stargazers_since_stops_at_since(self):
+        '''Test only the stargazers starred after the time are walked'''
+
+        # Arrange
+        client = FakeGraphqlClient(logins=[f'login{index}' for index in range(250)])
+        since = datetime(2022, 1, 1, tzinfo=timezone.utc) + timedelta(days=139)
+
+        # Act
+        stars = asyncio.run(client.get_repo_stargazers_since(REPO_URL, since))
+
+        # Assert
+        assert [star['login'] for star in stars] == [f'login{index}' for index in range(140, 250)]
+        assert len(client.queries) == 2
+
+    def test_get_repo_stargazers_since_stops_at_limit(self):
+        '''Test the limit bounds the newest stargazers'''
+
+        # Arrange
+        client = FakeGraphqlClient(logins=[f'login{index}' for index in range(10)])
+
+        # Act
+        stars = asyncio.run(client.get_repo_stargazers_since(REPO_URL, None, limit=3))
+
+        # Assert
+        assert [star['login'] for star in stars] == ['login7', 'login8', 'login9']
+        assert client.queries[0][1]['size'] == 3
+        assert len(client.queries) == 1
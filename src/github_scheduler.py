@@ -0,0 +1,111 @@
+'''The module with the scheduler of github api requests'''
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Mapping, Optional
+import asyncio
+import logging
+import random
+import settings
+from github_tokens import TokenPool
+
+
+@dataclass
+class GithubResponse:
+    '''The github api response'''
+    status: int
+    headers: Mapping[str, str]
+    content: Any
+
+
+class GithubRequestScheduler:
+    '''Limits the number of requests in flight, spreads them over the token pool,
+    paces them by the remaining quota and retries the rate limited and failed ones.
+    The pace is kept by token buckets in redis, so it's shared by all workers.'''
+
+    def __init__(self,
+                 token_pool: TokenPool = None,
+                 max_in_flight: int = None,
+                 max_requests_per_second: float = None,
+                 max_retries: int = None,
+                 retry_backoff_seconds: float = None,
+                 logger=None) -> None:
+        self.token_pool = token_pool or TokenPool()
+        self.max_in_flight = max_in_flight or settings.GITHUB_MAX_IN_FLIGHT
+        self.max_requests_per_second = max_requests_per_second or \
+                                       settings.GITHUB_MAX_REQUESTS_PER_SECOND
+        self.max_retries = settings.GITHUB_MAX_RETRIES if max_retries is None else max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds or settings.GITHUB_RETRY_BACKOFF_SECONDS
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._semaphore = None
+        self._semaphore_loop = None
+
+
+    def __get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._semaphore_loop = loop
+
+        return self._semaphore
+
+
+    async def __acquire_token(self) -> Optional[str]:
+        while True:
+            reservation = await self.token_pool.acquire(self.max_requests_per_second)
+            if reservation.delay <= 0:
+                return reservation.token
+
+            if reservation.exhausted:
+                self.logger.warning('github rate limit of all tokens is exhausted, wait %s seconds',
+                                    reservation.delay)
+
+            await asyncio.sleep(reservation.delay)
+
+
+    @staticmethod
+    def __is_retryable(response: GithubResponse) -> bool:
+        if response.status == 429 or response.status >= 500:
+            return True
+
+        # 403 is returned for the exhausted primary and the secondary rate limits
+        return response.status == 403 and \
+            ('Retry-After' in response.headers
+             or response.headers.get('X-RateLimit-Remaining') == '0'
+             or 'rate limit' in str(response.content).lower())
+
+
+    def __get_retry_delay(self, response: GithubResponse, attempt: int) -> float:
+        if 'Retry-After' in response.headers:
+            return float(response.headers['Retry-After'])
+
+        # The spent token is marked by its quota headers, so the request is retried at once
+        # by another token and waits for the earliest reset only when all tokens are spent
+        if response.headers.get('X-RateLimit-Remaining') == '0' \
+                and 'X-RateLimit-Reset' in response.headers:
+            return 0
+
+        return random.uniform(0, self.retry_backoff_seconds * 2 ** attempt)
+
+
+    async def run(self,
+                  send_request: Callable[[Optional[str]], Awaitable[GithubResponse]]
+                  ) -> GithubResponse:
+        '''Send the request by the token with the most headroom when the rate limit allows it'''
+        semaphore = self.__get_semaphore()
+
+        attempt = 0
+        while True:
+            async with semaphore:
+                token = await self.__acquire_token()
+                response = await send_request(token)
+
+            # Github doesn't count the conditional requests answered by 304
+            await self.token_pool.update(token, response.headers, refund=response.status == 304)
+
+            if not self.__is_retryable(response) or attempt >= self.max_retries:
+                return response
+
+            delay = self.__get_retry_delay(response, attempt)
+            self.logger.warning('github responded %s, retry in %s seconds', response.status, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
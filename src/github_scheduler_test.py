@@ -0,0 +1,71 @@
+import asyncio
+import time
+import unittest
+from github_scheduler import GithubRequestScheduler, GithubResponse
+from github_tokens import TokenPool
+from redis_pool import close_async_connection_pool, get_redis_connection
+from testing import use_test_redis_db
+
+
+class GithubRequestSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        use_test_redis_db()
+        self.redis_connection = get_redis_connection()
+        self.redis_connection.flushdb()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.run_until_complete(close_async_connection_pool())
+        self.loop.close()
+        self.redis_connection.flushdb()
+
+    def run_async(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def test_run_retries_spent_token_by_another_token(self):
+        # Arrange
+        pool = TokenPool(['first', 'second'])
+        reset = str(int(time.time()) + 3600)
+        self.run_async(pool.update('first', {'X-RateLimit-Remaining': '100',
+                                             'X-RateLimit-Reset': reset}))
+        self.run_async(pool.update('second', {'X-RateLimit-Remaining': '50',
+                                              'X-RateLimit-Reset': reset}))
+        scheduler = GithubRequestScheduler(pool, max_requests_per_second=100)
+        tokens = []
+
+        async def send_request(token):
+            tokens.append(token)
+            if token == 'first':
+                return GithubResponse(status=403,
+                                      headers={'X-RateLimit-Remaining': '0',
+                                               'X-RateLimit-Reset': reset},
+                                      content='API rate limit exceeded')
+
+            return GithubResponse(status=200, headers={}, content='[]')
+
+        # Act
+        started_time = time.monotonic()
+        response = self.run_async(scheduler.run(send_request))
+
+        # Assert
+        assert response.status == 200
+        assert tokens == ['first', 'second']
+        assert time.monotonic() - started_time < 1
+
+    def test_run_retries_server_errors(self):
+        # Arrange
+        scheduler = GithubRequestScheduler(TokenPool(['first']),
+                                           max_requests_per_second=100,
+                                           max_retries=2,
+                                           retry_backoff_seconds=0.01)
+        statuses = [502, 502, 502]
+
+        async def send_request(_):
+            return GithubResponse(status=statuses.pop(0), headers={}, content='')
+
+        # Act
+        response = self.run_async(scheduler.run(send_request))
+
+        # Assert
+        assert response.status == 502
+        assert statuses == []
@@ -0,0 +1,198 @@
+'''The module with the pool of github tokens'''
+from dataclasses import dataclass
+from hashlib import sha256
+from typing import List, Mapping, Optional
+import time
+from redis_pool import get_async_redis_connection
+import settings
+from metrics import GITHUB_RATE_LIMIT_REMAINING
+
+
+# The hourly quota of the authenticated and the anonymous requests
+TOKEN_QUOTA = 5000
+ANONYMOUS_QUOTA = 60
+
+# The bucket which limits the requests of all tokens
+ALL_TOKENS_BUCKET_KEY = 'github_rate_all'
+
+# Picks the token with the most headroom, takes a token from the bucket of all tokens and
+# from the bucket of the picked one when it's paced, and reserves the request in its quota.
+# The buckets are taken all or none. KEYS are the bucket of all tokens and the quota and
+# the bucket of every token. ARGV are the current time, the max rate, the remaining quota
+# which starts pacing and the hourly quota of every token.
+# Returns the index of the token, seconds to wait and 1 when the quota of all tokens is spent.
+ACQUIRE_TOKEN_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local max_rate = tonumber(ARGV[2])
+local pacing_remaining = tonumber(ARGV[3])
+
+local best, best_headroom, best_reset
+local earliest_reset = math.huge
+for i = 1, (#KEYS - 1) / 2 do
+    local quota = redis.call('HMGET', KEYS[2 * i], 'remaining', 'reset')
+    local reset = tonumber(quota[2]) or 0
+    local headroom = tonumber(ARGV[i + 3])
+    -- The reserved requests are counted before the first response is known
+    if reset > now then
+        headroom = tonumber(quota[1])
+        earliest_reset = math.min(earliest_reset, reset)
+    end
+    if best == nil or headroom > best_headroom
+            or (headroom == best_headroom and reset < best_reset) then
+        best, best_headroom, best_reset = i, headroom, reset
+    end
+end
+
+if best_headroom <= 0 then
+    return {best - 1, tostring(math.max(earliest_reset - now, 1)), 1}
+end
+
+-- All tokens together are limited by the max rate, the token with the low quota
+-- is paced to spend the rest of it till the reset
+local keys = {KEYS[1]}
+local rates = {max_rate}
+if best_headroom < pacing_remaining then
+    keys[2] = KEYS[2 * best + 1]
+    rates[2] = math.min(max_rate, best_headroom / math.max(best_reset - now, 1))
+end
+
+local tokens = {}
+local delay = 0
+for i = 1, #keys do
+    local capacity = math.max(rates[i], 1)
+    local bucket = redis.call('HMGET', keys[i], 'tokens', 'updated_time')
+    local elapsed = math.max(now - (tonumber(bucket[2]) or now), 0)
+    tokens[i] = math.min(capacity, (tonumber(bucket[1]) or capacity) + elapsed * rates[i])
+    if tokens[i] < 1 then
+        delay = math.max(delay, (1 - tokens[i]) / rates[i])
+    end
+end
+
+for i = 1, #keys do
+    if delay == 0 then
+        tokens[i] = tokens[i] - 1
+    end
+    redis.call('HSET', keys[i], 'tokens', tostring(tokens[i]), 'updated_time', ARGV[1])
+    -- The idle bucket is full again after capacity / rate seconds, so it can expire
+    redis.call('EXPIRE', keys[i], math.ceil(math.max(rates[i], 1) / rates[i]) + 1)
+end
+
+if delay == 0 then
+    redis.call('HINCRBY', KEYS[2 * best], 'remaining', -1)
+end
+
+return {best - 1, tostring(delay), 0}
+'''
+
+# Sets the quota of the token by the response and gives back the tokens taken
+# from the buckets when the response isn't counted by github. The refill caps the buckets
+# by their capacity. KEYS are the quota of the token, the bucket of all tokens and the bucket
+# of the token. ARGV are the remaining quota and the reset time, empty when they are unknown,
+# and 1 to refund the buckets.
+UPDATE_TOKEN_SCRIPT = '''
+if ARGV[1] ~= '' then
+    redis.call('HSET', KEYS[1], 'remaining', ARGV[1], 'reset', ARGV[2])
+    redis.call('EXPIREAT', KEYS[1], ARGV[2])
+end
+
+if ARGV[3] == '1' then
+    for i = 2, #KEYS do
+        if redis.call('HEXISTS', KEYS[i], 'tokens') == 1 then
+            redis.call('HINCRBYFLOAT', KEYS[i], 'tokens', 1)
+        end
+    end
+end
+'''
+
+
+@dataclass
+class TokenReservation:
+    '''The token picked for the request. The request is reserved
+    when there is no delay, otherwise it should be acquired again after the delay.'''
+    token: Optional[str]
+    delay: float
+    exhausted: bool
+
+
+class TokenPool:
+    '''The pool of github tokens. The remaining quota and the reset time of every token
+    are tracked in redis by response headers, so all workers share them. The requests are
+    paced by the token buckets in redis. The clock of the caller is used for them,
+    so the clocks of the hosts should be synchronized.'''
+
+    def __init__(self,
+                 tokens: List[str] = None,
+                 redis_connection=None,
+                 pacing_remaining: int = None) -> None:
+        self.redis_connection = redis_connection
+        tokens = settings.GITHUB_KEYS if tokens is None else tokens
+        self.tokens = tokens if len(tokens) > 0 else [None]
+        self.pacing_remaining = settings.GITHUB_PACING_REMAINING if pacing_remaining is None \
+                                else pacing_remaining
+
+        self.__acquire_token_script = None
+        self.__update_token_script = None
+
+
+    def __get_redis_connection(self):
+        return self.redis_connection or get_async_redis_connection()
+
+
+    @staticmethod
+    def __get_token_id(token: Optional[str]) -> str:
+        return sha256(token.encode()).hexdigest()[:16] if token is not None else 'anonymous'
+
+
+    def __get_redis_key(self, token: Optional[str]) -> str:
+        return 'github_token_' + self.__get_token_id(token)
+
+
+    def get_bucket_key(self, token: Optional[str]) -> str:
+        '''Get the key of the rate limit bucket of the token'''
+        return 'github_rate_' + self.__get_token_id(token)
+
+
+    async def acquire(self, max_requests_per_second: float) -> TokenReservation:
+        '''Pick the token with the most headroom and reserve the request by it
+        when the rate limits allow it. Takes one redis round trip.'''
+        redis_connection = self.__get_redis_connection()
+        if self.__acquire_token_script is None:
+            self.__acquire_token_script = redis_connection.register_script(ACQUIRE_TOKEN_SCRIPT)
+
+        keys = [ALL_TOKENS_BUCKET_KEY]
+        for token in self.tokens:
+            keys.extend([self.__get_redis_key(token), self.get_bucket_key(token)])
+
+        index, delay, exhausted = await self.__acquire_token_script(
+            keys=keys,
+            args=[repr(time.time()), max_requests_per_second, self.pacing_remaining,
+                  *[TOKEN_QUOTA if token is not None else ANONYMOUS_QUOTA
+                    for token in self.tokens]],
+            client=redis_connection)
+        return TokenReservation(token=self.tokens[int(index)],
+                                delay=float(delay),
+                                exhausted=int(exhausted) == 1)
+
+
+    async def update(self, token: Optional[str], headers: Mapping[str, str], refund: bool = False):
+        '''Update the token quota by the response headers. The refund gives back the pace
+        of the request which isn't counted by github.'''
+        has_quota = 'X-RateLimit-Remaining' in headers and 'X-RateLimit-Reset' in headers
+        if not has_quota and not refund:
+            return
+
+        redis_connection = self.__get_redis_connection()
+        if self.__update_token_script is None:
+            self.__update_token_script = redis_connection.register_script(UPDATE_TOKEN_SCRIPT)
+
+        redis_key = self.__get_redis_key(token)
+        await self.__update_token_script(
+            keys=[redis_key, ALL_TOKENS_BUCKET_KEY, self.get_bucket_key(token)],
+            args=[headers['X-RateLimit-Remaining'] if has_quota else '',
+                  headers['X-RateLimit-Reset'] if has_quota else '',
+                  1 if refund else 0],
+            client=redis_connection)
+
+        if has_quota:
+            GITHUB_RATE_LIMIT_REMAINING.labels(token=redis_key).set(
+                int(headers['X-RateLimit-Remaining']))
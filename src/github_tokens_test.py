@@ -0,0 +1,123 @@
+import asyncio
+import time
+import unittest
+from github_tokens import ALL_TOKENS_BUCKET_KEY, TokenPool
+from redis_pool import close_async_connection_pool, get_redis_connection
+from testing import use_test_redis_db
+
+
+class TokenPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        use_test_redis_db()
+        self.redis_connection = get_redis_connection()
+        self.redis_connection.flushdb()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.run_until_complete(close_async_connection_pool())
+        self.loop.close()
+        self.redis_connection.flushdb()
+
+    def run_async(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def test_acquire_picks_token_with_most_headroom(self):
+        # Arrange
+        pool = TokenPool(['first', 'second'])
+        reset = str(int(time.time()) + 3600)
+        self.run_async(pool.update('first', {'X-RateLimit-Remaining': '10',
+                                             'X-RateLimit-Reset': reset}))
+        self.run_async(pool.update('second', {'X-RateLimit-Remaining': '20',
+                                              'X-RateLimit-Reset': reset}))
+
+        # Act
+        reservation = self.run_async(pool.acquire(100))
+
+        # Assert
+        assert reservation.token == 'second'
+        assert reservation.delay == 0
+        assert not reservation.exhausted
+
+    def test_acquire_reserves_request_in_quota(self):
+        # Arrange
+        pool = TokenPool(['first', 'second'])
+        reset = str(int(time.time()) + 3600)
+        self.run_async(pool.update('first', {'X-RateLimit-Remaining': '2',
+                                             'X-RateLimit-Reset': reset}))
+        self.run_async(pool.update('second', {'X-RateLimit-Remaining': '2',
+                                              'X-RateLimit-Reset': reset}))
+
+        # Act
+        reservations = [self.run_async(pool.acquire(100)) for _ in range(2)]
+
+        # Assert
+        assert [reservation.token for reservation in reservations] == ['first', 'second']
+        assert all(reservation.delay == 0 for reservation in reservations)
+        assert [int(self.redis_connection.hget(key, 'remaining'))
+                for key in self.redis_connection.keys('github_token_*')] == [1, 1]
+
+    def test_acquire_paces_by_shared_bucket(self):
+        # Arrange
+        pool = TokenPool(['first'])
+        self.run_async(pool.acquire(1))
+
+        # Act
+        reservation = self.run_async(TokenPool(['second']).acquire(1))
+
+        # Assert
+        assert 0 < reservation.delay <= 1
+        assert self.redis_connection.exists(ALL_TOKENS_BUCKET_KEY)
+
+    def test_acquire_bursts_while_quota_is_high(self):
+        # Arrange
+        pool = TokenPool(['first'], pacing_remaining=50)
+        self.run_async(pool.update('first', {'X-RateLimit-Remaining': '100',
+                                             'X-RateLimit-Reset': str(int(time.time()) + 3600)}))
+
+        # Act
+        reservations = [self.run_async(pool.acquire(10)) for _ in range(10)]
+
+        # Assert
+        assert all(reservation.delay == 0 for reservation in reservations)
+
+    def test_acquire_paces_token_when_quota_is_low(self):
+        # Arrange
+        pool = TokenPool(['first'], pacing_remaining=50)
+        self.run_async(pool.update('first', {'X-RateLimit-Remaining': '10',
+                                             'X-RateLimit-Reset': str(int(time.time()) + 3600)}))
+        self.run_async(pool.acquire(10))
+
+        # Act
+        reservation = self.run_async(pool.acquire(10))
+
+        # Assert
+        assert reservation.token == 'first'
+        assert reservation.delay > 1
+
+    def test_update_refunds_pace(self):
+        # Arrange
+        pool = TokenPool(['first'])
+        self.run_async(pool.acquire(1))
+
+        # Act
+        self.run_async(pool.update('first', {}, refund=True))
+        reservation = self.run_async(pool.acquire(1))
+
+        # Assert
+        assert reservation.delay == 0
+
+    def test_acquire_waits_for_earliest_reset_when_all_tokens_are_spent(self):
+        # Arrange
+        pool = TokenPool(['first', 'second'])
+        now = int(time.time())
+        self.run_async(pool.update('first', {'X-RateLimit-Remaining': '0',
+                                             'X-RateLimit-Reset': str(now + 100)}))
+        self.run_async(pool.update('second', {'X-RateLimit-Remaining': '0',
+                                              'X-RateLimit-Reset': str(now + 50)}))
+
+        # Act
+        reservation = self.run_async(pool.acquire(100))
+
+        # Assert
+        assert reservation.exhausted
+        assert 40 < reservation.delay <= 50
@@ -0,0 +1,78 @@
+'''The module with prometheus metrics of workers, bot and github client'''
+import os
+import shutil
+
+# The directory must exist before metrics are created
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+# pylint: disable=wrong-import-position
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess, \
+                              start_http_server
+import settings
+
+
+GITHUB_REQUEST_SECONDS = Histogram('github_request_seconds',
+                                   'Github api request latency',
+                                   ['endpoint', 'status'])
+GITHUB_RATE_LIMIT_REMAINING = Gauge('github_rate_limit_remaining',
+                                    'Remaining github api quota of the token',
+                                    ['token'],
+                                    multiprocess_mode='livemin')
+REPO_PAGES_FETCHED = Histogram('repo_pages_fetched',
+                               'Stargazer pages fetched per repo sync',
+                               buckets=(0, 1, 2, 5, 10, 25, 50, 100, 200, 400, 1000))
+REPO_DIFF_SIZE = Histogram('repo_diff_size',
+                           'Added or removed stars per repo sync',
+                           ['kind'],
+                           buckets=(0, 1, 2, 5, 10, 50, 100, 1000, 10000))
+REDIS_OPERATION_SECONDS = Histogram('redis_operation_seconds',
+                                    'Redis operations latency of the stars update',
+                                    ['operation'])
+TASK_SECONDS = Histogram('celery_task_seconds',
+                         'Celery task duration',
+                         ['task'])
+TASK_QUEUE_LAG_SECONDS = Histogram('celery_task_queue_lag_seconds',
+                                   'Time between the task publishing and its start',
+                                   ['task'])
+TELEGRAM_SEND_SECONDS = Histogram('telegram_send_seconds',
+                                  'Telegram send message latency')
+TELEGRAM_SEND_ERRORS = Counter('telegram_send_errors_total',
+                               'Telegram send message errors',
+                               ['error'])
+BOT_HANDLER_SECONDS = Histogram('bot_handler_seconds',
+                                'Telegram bot handlers latency',
+                                ['handler'])
+
+
+def is_multiprocess_mode() -> bool:
+    '''Metrics of prefork processes are collected through files in the shared directory'''
+    return 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+
+def clean_multiprocess_dir():
+    '''Remove metrics files left by the previous run'''
+    multiprocess_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(multiprocess_dir, ignore_errors=True)
+    os.makedirs(multiprocess_dir)
+
+
+def start_metrics_server(port: int = None):
+    '''Expose metrics by http. Does nothing when METRICS_PORT isn't set'''
+    port = port or settings.METRICS_PORT
+    if not port:
+        return
+
+    if is_multiprocess_mode():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(port, registry=registry)
+        return
+
+    start_http_server(port)
+
+
+def mark_process_dead(pid: int):
+    '''Forget live gauges of the finished process'''
+    if is_multiprocess_mode():
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,10 @@
+'''Convert the stored stars of all repos from the legacy list of json items
+and the legacy set of logins to the stars buckets'''
+import logging
+from notification import Notification
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    migrated = Notification().migrate_legacy_stars()
+    logging.info('Stars of %s repos are migrated.', migrated)
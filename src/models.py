@@ -1,6 +1,10 @@
 # from tkinter import W
 from email.policy import default
-from sqlalchemy import DateTime, Column, String, Integer, Boolean, Table, ForeignKey, create_engine, PrimaryKeyConstraint
+import threading
+from typing import List
+from sqlalchemy import DateTime, Column, String, Integer, Boolean, Table, ForeignKey, create_engine, PrimaryKeyConstraint, \
+                       BigInteger, Date, Index
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy_utils import database_exists, create_database
@@ -8,7 +12,17 @@ import settings
 
 
 postgresql_url = f'postgresql://{settings.POSTGRESQL_USER}:{settings.POSTGRESQL_PASSWORD}@{settings.POSTGRESQL_HOST}:{settings.POSTGRESQL_PORT}/{settings.POSTGRESQL_DB}'
-engine = create_engine(postgresql_url)
+database_url = settings.DATABASE_URL or postgresql_url
+if database_url.startswith('sqlite'):
+    engine = create_engine(database_url)
+else:
+    engine = create_engine(
+        database_url,
+        pool_size=settings.DATABASE_POOL_SIZE,
+        max_overflow=settings.DATABASE_MAX_OVERFLOW,
+        pool_timeout=settings.DATABASE_POOL_TIMEOUT_SECONDS,
+        pool_pre_ping=True
+    )
 _SessionFactory = sessionmaker(bind=engine)
 
 Base = declarative_base()
@@ -26,9 +40,25 @@ def get_or_create(session, model, **kwargs):
         return instance
 
 
+_schema_lock = threading.Lock()
+_schema_created = False
+
+
+def create_schema():
+    '''Create missing tables once per process'''
+    global _schema_created  # pylint: disable=global-statement
+    if _schema_created:
+        return
+
+    with _schema_lock:
+        if not _schema_created:
+            Base.metadata.create_all(engine)
+            _schema_created = True
+
+
 def session_factory():
     '''Generate the session factory'''
-    Base.metadata.create_all(engine)
+    create_schema()
     return _SessionFactory()
 
 
@@ -36,7 +66,8 @@ association_table = Table(
     'user_repo_association', Base.metadata,
     Column('user_id', Integer, ForeignKey('user.id')),
     Column('repo_id', Integer, ForeignKey('repo.id')),
-    PrimaryKeyConstraint('user_id', 'repo_id')
+    PrimaryKeyConstraint('user_id', 'repo_id'),
+    Index('ix_user_repo_association_repo_id', 'repo_id')
 )
 
 
@@ -58,19 +89,47 @@ class Repo(Base):
     stars_init = Column(Boolean, default=False)
     last_updated_time = Column(DateTime, nullable=True, default=None)
     #users = relationship("User", secondary=association_table)
-    #likes = relationship("Like", back_populates="repo")
-
-
-# class Like(Base):
-#     '''Like info'''
 
-#     __tablename__ = 'like'
 
-#     id = Column(Integer, primary_key=True)
-#     user = Column(String)
-#     datetime = Column(DateTime)
-#     repo_id = Column(Integer, ForeignKey('repo.id'))
-#     repo = relationship("Repo", back_populates="likes")
+class StarEvent(Base):
+    '''The star or unstar of the repo. The table is append only.'''
+    __tablename__ = 'star_event'
+    __table_args__ = (
+        Index('ix_star_event_repo_id_event_time', 'repo_id', 'event_time'),
+    )
+
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    repo_id = Column(Integer, ForeignKey('repo.id'), nullable=False)
+    login = Column(String, nullable=False)
+    starred = Column(Boolean, nullable=False)
+    event_time = Column(DateTime, nullable=False)
+
+
+class RepoStarsRollup(Base):
+    '''Stars changes of the repo per day or week'''
+    __tablename__ = 'repo_stars_rollup'
+
+    repo_id = Column(Integer, ForeignKey('repo.id'), primary_key=True)
+    period = Column(String, primary_key=True)
+    period_start = Column(Date, primary_key=True)
+    added = Column(Integer, nullable=False, default=0)
+    removed = Column(Integer, nullable=False, default=0)
+
+
+def upsert_stars_rollups(session, rollups: List[dict]):
+    '''Add stars changes to the rollups creating the missing ones'''
+    if len(rollups) == 0:
+        return
+
+    insert = postgresql.insert if session.bind.dialect.name == 'postgresql' else sqlite.insert
+    statement = insert(RepoStarsRollup.__table__).values(rollups)
+    statement = statement.on_conflict_do_update(
+        index_elements=['repo_id', 'period', 'period_start'],
+        set_={
+            'added': RepoStarsRollup.__table__.c.added + statement.excluded.added,
+            'removed': RepoStarsRollup.__table__.c.removed + statement.excluded.removed
+        })
+    session.execute(statement)
 
 if __name__ == '__main___':
     if not database_exists(engine.url):
@@ -1,18 +1,113 @@
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 from enum import Enum
-from typing import Dict, List
+from collections import deque
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
 import logging
 import math
-from dataclasses import dataclass, field
-from dataclasses_json import dataclass_json, config
-import redis
-from marshmallow import fields
-from sqlalchemy.orm import sessionmaker
+from dataclasses import dataclass
+import json
+import zlib
+from redis_pool import get_redis_connection
+from sqlalchemy import exists, select
+from sqlalchemy.orm import selectinload
 import asyncio 
 from common import get_api_repo_url_from_repo_url
 import settings
 import github_api
-from models import session_factory, User, Repo, get_or_create
+import worker_resources
+from poll_scheduler import PollScheduler
+from metrics import REDIS_OPERATION_SECONDS, REPO_DIFF_SIZE, REPO_PAGES_FETCHED
+from models import session_factory, User, Repo, RepoStarsRollup, StarEvent, association_table, \
+                   get_or_create, upsert_stars_rollups
+
+
+# Replaces the stored stars buckets by the staging ones and returns added and removed logins.
+# KEYS are the watermark, the stored buckets and the staging buckets. ARGV are the numbers
+# of the stored and the staging buckets. The diff is skipped when ARGV[3] is 0,
+# so the baseline sync doesn't return all stars.
+SWAP_STARS_SCRIPT = '''
+local stored_count = tonumber(ARGV[1])
+local staging_count = tonumber(ARGV[2])
+local keys_count = math.max(stored_count, staging_count)
+local added = {}
+local removed = {}
+
+local function diff(stored_logins, staging_logins)
+    local stored = {}
+    for _, login in ipairs(stored_logins) do
+        stored[login] = true
+    end
+    for _, login in ipairs(staging_logins) do
+        if stored[login] then
+            stored[login] = nil
+        else
+            table.insert(added, login)
+        end
+    end
+    for login in pairs(stored) do
+        table.insert(removed, login)
+    end
+end
+
+local function get_logins(first, last)
+    local logins = {}
+    for i = first, last do
+        for _, login in ipairs(redis.call('HKEYS', KEYS[i])) do
+            table.insert(logins, login)
+        end
+    end
+    return logins
+end
+
+if ARGV[3] == '1' then
+    if stored_count == staging_count then
+        -- The login is in the bucket with the same number, so buckets are compared by pairs
+        for i = 2, stored_count + 1 do
+            diff(get_logins(i, i), get_logins(i + keys_count, i + keys_count))
+        end
+    else
+        diff(get_logins(2, stored_count + 1),
+             get_logins(keys_count + 2, keys_count + staging_count + 1))
+    end
+end
+
+for i = 2, keys_count + 1 do
+    redis.call('DEL', KEYS[i])
+end
+for i = 2, staging_count + 1 do
+    if redis.call('EXISTS', KEYS[i + keys_count]) == 1 then
+        redis.call('RENAME', KEYS[i + keys_count], KEYS[i])
+    end
+end
+redis.call('HSET', KEYS[1], 'buckets', staging_count)
+
+return {added, removed}
+'''
+
+# Adds stars to the stored buckets and returns logins which were missing.
+# KEYS are buckets of the stars, ARGV are pairs of the login and the starred_at.
+ADD_STARS_SCRIPT = '''
+local added = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('HSETNX', key, ARGV[2 * i - 1], ARGV[2 * i]) == 1 then
+        table.insert(added, ARGV[2 * i - 1])
+    end
+end
+return added
+'''
+
+# Adds the scored logins to the newest stars, trims them to the window size
+# and returns the logins which were missing
+ADD_NEWEST_STARS_SCRIPT = '''
+local added = {}
+for i = 2, #ARGV, 2 do
+    if redis.call('ZADD', KEYS[1], 'NX', ARGV[i], ARGV[i + 1]) == 1 then
+        table.insert(added, ARGV[i + 1])
+    end
+end
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[1]) - 1)
+return added
+'''
 
 
 class SubscribeResult(Enum):
@@ -28,16 +123,74 @@ class UnsubscribeResut(Enum):
     REPO_MISSING = 2
 
 
-@dataclass_json
-@dataclass
 class StarItem:
-    login: str
-    starred_at: datetime = field(
-        metadata=config(
-            encoder=datetime.isoformat,
-            decoder=datetime.fromisoformat,
-            mm_field=fields.DateTime(format='iso')
-        ))
+    '''The stargazer. It's created for every star, so it has no per instance dict'''
+    __slots__ = ('login', 'starred_at')
+
+    def __init__(self, login: str, starred_at: Optional[datetime]) -> None:
+        self.login = login
+        self.starred_at = starred_at
+
+    @classmethod
+    def from_dict(cls, item: Dict) -> 'StarItem':
+        '''Create from the github api item'''
+        starred_at = item['starred_at']
+        if isinstance(starred_at, str):
+            starred_at = datetime.fromisoformat(starred_at)
+
+        return cls(item['login'], starred_at)
+
+    @classmethod
+    def from_json(cls, content: str) -> 'StarItem':
+        '''Create from the json stored by the legacy stars list'''
+        return cls.from_dict(json.loads(content))
+
+    @classmethod
+    def from_stored(cls, login: bytes, starred_at: bytes) -> 'StarItem':
+        '''Create from the field and the value of the stars bucket'''
+        starred_at = datetime.fromtimestamp(int(starred_at), timezone.utc) if starred_at else None
+        return cls(login.decode(), starred_at)
+
+    def get_stored_starred_at(self) -> str:
+        '''Get the starred_at stored by the stars bucket. The integer is kept compact by redis.
+        The stars migrated from the legacy set of logins have no starred_at.'''
+        return str(int(self.starred_at.timestamp())) if self.starred_at is not None else ''
+
+
+def get_stars_buckets_count(stars_count: int) -> int:
+    '''Get the number of buckets for the repo stars. It's the power of two,
+    so the stars are rebucketed only when the repo size is doubled.'''
+    buckets_count = 1
+    while buckets_count * settings.STARS_BUCKET_SIZE < stars_count:
+        buckets_count *= 2
+
+    return buckets_count
+
+
+def get_stars_bucket(login: str, buckets_count: int) -> int:
+    '''Get the bucket of the stargazer'''
+    return zlib.crc32(login.encode()) % buckets_count
+
+
+@dataclass
+class StarsWatermark:
+    '''The last synced state of the repo stargazers'''
+    count: int
+    # None when no stargazer is known yet
+    starred_at: Optional[datetime]
+    full_sync_time: datetime
+    approximate: bool = False
+
+
+@dataclass
+class GithubStarsResult:
+    '''Stargazers fetched from github'''
+    count: int
+    stars: List[StarItem]
+    full_sync: bool
+    pages_fetched: int = 0
+    last_starred_at: Optional[datetime] = None
+
 
 @dataclass
 class UpdateRepoStarsResult:
@@ -45,9 +198,32 @@ class UpdateRepoStarsResult:
     removed_stars: List[str]
     added_stars: List[str]
     teleg_subscribed_users: List[str]
+    repo_url: Optional[str] = None
+    # Large repos are tracked approximately, their changes can be known only by count
+    approximate: bool = False
+    removed_stars_count: int = 0
+    added_stars_count: int = 0
 
     def need_to_handle(self):
-        return self.initiated and (len(self.removed_stars) > 0 or len(self.added_stars) > 0)
+        return self.initiated and (len(self.removed_stars) > 0
+                                   or len(self.added_stars) > 0
+                                   or self.removed_stars_count > 0
+                                   or self.added_stars_count > 0)
+
+
+@dataclass
+class StarsChanges:
+    '''The number of added and removed stars'''
+    added: int
+    removed: int
+
+
+@dataclass
+class RepoStats:
+    '''Stars changes of the repo for periods'''
+    today: StarsChanges
+    last_7_days: StarsChanges
+    last_4_weeks: StarsChanges
 
 
 class Notification:
@@ -57,17 +233,33 @@ class Notification:
                     get_repo_stars_count = None,
                     get_repo_stargazers_page = None,
                     page_size = 100,
-                    logger=None
+                    logger=None,
+                    github_client: github_api.GithubClient = None,
+                    full_sync_seconds: int = None,
+                    get_repo_stargazers_since = None
                 ) -> None:
-        self.redis_connection = redis.Redis(
-                                    host=settings.REDIS_HOST,
-                                    port=settings.REDIS_PORT,
-                                    db=0)
-        self.get_repo_stars_count = get_repo_stars_count or github_api.get_repo_stars_count
+        self.redis_connection = get_redis_connection()
+        self.poll_scheduler = PollScheduler(self.redis_connection)
+        self.github_client = github_client or github_api.get_default_client()
+        self.__swap_stars_script = self.redis_connection.register_script(SWAP_STARS_SCRIPT)
+        self.__add_stars_script = self.redis_connection.register_script(ADD_STARS_SCRIPT)
+        self.__add_newest_stars_script = self.redis_connection.register_script(
+            ADD_NEWEST_STARS_SCRIPT)
+        self.get_repo_stars_count = get_repo_stars_count or self.github_client.get_repo_stars_count
         self.get_repo_stargazers_page = get_repo_stargazers_page or \
-                                        github_api.get_repo_stargazers_page
+                                        self.github_client.get_repo_stargazers_page
+
+        # The client method is used only when the pages aren't taken from elsewhere
+        if get_repo_stargazers_since is None and get_repo_stargazers_page is None:
+            get_repo_stargazers_since = getattr(self.github_client,
+                                                'get_repo_stargazers_since',
+                                                None)
+        self.get_repo_stargazers_since = get_repo_stargazers_since
 
         self.page_size = page_size
+        self.pages_window = settings.GITHUB_PAGES_WINDOW
+        self.full_sync_seconds = settings.SECONDS_FULL_SYNC if full_sync_seconds is None \
+                                 else full_sync_seconds
         self.logger = logger or logging.getLogger(__name__)
 
 
@@ -91,7 +283,7 @@ class Notification:
                 return SubscribeResult.ALREADY_SUBSCRIBE
 
             user = get_or_create(session, User, teleg_user_id = teleg_user_id)
-            repo = get_or_create(session, Repo, url = repository_url)
+            repo = self.__get_locked_repo(session, repository_url)
 
             user.repos.append(repo)
             session.commit()
@@ -99,6 +291,24 @@ class Notification:
         return SubscribeResult.OK
 
 
+    @staticmethod
+    def __get_locked_repo(session, repository_url: str) -> Repo:
+        '''Get or create the repo and lock it from removing till the commit.
+        The found orphan repo could be removed before it's locked, then it's created again.'''
+        while True:
+            repo = get_or_create(session, Repo, url = repository_url)
+            locked_repo = session.execute(
+                select(Repo)
+                .where(Repo.id == repo.id)
+                .with_for_update(read=True)
+            ).scalar_one_or_none()
+
+            if locked_repo is not None:
+                return locked_repo
+
+            session.expunge(repo)
+
+
     def unsubscribe(self, teleg_user_id: str, repository_url: str) -> UnsubscribeResut:
         '''Unsubscribe to watch for the repo'''
 
@@ -138,10 +348,94 @@ class Notification:
             return [repo.url for repo in repos]
 
 
-    def get_all_repos(self) -> List[Repo]:
-        '''Get all repos'''
+    def iter_subscribed_repo_ids(self, batch_size: int = None) -> Iterator[List[int]]:
+        '''Iterate ids of repos with at least one subscriber by batches'''
+        return self.__iter_repo_ids(self.__get_subscribed_condition(), batch_size)
+
+
+    def iter_orphan_repo_ids(self, batch_size: int = None) -> Iterator[List[int]]:
+        '''Iterate ids of repos without subscribers by batches'''
+        return self.__iter_repo_ids(~self.__get_subscribed_condition(), batch_size)
+
+
+    def __iter_repo_ids(self, condition, batch_size: int = None) -> Iterator[List[int]]:
+        batch_size = batch_size or settings.REPOS_SCAN_BATCH_SIZE
+        last_repo_id = 0
+
+        while True:
+            with session_factory() as session:
+                repo_ids = session.execute(
+                    select(Repo.id)
+                    .where(Repo.id > last_repo_id, condition)
+                    .order_by(Repo.id)
+                    .limit(batch_size)
+                ).scalars().all()
+
+            if len(repo_ids) == 0:
+                return
+
+            yield repo_ids
+            last_repo_id = repo_ids[-1]
+
+
+    @staticmethod
+    def __get_subscribed_condition():
+        return exists().where(association_table.c.repo_id == Repo.id)
+
+
+    def remove_orphan_repos(self, repo_ids: List[int]) -> List[int]:
+        '''Remove the repos which are still without subscribers with their stars history
+        and redis keys. Returns ids of the removed repos.'''
+        if len(repo_ids) == 0:
+            return []
+
         with session_factory() as session:
-            return session.query(Repo).all()
+            # Subscribing holds the shared lock of the repo till the commit,
+            # so the removing waits for it and the subscribing of the locked repo
+            # waits for the removing and creates the repo again
+            locked_repo_ids = session.execute(
+                select(Repo.id)
+                .where(Repo.id.in_(repo_ids), ~self.__get_subscribed_condition())
+                .with_for_update()
+            ).scalars().all()
+
+            if len(locked_repo_ids) == 0:
+                return []
+
+            # The subscriptions committed while the lock was awaited are seen only
+            # by the next statement
+            orphan_repo_ids = session.execute(
+                select(Repo.id)
+                .where(Repo.id.in_(locked_repo_ids), ~self.__get_subscribed_condition())
+            ).scalars().all()
+
+            if len(orphan_repo_ids) == 0:
+                return []
+
+            session.execute(StarEvent.__table__.delete()
+                            .where(StarEvent.repo_id.in_(orphan_repo_ids)))
+            session.execute(RepoStarsRollup.__table__.delete()
+                            .where(RepoStarsRollup.repo_id.in_(orphan_repo_ids)))
+            session.execute(Repo.__table__.delete()
+                            .where(Repo.id.in_(orphan_repo_ids)))
+            session.commit()
+
+        redis_keys = []
+        for repo_id in orphan_repo_ids:
+            stars_redis_key = self.__get_stars_redis_key(repo_id)
+            buckets_count = self.__get_stars_buckets_count(repo_id)
+            redis_keys.extend([stars_redis_key,
+                               stars_redis_key + '_newest',
+                               self.__get_watermark_redis_key(repo_id),
+                               *self.__get_stars_bucket_keys(stars_redis_key, buckets_count),
+                               *self.__get_stars_bucket_keys(stars_redis_key + '_staging',
+                                                             buckets_count)])
+
+        self.redis_connection.delete(*redis_keys)
+        self.poll_scheduler.remove(orphan_repo_ids)
+
+        return orphan_repo_ids
+
 
     def get_repo_by_id(self, repo_id: int) -> Repo:
         '''Get repo by id'''
@@ -154,91 +448,555 @@ class Notification:
 
         with session_factory() as session:
             repo = session.query(Repo).filter(Repo.id == repo_id).one()
-            return self.__update_repo_stars(repo, session)
+            result = self.__run_github_requests(self.__update_repo_stars(repo))
+            self.__record_stars_history(session, {repo_id: result})
+            session.commit()
+            return result
+
+
+    def update_repos_stars(self, repo_ids: List[int]) -> Dict[int, UpdateRepoStarsResult]:
+        '''Get repo starts for the batch of repos concurrently.
+        The failed repos are logged and missing in the result'''
+
+        with session_factory() as session:
+            repos = session.query(Repo)\
+                        .options(selectinload(Repo.users))\
+                        .filter(Repo.id.in_(repo_ids))\
+                        .all()
+
+            results = self.__run_github_requests(self.__update_repos_stars(repos))
+            self.__record_stars_history(session, results)
+            session.commit()
+            return results
+
+
+    def __record_stars_history(self, session, results: Dict[int, UpdateRepoStarsResult]):
+        '''Append star events and add them to the daily and weekly rollups'''
+        now = datetime.utcnow()
+        day = now.date()
+        week = day - timedelta(days=day.weekday())
+
+        events = []
+        rollups = []
+        for repo_id, result in results.items():
+            if not result.need_to_handle():
+                continue
 
+            events.extend({'repo_id': repo_id, 'login': login, 'starred': True, 'event_time': now}
+                          for login in result.added_stars)
+            events.extend({'repo_id': repo_id, 'login': login, 'starred': False, 'event_time': now}
+                          for login in result.removed_stars)
+            added_count = len(result.added_stars) + result.added_stars_count
+            removed_count = len(result.removed_stars) + result.removed_stars_count
 
-    async def __put_repo_stars_page(self,
-                                    pages:Dict[int, List[StarItem]],
-                                    page_number: int,
-                                    url: str):
+            for period, period_start in (('day', day), ('week', week)):
+                rollups.append({
+                    'repo_id': repo_id,
+                    'period': period,
+                    'period_start': period_start,
+                    'added': added_count,
+                    'removed': removed_count
+                })
 
+        if len(events) > 0:
+            session.execute(StarEvent.__table__.insert(), events)
+
+        upsert_stars_rollups(session, rollups)
+
+
+    def get_repo_stats(self, repository_url: str) -> Optional[RepoStats]:
+        '''Get stars changes of the repo from the rollups'''
+        today = datetime.utcnow().date()
+        this_week = today - timedelta(days=today.weekday())
+
+        with session_factory() as session:
+            repo = session.query(Repo).filter(Repo.url == repository_url).one_or_none()
+            if repo is None:
+                return None
+
+            rollups = session.query(RepoStarsRollup)\
+                .filter(RepoStarsRollup.repo_id == repo.id,
+                        ((RepoStarsRollup.period == 'day')
+                         & (RepoStarsRollup.period_start > today - timedelta(days=7)))
+                        | ((RepoStarsRollup.period == 'week')
+                           & (RepoStarsRollup.period_start > this_week - timedelta(weeks=4))))\
+                .all()
+
+        def sum_changes(period: str, since: date) -> StarsChanges:
+            period_rollups = [rollup for rollup in rollups
+                              if rollup.period == period and rollup.period_start >= since]
+            return StarsChanges(added=sum(rollup.added for rollup in period_rollups),
+                                removed=sum(rollup.removed for rollup in period_rollups))
+
+        return RepoStats(today=sum_changes('day', today),
+                         last_7_days=sum_changes('day', today - timedelta(days=6)),
+                         last_4_weeks=sum_changes('week', this_week - timedelta(weeks=3)))
+
+
+    async def __update_repos_stars(self, repos: List[Repo]) -> Dict[int, UpdateRepoStarsResult]:
+        results = await asyncio.gather(*[self.__update_repo_stars(repo) for repo in repos],
+                                       return_exceptions=True)
+
+        repos_results = {}
+        for repo, result in zip(repos, results):
+            if isinstance(result, Exception):
+                self.logger.error('update of repo %s is failed', repo.id, exc_info=result)
+                continue
+
+            repos_results[repo.id] = result
+
+        return repos_results
+
+
+    async def __get_repo_stars_page(self, url: str, page_number: int) -> List[StarItem]:
         page_items = await self.get_repo_stargazers_page(
             url,
             page=page_number,
             size=self.page_size
         )
 
-        pages[page_number] = list(map(
-                                    StarItem.from_dict,
-                                    page_items
-                                ))
+        return list(map(
+                        StarItem.from_dict,
+                        page_items
+                    ))
+
+
+    async def __iter_github_stars_pages(self,
+                                        url: str,
+                                        first_page: int,
+                                        last_page: int) -> AsyncIterator[List[StarItem]]:
+        '''Yield pages in order. Only the window of pages is fetched at the same time,
+        so the memory doesn't depend on the stars count.'''
+        pending_pages = deque()
+        next_page = first_page
+        try:
+            while len(pending_pages) > 0 or next_page <= last_page:
+                while next_page <= last_page and len(pending_pages) < self.pages_window:
+                    pending_pages.append(asyncio.ensure_future(
+                        self.__get_repo_stars_page(url, next_page)))
+                    next_page += 1
+
+                yield await pending_pages.popleft()
+        finally:
+            for pending_page in pending_pages:
+                pending_page.cancel()
+
+
+    async def __get_github_stars_pages(self,
+                                       url: str,
+                                       first_page: int,
+                                       last_page: int) -> List[StarItem]:
+        github_stars = []
+        async for page in self.__iter_github_stars_pages(url, first_page, last_page):
+            github_stars.extend(page)
+
+        return github_stars
+
+
+    async def __write_github_stars_pages(self,
+                                         url: str,
+                                         last_page: int,
+                                         redis_key: str,
+                                         buckets_count: int) -> Optional[datetime]:
+        '''Write stars of all pages to the redis buckets. Returns the last starred_at'''
+        last_starred_at = None
+
+        self.redis_connection.delete(*self.__get_stars_bucket_keys(redis_key, buckets_count))
+        async for page in self.__iter_github_stars_pages(url, 1, last_page):
+            if len(page) == 0:
+                continue
+
+            with REDIS_OPERATION_SECONDS.labels(operation='write_staging').time():
+                with self.redis_connection.pipeline(transaction=False) as pipe:
+                    self.__write_stars_buckets(pipe, redis_key, page, buckets_count)
+                    pipe.execute()
+
+            page_last_starred_at = max(star.starred_at for star in page)
+            if last_starred_at is None or page_last_starred_at > last_starred_at:
+                last_starred_at = page_last_starred_at
 
+        return last_starred_at
 
-    async def __get_all_github_starts(self, repo: Repo) -> List[StarItem]:
+
+    def __is_incremental_sync_possible(self,
+                                       watermark: Optional[StarsWatermark],
+                                       repo_stars_count: int) -> bool:
+        if watermark is None or watermark.count == 0 or watermark.starred_at is None:
+            return False
+
+        # Removed stars are visible only for the full sync
+        if repo_stars_count < watermark.count:
+            return False
+
+        seconds_from_full_sync = (datetime.utcnow() - watermark.full_sync_time).total_seconds()
+        return seconds_from_full_sync < self.full_sync_seconds
+
+
+    async def __get_github_stars(self,
+                                 repo: Repo,
+                                 repo_stars_count: int,
+                                 watermark: Optional[StarsWatermark],
+                                 staging_redis_key: str) -> GithubStarsResult:
+        '''Get the new stars or write all the stars to the staging redis buckets
+        when the full sync is needed'''
         api_urls_repo_result = get_api_repo_url_from_repo_url(repo.url)
-        repo_stars_count = await self.get_repo_stars_count(api_urls_repo_result.api_repo_url)
         pages_number = math.ceil(repo_stars_count / self.page_size)
+        tail_pages_fetched = 0
+
+        if self.__is_incremental_sync_possible(watermark, repo_stars_count):
+            # Equal adds and removes keep the count, they are caught by the next full sync
+            if repo_stars_count == watermark.count:
+                self.logger.debug('stars count of repo %s is not changed', repo.id)
+                return GithubStarsResult(count=repo_stars_count,
+                                         stars=[],
+                                         full_sync=False)
+
+            if self.get_repo_stargazers_since is not None:
+                new_stars = await self.get_repo_stargazers_since(
+                    api_urls_repo_result.api_repo_stars_url,
+                    watermark.starred_at)
+
+                return GithubStarsResult(count=repo_stars_count,
+                                         stars=list(map(StarItem.from_dict, new_stars)),
+                                         full_sync=False)
+
+            # Github returns stargazers ordered by starred_at, so the new ones are in the tail.
+            # Start from the page which holds the last known stargazer.
+            first_page = (watermark.count - 1) // self.page_size + 1
+            tail_stars = await self.__get_github_stars_pages(
+                api_urls_repo_result.api_repo_stars_url,
+                first_page,
+                pages_number)
+
+            # If the first item of the tail is new then some stars were removed and
+            # the new ones could be shifted to the previous pages.
+            if len(tail_stars) > 0 and tail_stars[0].starred_at <= watermark.starred_at:
+                new_stars = [star for star in tail_stars
+                             if star.starred_at > watermark.starred_at]
+
+                return GithubStarsResult(count=repo_stars_count,
+                                         stars=new_stars,
+                                         full_sync=False,
+                                         pages_fetched=pages_number - first_page + 1)
+
+            tail_pages_fetched = pages_number - first_page + 1
+            self.logger.debug('the stars tail of repo %s is shifted, run the full sync', repo.id)
+
+        last_starred_at = await self.__write_github_stars_pages(
+            api_urls_repo_result.api_repo_stars_url,
+            pages_number,
+            staging_redis_key,
+            get_stars_buckets_count(repo_stars_count))
+
+        return GithubStarsResult(count=repo_stars_count,
+                                 stars=[],
+                                 full_sync=True,
+                                 pages_fetched=tail_pages_fetched + pages_number,
+                                 last_starred_at=last_starred_at)
+
+
+    async def __get_large_repo_stars(self,
+                                     repo: Repo,
+                                     repo_stars_count: int,
+                                     watermark: Optional[StarsWatermark],
+                                     newest_redis_key: str
+                                     ) -> Tuple[GithubStarsResult, Optional[List[str]]]:
+        '''Get the newest stars of the large repo and add them to the bounded redis window.
+        Github doesn't list stargazers past the fixed page depth, so the full sync is impossible.
+        Returns the stars and the added logins. The added logins are None when they can't be
+        known, then the changes are known only by count.'''
+        # Only the graphql api lists the newest stargazers first
+        if self.get_repo_stargazers_since is None:
+            self.logger.warning('repo %s is tracked only by the stars count, '
+                                'set GITHUB_API_BACKEND=graphql to get the new stargazers',
+                                repo.id)
+            return GithubStarsResult(count=repo_stars_count, stars=[], full_sync=False), None
+
+        since = watermark.starred_at if watermark is not None and watermark.approximate else None
+        api_urls_repo_result = get_api_repo_url_from_repo_url(repo.url)
+        new_stars = await self.get_repo_stargazers_since(
+            api_urls_repo_result.api_repo_stars_url,
+            since,
+            limit=settings.LARGE_REPO_WINDOW)
+        stars = list(map(StarItem.from_dict, new_stars))
+
+        added_stars = []
+        if len(stars) > 0:
+            scored_logins = []
+            for star in stars:
+                scored_logins.extend([star.starred_at.timestamp(), star.login])
+
+            with REDIS_OPERATION_SECONDS.labels(operation='add_newest_stars').time():
+                added_stars = self.__add_newest_stars_script(
+                    keys=[newest_redis_key],
+                    args=[settings.LARGE_REPO_WINDOW, *scored_logins])
+
+        github_stars_result = GithubStarsResult(count=repo_stars_count,
+                                                stars=stars,
+                                                full_sync=False,
+                                                pages_fetched=math.ceil(len(stars)
+                                                                        / self.page_size))
+
+        # Without the known newest stargazer the whole window is new, it's only filled
+        return github_stars_result, added_stars if since is not None else None
+
+
+    @staticmethod
+    def __get_stars_redis_key(repo_id: int) -> str:
+        return 'stars_repo_' + str(repo_id)
+
+
+    @staticmethod
+    def __get_stars_bucket_keys(redis_key: str, buckets_count: int) -> List[str]:
+        return [f'{redis_key}_bucket_{bucket}' for bucket in range(buckets_count)]
+
+
+    def __get_stars_buckets_count(self, repo_id: int) -> int:
+        '''Get the number of the stored stars buckets, it's kept by the watermark'''
+        buckets_count = self.redis_connection.hget(self.__get_watermark_redis_key(repo_id),
+                                                   'buckets')
+        return int(buckets_count) if buckets_count is not None else 1
+
+
+    @staticmethod
+    def __write_stars_buckets(pipe, redis_key: str, stars: List[StarItem], buckets_count: int):
+        buckets = {}
+        for star in stars:
+            bucket = get_stars_bucket(star.login, buckets_count)
+            buckets.setdefault(bucket, {})[star.login] = star.get_stored_starred_at()
 
-        pages = {}
-        awaitables = []
-        for page_number in range(1, pages_number + 1):
-            awaitables.append(
-                self.__put_repo_stars_page(
-                    pages,
-                    page_number,
-                    api_urls_repo_result.api_repo_stars_url))
+        for bucket, bucket_stars in buckets.items():
+            pipe.hset(f'{redis_key}_bucket_{bucket}', mapping=bucket_stars)
 
-        await asyncio.gather(*awaitables)
 
-        github_stars = []
-        for page_number in range(1, pages_number + 1):
-            for page_item in pages[page_number]:
-                github_stars.append(page_item)
+    def __migrate_legacy_stars(self, repo_id: int) -> bool:
+        '''Convert the stars stored as the list of json items or the set of logins
+        to the stars buckets'''
+        repo_redis_key = self.__get_stars_redis_key(repo_id)
+        redis_type = self.redis_connection.type(repo_redis_key)
+        if redis_type == b'list':
+            stars = [StarItem.from_json(item)
+                     for item in self.redis_connection.lrange(repo_redis_key, 0, -1)]
+        elif redis_type == b'set':
+            stars = [StarItem(login.decode(), None)
+                     for login in self.redis_connection.smembers(repo_redis_key)]
+        else:
+            return False
 
-        return github_stars
+        buckets_count = get_stars_buckets_count(len(stars))
+        with self.redis_connection.pipeline() as pipe:
+            pipe.delete(repo_redis_key)
+            self.__write_stars_buckets(pipe, repo_redis_key, stars, buckets_count)
+            pipe.hset(self.__get_watermark_redis_key(repo_id), 'buckets', buckets_count)
+            pipe.execute()
 
+        return True
 
-    def __update_repo_stars(self, repo: Repo, session: sessionmaker) -> UpdateRepoStarsResult:
-        is_repo_initiated = repo.last_updated_time is not None
 
-        users = [u.teleg_user_id for u in repo.users]
+    def migrate_legacy_stars(self) -> int:
+        '''Convert stars of all repos from the legacy list and set formats.
+        Returns the number of converted repos.'''
+        migrated = 0
+        for redis_type in ('list', 'set'):
+            for repo_redis_key in self.redis_connection.scan_iter(match='stars_repo_*',
+                                                                  _type=redis_type):
+                repo_id = repo_redis_key.decode()[len('stars_repo_'):]
+                # The staging sets are left by the interrupted syncs, they are dropped
+                if not repo_id.isdigit():
+                    self.redis_connection.delete(repo_redis_key)
+                    continue
 
-        last_updated_time = repo.last_updated_time.isoformat() if is_repo_initiated else 'None'
-        self.logger.debug('repo last update time: %s', last_updated_time)
+                if self.__migrate_legacy_stars(int(repo_id)):
+                    migrated += 1
+
+        return migrated
+
+
+    @staticmethod
+    def __run_github_requests(awaitable):
+        # The event loop lives as long as the process, so the pooled github session is reused
+        return worker_resources.run_until_complete(awaitable)
+
+
+    def get_last_stars_counts(self, repo_ids: List[int]) -> List[Optional[int]]:
+        '''Get stars counts of repos by the last sync. None for never synced repos.'''
+        with self.redis_connection.pipeline(transaction=False) as pipe:
+            for repo_id in repo_ids:
+                pipe.hget(self.__get_watermark_redis_key(repo_id), 'count')
+            counts = pipe.execute()
+
+        return [int(count) if count is not None else None for count in counts]
+
+
+    def __get_stars_watermark(self, repo_id: int) -> Optional[StarsWatermark]:
+        watermark = self.redis_connection.hgetall(self.__get_watermark_redis_key(repo_id))
+        # The watermark of the migrated legacy stars holds only the number of buckets
+        if b'count' not in watermark:
+            return None
+
+        starred_at = watermark[b'starred_at'].decode()
+        starred_at = datetime.fromisoformat(starred_at) if starred_at else None
+        # The legacy watermarks keep the naive minimal time when no stargazer is known
+        if starred_at is not None and starred_at.tzinfo is None:
+            starred_at = None
 
-        if is_repo_initiated\
-            and (datetime.utcnow() - repo.last_updated_time).total_seconds() \
-                < settings.SECONDS_UPDATE:
+        return StarsWatermark(
+            count=int(watermark[b'count']),
+            starred_at=starred_at,
+            full_sync_time=datetime.fromisoformat(watermark[b'full_sync_time'].decode()),
+            approximate=watermark.get(b'approximate') == b'1')
 
-            return UpdateRepoStarsResult(initiated=is_repo_initiated,
-                                         removed_stars=[],
-                                         added_stars=[],
-                                         teleg_subscribed_users=users)
 
-        stars_from_github = asyncio.run(self.__get_all_github_starts(repo))
+    def __set_stars_watermark(self, repo_id: int, watermark: StarsWatermark):
+        self.redis_connection.hset(self.__get_watermark_redis_key(repo_id), mapping={
+            'count': watermark.count,
+            'starred_at': watermark.starred_at.isoformat() if watermark.starred_at else '',
+            'full_sync_time': watermark.full_sync_time.isoformat(),
+            'approximate': int(watermark.approximate)
+        })
 
-        repo_redis_key = 'stars_repo_' + str(repo.id)
-        stars_from_db = list(map(
-                                    StarItem.from_json,
-                                    self.redis_connection.lrange(repo_redis_key, 0, -1)
-                                ))
 
-        stars_from_db_set = set(map(lambda x: x.login, stars_from_db))
-        stars_from_github_set = set(map(lambda x: x.login, stars_from_github))
+    @staticmethod
+    def __is_approximate(watermark: Optional[StarsWatermark], repo_stars_count: int) -> bool:
+        if watermark is not None and watermark.approximate:
+            return repo_stars_count >= settings.LARGE_REPO_STARS * settings.LARGE_REPO_EXIT_RATIO
 
-        self.logger.debug('stars from db: %s', stars_from_db_set)
-        self.logger.debug('stars from github: %s', stars_from_github_set)
+        return repo_stars_count >= settings.LARGE_REPO_STARS
+
+
+    @staticmethod
+    def __get_watermark_redis_key(repo_id: int) -> str:
+        return 'stars_watermark_repo_' + str(repo_id)
+
+
+    async def __update_repo_stars(self, repo: Repo) -> UpdateRepoStarsResult:
+        is_repo_initiated = repo.last_updated_time is not None
+
+        users = [u.teleg_user_id for u in repo.users]
+
+        last_updated_time = repo.last_updated_time.isoformat() if is_repo_initiated else 'None'
+        self.logger.debug('repo last update time: %s', last_updated_time)
+
+        repo_redis_key = self.__get_stars_redis_key(repo.id)
+        staging_redis_key = repo_redis_key + '_staging'
+        newest_redis_key = repo_redis_key + '_newest'
+        self.__migrate_legacy_stars(repo.id)
+
+        watermark = self.__get_stars_watermark(repo.id)
+        stored_buckets_count = self.__get_stars_buckets_count(repo.id)
+        api_urls_repo_result = get_api_repo_url_from_repo_url(repo.url)
+        repo_stars_count = await self.get_repo_stars_count(api_urls_repo_result.api_repo_url)
 
-        added_stars = list(stars_from_github_set.difference(stars_from_db_set))
-        removed_stars = list(stars_from_db_set.difference(stars_from_github_set))
+        approximate = self.__is_approximate(watermark, repo_stars_count)
+        # The stored stars are replaced when the repo switches the mode, so the first sync
+        # in the new mode is the baseline without changes
+        is_mode_switched = watermark is not None and watermark.approximate != approximate
+        removed_stars_count = 0
+        added_stars_count = 0
+
+        if approximate:
+            if is_mode_switched:
+                self.redis_connection.delete(
+                    *self.__get_stars_bucket_keys(repo_redis_key, stored_buckets_count))
+
+            github_stars_result, added_stars = await self.__get_large_repo_stars(
+                repo,
+                repo_stars_count,
+                watermark,
+                newest_redis_key)
+            removed_stars = []
+
+            if watermark is None or is_mode_switched:
+                # The first sync in the mode only fills the window
+                added_stars = []
+            elif added_stars is None:
+                added_stars = []
+                added_stars_count = max(0, repo_stars_count - watermark.count)
+                removed_stars_count = max(0, watermark.count - repo_stars_count)
+            else:
+                # The window holds only the newest stars, so removed ones are known by count
+                removed_stars_count = max(0, watermark.count + len(added_stars) - repo_stars_count)
+        else:
+            if is_mode_switched:
+                self.redis_connection.delete(newest_redis_key)
+                watermark = None
+
+            try:
+                github_stars_result = await self.__get_github_stars(repo,
+                                                                    repo_stars_count,
+                                                                    watermark,
+                                                                    staging_redis_key)
+            finally:
+                # The page cursors must not outlive one walk of the pages
+                self.github_client.forget_repo_pages(api_urls_repo_result.api_repo_stars_url)
+
+            if github_stars_result.full_sync:
+                staging_buckets_count = get_stars_buckets_count(github_stars_result.count)
+                buckets_count = max(stored_buckets_count, staging_buckets_count)
+                with REDIS_OPERATION_SECONDS.labels(operation='swap_stars').time():
+                    added_stars, removed_stars = self.__swap_stars_script(
+                        keys=[self.__get_watermark_redis_key(repo.id),
+                              *self.__get_stars_bucket_keys(repo_redis_key, buckets_count),
+                              *self.__get_stars_bucket_keys(staging_redis_key,
+                                                            staging_buckets_count)],
+                        args=[stored_buckets_count,
+                              staging_buckets_count,
+                              int(is_repo_initiated and not is_mode_switched)])
+            else:
+                added_stars = []
+                removed_stars = []
+                if len(github_stars_result.stars) > 0:
+                    # The buckets are overfilled till the next full sync rebuckets the stars
+                    keys = []
+                    args = []
+                    for star in github_stars_result.stars:
+                        bucket = get_stars_bucket(star.login, stored_buckets_count)
+                        keys.append(f'{repo_redis_key}_bucket_{bucket}')
+                        args.extend([star.login, star.get_stored_starred_at()])
+
+                    with REDIS_OPERATION_SECONDS.labels(operation='add_stars').time():
+                        added_stars = self.__add_stars_script(keys=keys, args=args)
+
+        stars_from_github = github_stars_result.stars
+        added_stars = [login.decode() for login in added_stars]
+        removed_stars = [login.decode() for login in removed_stars]
+
+        if is_mode_switched:
+            self.logger.info('repo %s is switched to the %s mode', repo.id,
+                             'approximate' if approximate else 'exact')
+            added_stars = []
+            removed_stars = []
+
+        self.logger.debug('added stars: %s', added_stars)
+        self.logger.debug('removed stars: %s', removed_stars)
+
+        REPO_PAGES_FETCHED.observe(github_stars_result.pages_fetched)
+        REPO_DIFF_SIZE.labels(kind='added').observe(len(added_stars) + added_stars_count)
+        REPO_DIFF_SIZE.labels(kind='removed').observe(len(removed_stars) + removed_stars_count)
 
         repo.last_updated_time = datetime.utcnow()
-        session.commit()
 
-        self.redis_connection.delete(repo_redis_key)
-        self.redis_connection.lpush(repo_redis_key, *list(map(StarItem.to_json, stars_from_github)))
+        self.poll_scheduler.schedule(repo.id,
+                                     stars_changed=len(added_stars) > 0
+                                                   or len(removed_stars) > 0
+                                                   or removed_stars_count > 0
+                                                   or added_stars_count > 0)
+
+        self.__set_stars_watermark(repo.id, StarsWatermark(
+            count=github_stars_result.count,
+            starred_at=github_stars_result.last_starred_at \
+                       or max([star.starred_at for star in stars_from_github],
+                              default=watermark.starred_at if watermark else None),
+            full_sync_time=repo.last_updated_time \
+                           if github_stars_result.full_sync or watermark is None \
+                           else watermark.full_sync_time,
+            approximate=approximate))
 
         return UpdateRepoStarsResult(initiated=is_repo_initiated,
                                      removed_stars=removed_stars,
                                      added_stars=added_stars,
-                                     teleg_subscribed_users=users)
+                                     teleg_subscribed_users=users,
+                                     repo_url=repo.url,
+                                     approximate=approximate,
+                                     removed_stars_count=removed_stars_count,
+                                     added_stars_count=added_stars_count)
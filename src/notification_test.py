@@ -1,11 +1,58 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from functools import reduce
+from typing import Dict, List, Optional, Set
+import json
 import unittest
+from unittest import mock
 from notification import Notification, SubscribeResult, UnsubscribeResut
-from models import Repo, User, session_factory, engine
+from models import Repo, RepoStarsRollup, StarEvent, User, session_factory, engine
+from testing import use_test_redis_db
+
+
+class FakeStargazers:
+    '''Stargazers of the repo served like github does, ordered by starred_at'''
+
+    def __init__(self, logins: List[str]) -> None:
+        self.stars = []
+        self.pages_requested = []
+        self.add(logins)
+
+
+    def add(self, logins: List[str]):
+        '''Star the repo by the logins'''
+        for login in logins:
+            starred_at = datetime(2022, 1, 1, tzinfo=timezone.utc) + timedelta(days=len(self.stars))
+            if len(self.stars) > 0:
+                starred_at = max(starred_at, self.stars[-1]['starred_at'] + timedelta(days=1))
+            self.stars.append({'login': login, 'starred_at': starred_at})
+
+
+    def remove(self, logins: List[str]):
+        '''Unstar the repo by the logins'''
+        self.stars = [star for star in self.stars if star['login'] not in logins]
+
+
+    async def get_repo_stars_count(self, repo_url: str) -> int:
+        return len(self.stars)
+
+
+    async def get_repo_stargazers_page(self, repo_url: str, page: int, size: int) -> List[Dict]:
+        self.pages_requested.append(page)
+        return self.stars[(page - 1) * size:page * size]
+
+
+    async def get_repo_stargazers_since(self,
+                                        repo_url: str,
+                                        since: Optional[datetime],
+                                        limit: Optional[int] = None) -> List[Dict]:
+        stars = [star for star in self.stars if since is None or star['starred_at'] > since]
+        return stars[-limit:] if limit is not None else stars
 
 
 class NotificationTestCase(unittest.TestCase):
+    def setUp(self):
+        use_test_redis_db()
+
     def tearDown(self):
         '''Setup'''
 
@@ -13,11 +60,54 @@ class NotificationTestCase(unittest.TestCase):
             con.execute('DELETE FROM user_repo_association',)
 
         with session_factory() as session:
+            session.query(StarEvent).delete()
+            session.query(RepoStarsRollup).delete()
             session.query(Repo).delete()
             session.query(User).delete()
 
             session.commit()
 
+        # Repo ids are reused by sqlite, so the stored stars must not leak between tests
+        Notification().redis_connection.flushdb()
+
+
+    @staticmethod
+    def subscribe_repo(notification: Notification, url: str, teleg_user_id: int = 1) -> int:
+        '''Subscribe the user to the repo and get the repo id'''
+        notification.subscribe(teleg_user_id, url)
+        with session_factory() as session:
+            return session.query(Repo).filter_by(url=url).one().id
+
+
+    @staticmethod
+    def mark_updated(repo_id: int):
+        '''Set the last update time like the repo was polled before'''
+        with session_factory() as session:
+            repo = session.query(Repo).filter_by(id=repo_id).one()
+            repo.last_updated_time = datetime(2022, 1, 1)
+            session.commit()
+
+
+    @staticmethod
+    def get_stored_logins(notification: Notification, repo_id: int) -> Set[str]:
+        '''Get logins of all stored stars buckets of the repo'''
+        redis_connection = notification.redis_connection
+        return {login.decode()
+                for bucket_key in redis_connection.scan_iter(f'stars_repo_{repo_id}_bucket_*')
+                for login in redis_connection.hkeys(bucket_key)}
+
+
+    @staticmethod
+    def create_notification(stargazers: FakeStargazers, graphql: bool = True, **kwargs):
+        '''Create the notification with the fake github. Only the graphql api lists
+        the newest stargazers.'''
+        return Notification(
+            get_repo_stars_count=stargazers.get_repo_stars_count,
+            get_repo_stargazers_page=stargazers.get_repo_stargazers_page,
+            get_repo_stargazers_since=stargazers.get_repo_stargazers_since if graphql else None,
+            page_size=2,
+            **kwargs)
+
 
     def test_subscribe_repo(self):
         '''Test subscribe'''
@@ -160,8 +250,14 @@ class NotificationTestCase(unittest.TestCase):
 
         count = len(reduce(list.__add__, stars_pages))
 
-        notification = Notification(get_repo_stars_count=lambda _: count,
-                                    get_repo_stargazers_page=lambda repo_url, page, size: stars_pages[page-1],
+        async def get_repo_stars_count(arg):
+            return count
+
+        async def get_repo_stargazers_page(repo_url, page, size):
+            return stars_pages[page - 1]
+
+        notification = Notification(get_repo_stars_count=get_repo_stars_count,
+                                    get_repo_stargazers_page=get_repo_stargazers_page,
                                     page_size=len(stars_pages[0]))
 
         # Act
@@ -226,9 +322,11 @@ class NotificationTestCase(unittest.TestCase):
         async def get_repo_stargazers_page(repo_url, page, size):
             return stars_pages[page - 1]
 
+        # The stars count is not changed, so only the full sync finds the replaced star
         notification = Notification(get_repo_stars_count=get_repo_stars_count,
                                     get_repo_stargazers_page=get_repo_stargazers_page,
-                                    page_size=len(stars_pages[0]))
+                                    page_size=len(stars_pages[0]),
+                                    full_sync_seconds=0)
 
         # Act
         url = 'https://github.com/alexpantyukhin/aiohttp-session-mongo'
@@ -261,3 +359,512 @@ class NotificationTestCase(unittest.TestCase):
         assert result.added_stars[0] == 'login10'
         assert len(result.removed_stars) == 1
         assert result.removed_stars[0] == 'login5'
+
+
+    def test_update_repo_stars_first_sync_stores_stars_without_diff(self):
+        '''Test the first sync of the repo only stores its stars'''
+
+        # Arrange
+        stargazers = FakeStargazers([f'login{index}' for index in range(3)])
+        notification = self.create_notification(stargazers)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/small/repo')
+
+        # Act
+        result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert result.initiated is False
+        assert result.added_stars == []
+        assert result.removed_stars == []
+        assert self.get_stored_logins(notification, repo_id) == {'login0', 'login1', 'login2'}
+
+
+    @mock.patch('settings.STARS_BUCKET_SIZE', 2)
+    def test_update_repo_stars_when_buckets_count_changed(self):
+        '''Test the full sync finds changes when the grown repo is rebucketed'''
+
+        # Arrange
+        stargazers = FakeStargazers([f'login{index}' for index in range(3)])
+        notification = self.create_notification(stargazers, graphql=False, full_sync_seconds=0)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/small/repo')
+        notification.update_repo_stars(repo_id)
+
+        stargazers.remove(['login0'])
+        stargazers.add(['new1', 'new2', 'new3', 'new4', 'new5'])
+
+        # Act
+        result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert set(result.added_stars) == {'new1', 'new2', 'new3', 'new4', 'new5'}
+        assert result.removed_stars == ['login0']
+        assert self.get_stored_logins(notification, repo_id) \
+            == {'login1', 'login2', 'new1', 'new2', 'new3', 'new4', 'new5'}
+        assert len(list(notification.redis_connection.scan_iter(
+            f'stars_repo_{repo_id}_bucket_*'))) <= 4
+
+
+    def test_update_repo_stars_migrates_legacy_logins_set(self):
+        '''Test the stars stored as the set of logins are moved to the buckets'''
+
+        # Arrange
+        stargazers = FakeStargazers(['login0', 'login1'])
+        notification = self.create_notification(stargazers, full_sync_seconds=0)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/small/repo')
+        notification.redis_connection.sadd(f'stars_repo_{repo_id}', 'login0', 'gone')
+        self.mark_updated(repo_id)
+
+        # Act
+        result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert result.added_stars == ['login1']
+        assert result.removed_stars == ['gone']
+        assert notification.redis_connection.exists(f'stars_repo_{repo_id}') == 0
+        assert self.get_stored_logins(notification, repo_id) == {'login0', 'login1'}
+
+
+    @mock.patch('settings.LARGE_REPO_STARS', 5)
+    @mock.patch('settings.LARGE_REPO_WINDOW', 3)
+    def test_update_large_repo_stars_fills_window(self):
+        '''Test the first sync of the large repo keeps only the newest stars'''
+
+        # Arrange
+        stargazers = FakeStargazers([f'login{index}' for index in range(6)])
+        notification = self.create_notification(stargazers)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/large/repo')
+
+        # Act
+        result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert result.initiated is False
+        assert result.approximate is True
+        assert result.added_stars == []
+        assert result.removed_stars_count == 0
+
+        redis_connection = notification.redis_connection
+        assert redis_connection.zrange(f'stars_repo_{repo_id}_newest', 0, -1) \
+            == [b'login3', b'login4', b'login5']
+        assert self.get_stored_logins(notification, repo_id) == set()
+
+
+    @mock.patch('settings.LARGE_REPO_STARS', 5)
+    @mock.patch('settings.LARGE_REPO_WINDOW', 3)
+    def test_update_large_repo_stars_when_stars_added(self):
+        '''Test the new stars of the large repo are found by the newest stargazers'''
+
+        # Arrange
+        stargazers = FakeStargazers([f'login{index}' for index in range(6)])
+        notification = self.create_notification(stargazers)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/large/repo')
+        notification.update_repo_stars(repo_id)
+
+        stargazers.add(['new1', 'new2'])
+
+        # Act
+        result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert result.initiated is True
+        assert result.approximate is True
+        assert result.added_stars == ['new1', 'new2']
+        assert result.removed_stars_count == 0
+        assert result.need_to_handle()
+        assert notification.redis_connection.zrange(f'stars_repo_{repo_id}_newest', 0, -1) \
+            == [b'login5', b'new1', b'new2']
+
+
+    @mock.patch('settings.LARGE_REPO_STARS', 5)
+    @mock.patch('settings.LARGE_REPO_WINDOW', 3)
+    def test_update_large_repo_stars_when_stars_removed(self):
+        '''Test the removed stars of the large repo are derived from the count'''
+
+        # Arrange
+        stargazers = FakeStargazers([f'login{index}' for index in range(7)])
+        notification = self.create_notification(stargazers)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/large/repo')
+        notification.update_repo_stars(repo_id)
+
+        stargazers.remove(['login0', 'login1'])
+        stargazers.add(['new1'])
+
+        # Act
+        result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert result.added_stars == ['new1']
+        assert result.removed_stars == []
+        assert result.removed_stars_count == 2
+
+
+    @mock.patch('settings.LARGE_REPO_STARS', 5)
+    @mock.patch('settings.LARGE_REPO_WINDOW', 3)
+    def test_update_large_repo_stars_by_count_without_graphql(self):
+        '''Test the large repo changes are reported by count when the newest
+        stargazers can't be listed'''
+
+        # Arrange
+        stargazers = FakeStargazers([f'login{index}' for index in range(6)])
+        notification = self.create_notification(stargazers, graphql=False)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/large/repo')
+        notification.update_repo_stars(repo_id)
+
+        # Act
+        stargazers.add(['new1', 'new2'])
+        added_result = notification.update_repo_stars(repo_id)
+
+        stargazers.remove(['login0', 'login1', 'login2'])
+        removed_result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert added_result.approximate is True
+        assert added_result.added_stars_count == 2
+        assert added_result.removed_stars_count == 0
+        assert added_result.need_to_handle()
+
+        assert removed_result.added_stars_count == 0
+        assert removed_result.removed_stars_count == 3
+        assert removed_result.need_to_handle()
+
+
+    @mock.patch('settings.LARGE_REPO_STARS', 5)
+    @mock.patch('settings.LARGE_REPO_WINDOW', 3)
+    def test_update_large_repo_stars_after_rest_backend(self):
+        '''Test the window is filled without changes when the backend is switched
+        to graphql after the count only tracking'''
+
+        # Arrange
+        stargazers = FakeStargazers([f'login{index}' for index in range(6)])
+        url = 'https://github.com/large/repo'
+        repo_id = self.subscribe_repo(self.create_notification(stargazers, graphql=False), url)
+        self.create_notification(stargazers, graphql=False).update_repo_stars(repo_id)
+
+        notification = self.create_notification(stargazers)
+
+        # Act
+        fill_result = notification.update_repo_stars(repo_id)
+        stargazers.add(['new1'])
+        added_result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert fill_result.added_stars == []
+        assert fill_result.need_to_handle() is False
+        assert added_result.added_stars == ['new1']
+
+
+    @mock.patch('settings.LARGE_REPO_STARS', 5)
+    @mock.patch('settings.LARGE_REPO_WINDOW', 3)
+    def test_update_repo_stars_when_mode_switched(self):
+        '''Test exact -> approximate -> exact switches rebuild the stored stars without changes'''
+
+        # Arrange
+        stargazers = FakeStargazers([f'login{index}' for index in range(4)])
+        notification = self.create_notification(stargazers)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/growing/repo')
+        redis_connection = notification.redis_connection
+        notification.update_repo_stars(repo_id)
+
+        # Act
+        stargazers.add(['new1', 'new2'])
+        approximate_result = notification.update_repo_stars(repo_id)
+        approximate_keys = (len(self.get_stored_logins(notification, repo_id)),
+                            redis_connection.exists(f'stars_repo_{repo_id}_newest'))
+
+        stargazers.remove(['login0', 'login1', 'login2'])
+        exact_result = notification.update_repo_stars(repo_id)
+
+        stargazers.add(['new3'])
+        added_result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert approximate_result.approximate is True
+        assert approximate_result.need_to_handle() is False
+        assert approximate_keys == (0, 1)
+
+        assert exact_result.approximate is False
+        assert exact_result.need_to_handle() is False
+        assert redis_connection.exists(f'stars_repo_{repo_id}_newest') == 0
+
+        assert added_result.added_stars == ['new3']
+        assert added_result.removed_stars == []
+        assert self.get_stored_logins(notification, repo_id) \
+            == {'login3', 'new1', 'new2', 'new3'}
+
+
+    @mock.patch('settings.LARGE_REPO_STARS', 10)
+    @mock.patch('settings.LARGE_REPO_EXIT_RATIO', 0.8)
+    @mock.patch('settings.LARGE_REPO_WINDOW', 3)
+    def test_update_large_repo_stars_when_count_oscillates(self):
+        '''Test the large repo around the threshold keeps the mode and reports its changes'''
+
+        # Arrange
+        stargazers = FakeStargazers([f'login{index}' for index in range(10)])
+        notification = self.create_notification(stargazers)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/large/repo')
+        notification.update_repo_stars(repo_id)
+
+        # Act
+        stargazers.remove(['login0'])
+        removed_result = notification.update_repo_stars(repo_id)
+
+        stargazers.add(['new1'])
+        added_result = notification.update_repo_stars(repo_id)
+
+        stargazers.remove(['login1', 'login2', 'login3'])
+        exact_result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert removed_result.approximate is True
+        assert removed_result.removed_stars_count == 1
+
+        assert added_result.approximate is True
+        assert added_result.added_stars == ['new1']
+
+        assert exact_result.approximate is False
+        assert exact_result.need_to_handle() is False
+
+
+    def test_update_repo_stars_fetches_only_tail(self):
+        '''Test the new stars are found by the pages from the last known stargazer'''
+
+        # Arrange
+        stargazers = FakeStargazers([f'login{index}' for index in range(5)])
+        notification = self.create_notification(stargazers, graphql=False)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/small/repo')
+        notification.update_repo_stars(repo_id)
+
+        stargazers.add(['new1', 'new2'])
+        stargazers.pages_requested = []
+
+        # Act
+        result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert stargazers.pages_requested == [3, 4]
+        assert result.added_stars == ['new1', 'new2']
+        assert result.removed_stars == []
+        assert self.get_stored_logins(notification, repo_id) \
+            == {'login0', 'login1', 'login2', 'login3', 'login4', 'new1', 'new2'}
+
+
+    def test_update_repo_stars_when_tail_shifted(self):
+        '''Test the full sync runs when removed stars shift the new ones out of the tail'''
+
+        # Arrange
+        stargazers = FakeStargazers([f'login{index}' for index in range(5)])
+        notification = self.create_notification(stargazers, graphql=False)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/small/repo')
+        notification.update_repo_stars(repo_id)
+
+        stargazers.remove(['login0'])
+        stargazers.add(['new1', 'new2', 'new3'])
+        stargazers.pages_requested = []
+
+        # Act
+        result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert stargazers.pages_requested[:2] == [3, 4]
+        assert sorted(stargazers.pages_requested[2:]) == [1, 2, 3, 4]
+        assert set(result.added_stars) == {'new1', 'new2', 'new3'}
+        assert result.removed_stars == ['login0']
+
+
+    def test_update_repo_stars_full_sync_after_count_drop(self):
+        '''Test the removed stars are found by the full sync when the count drops'''
+
+        # Arrange
+        stargazers = FakeStargazers([f'login{index}' for index in range(5)])
+        notification = self.create_notification(stargazers, graphql=False)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/small/repo')
+        notification.update_repo_stars(repo_id)
+
+        stargazers.remove(['login1', 'login3'])
+        stargazers.pages_requested = []
+
+        # Act
+        result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert sorted(stargazers.pages_requested) == [1, 2]
+        assert result.added_stars == []
+        assert set(result.removed_stars) == {'login1', 'login3'}
+        assert self.get_stored_logins(notification, repo_id) == {'login0', 'login2', 'login4'}
+
+
+    def test_update_repo_stars_migrates_legacy_list(self):
+        '''Test the stars stored as the list of json items are diffed after the migration'''
+
+        # Arrange
+        stargazers = FakeStargazers(['login0', 'login1'])
+        notification = self.create_notification(stargazers)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/small/repo')
+        notification.redis_connection.rpush(f'stars_repo_{repo_id}', *[
+            json.dumps({'login': login, 'starred_at': '2022-01-01T00:00:00+00:00'})
+            for login in ('login0', 'gone')
+        ])
+        self.mark_updated(repo_id)
+
+        # Act
+        result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert result.added_stars == ['login1']
+        assert result.removed_stars == ['gone']
+        assert notification.redis_connection.exists(f'stars_repo_{repo_id}') == 0
+        assert self.get_stored_logins(notification, repo_id) == {'login0', 'login1'}
+
+
+    def test_migrate_legacy_stars(self):
+        '''Test all legacy lists and sets are migrated and the legacy staging sets are dropped'''
+
+        # Arrange
+        notification = Notification()
+        redis_connection = notification.redis_connection
+        redis_connection.rpush('stars_repo_1', json.dumps(
+            {'login': 'login0', 'starred_at': '2022-01-01T00:00:00+00:00'}))
+        redis_connection.sadd('stars_repo_2', 'login1', 'login2')
+        redis_connection.sadd('stars_repo_2_staging', 'login1')
+
+        # Act
+        migrated = notification.migrate_legacy_stars()
+
+        # Assert
+        assert migrated == 2
+        assert self.get_stored_logins(notification, 1) == {'login0'}
+        assert self.get_stored_logins(notification, 2) == {'login1', 'login2'}
+        assert redis_connection.exists('stars_repo_1', 'stars_repo_2', 'stars_repo_2_staging') == 0
+
+
+    def test_update_repos_stars_isolates_failed_repo(self):
+        '''Test the batch is updated when one of its repos fails'''
+
+        # Arrange
+        stargazers = FakeStargazers(['login0'])
+        get_stars_count = stargazers.get_repo_stars_count
+
+        async def get_repo_stars_count(repo_url: str) -> int:
+            if 'broken' in repo_url:
+                raise RuntimeError('github is failed')
+
+            return await get_stars_count(repo_url)
+
+        stargazers.get_repo_stars_count = get_repo_stars_count
+        notification = self.create_notification(stargazers)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/small/repo')
+        broken_repo_id = self.subscribe_repo(notification, 'https://github.com/broken/repo')
+        notification.update_repo_stars(repo_id)
+
+        stargazers.add(['new1'])
+
+        # Act
+        results = notification.update_repos_stars([repo_id, broken_repo_id])
+
+        # Assert
+        assert list(results) == [repo_id]
+        assert results[repo_id].added_stars == ['new1']
+
+        with session_factory() as session:
+            assert session.query(Repo).filter_by(id=broken_repo_id).one().last_updated_time is None
+
+
+    def test_update_repos_stars_records_history(self):
+        '''Test star events and rollups are recorded and summed by the repo stats'''
+
+        # Arrange
+        url = 'https://github.com/small/repo'
+        stargazers = FakeStargazers(['login0', 'login1'])
+        notification = self.create_notification(stargazers, full_sync_seconds=0)
+        repo_id = self.subscribe_repo(notification, url)
+        notification.update_repo_stars(repo_id)
+
+        stargazers.remove(['login0'])
+        stargazers.add(['new1', 'new2'])
+
+        # Act
+        notification.update_repos_stars([repo_id])
+        stats = notification.get_repo_stats(url)
+
+        # Assert
+        with session_factory() as session:
+            events = {(event.login, event.starred)
+                      for event in session.query(StarEvent).filter_by(repo_id=repo_id)}
+            rollups = {(rollup.period, rollup.added, rollup.removed)
+                       for rollup in session.query(RepoStarsRollup).filter_by(repo_id=repo_id)}
+
+        assert events == {('new1', True), ('new2', True), ('login0', False)}
+        assert rollups == {('day', 2, 1), ('week', 2, 1)}
+        assert (stats.today.added, stats.today.removed) == (2, 1)
+        assert (stats.last_7_days.added, stats.last_7_days.removed) == (2, 1)
+        assert (stats.last_4_weeks.added, stats.last_4_weeks.removed) == (2, 1)
+        assert notification.get_repo_stats('https://github.com/missing/repo') is None
+
+
+    def test_iter_subscribed_repo_ids(self):
+        '''Test repos are iterated by batches and the orphan ones are skipped'''
+
+        # Arrange
+        notification = Notification()
+        first_repo_id = self.subscribe_repo(notification, 'https://github.com/first/repo')
+        second_repo_id = self.subscribe_repo(notification, 'https://github.com/second/repo')
+        orphan_repo_id = self.subscribe_repo(notification, 'https://github.com/orphan/repo')
+        notification.unsubscribe(1, 'https://github.com/orphan/repo')
+
+        # Act
+        subscribed_batches = list(notification.iter_subscribed_repo_ids(batch_size=1))
+        orphan_batches = list(notification.iter_orphan_repo_ids(batch_size=1))
+
+        # Assert
+        assert subscribed_batches == [[first_repo_id], [second_repo_id]]
+        assert orphan_batches == [[orphan_repo_id]]
+
+
+    def test_remove_orphan_repos(self):
+        '''Test only repos without subscribers are removed with their history and redis keys'''
+
+        # Arrange
+        stargazers = FakeStargazers(['login0'])
+        notification = self.create_notification(stargazers)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/small/repo')
+        orphan_repo_id = self.subscribe_repo(notification, 'https://github.com/orphan/repo')
+        notification.update_repos_stars([repo_id, orphan_repo_id])
+        notification.unsubscribe(1, 'https://github.com/orphan/repo')
+
+        with session_factory() as session:
+            session.add(StarEvent(repo_id=orphan_repo_id, login='login0', starred=True,
+                                  event_time=datetime(2022, 1, 1)))
+            session.commit()
+
+        # Act
+        removed = notification.remove_orphan_repos([repo_id, orphan_repo_id])
+
+        # Assert
+        assert removed == [orphan_repo_id]
+        with session_factory() as session:
+            assert session.query(Repo).filter_by(id=orphan_repo_id).one_or_none() is None
+            assert session.query(StarEvent).filter_by(repo_id=orphan_repo_id).count() == 0
+            assert session.query(Repo).filter_by(id=repo_id).one_or_none() is not None
+
+        redis_connection = notification.redis_connection
+        assert self.get_stored_logins(notification, orphan_repo_id) == set()
+        assert redis_connection.exists(f'stars_watermark_repo_{orphan_repo_id}') == 0
+        assert self.get_stored_logins(notification, repo_id) == {'login0'}
+
+
+    def test_update_repo_stars_schedules_next_poll(self):
+        '''Test the update right after the previous one polls the repo and schedules it'''
+
+        # Arrange
+        stargazers = FakeStargazers(['login0'])
+        notification = self.create_notification(stargazers)
+        repo_id = self.subscribe_repo(notification, 'https://github.com/small/repo')
+        notification.update_repo_stars(repo_id)
+        stargazers.add(['new1'])
+
+        # Act
+        result = notification.update_repo_stars(repo_id)
+
+        # Assert
+        assert result.added_stars == ['new1']
+        assert notification.poll_scheduler.get_due_repo_ids([repo_id]) == []
@@ -0,0 +1,26 @@
+'''The module with the durable outbox of telegram notifications'''
+from typing import List
+from redis_pool import get_redis_connection
+import settings
+
+
+OUTBOX_STREAM = 'notifications_outbox'
+OUTBOX_GROUP = 'telegram_senders'
+
+
+class NotificationOutbox:
+    '''The outbox of messages waiting for delivery by the telegram sender'''
+
+    def __init__(self, redis_connection=None) -> None:
+        self.redis_connection = redis_connection or get_redis_connection()
+
+
+    def put(self, teleg_user_ids: List[int], message: str):
+        '''Put the message for every user to the outbox'''
+        with self.redis_connection.pipeline(transaction=False) as pipe:
+            for teleg_user_id in teleg_user_ids:
+                pipe.xadd(OUTBOX_STREAM,
+                          {'user': teleg_user_id, 'message': message},
+                          maxlen=settings.OUTBOX_MAX_LENGTH,
+                          approximate=True)
+            pipe.execute()
@@ -0,0 +1,69 @@
+'''The module with the adaptive scheduler of repos polling'''
+from typing import List
+import random
+import time
+from redis_pool import get_redis_connection
+import settings
+
+
+NEXT_POLL_REDIS_KEY = 'repos_next_poll'
+POLL_INTERVAL_REDIS_KEY = 'repos_poll_interval'
+
+
+class PollScheduler:
+    '''Keeps the next poll time of every repo in the redis sorted set.
+    The poll interval is halved when stars are changed and doubled when they are not.
+    The next poll time is jittered within the share of the interval.'''
+
+    def __init__(self,
+                 redis_connection=None,
+                 min_seconds: int = None,
+                 max_seconds: int = None,
+                 jitter_ratio: float = None) -> None:
+        self.redis_connection = redis_connection or get_redis_connection()
+        self.min_seconds = min_seconds or settings.POLL_MIN_SECONDS
+        self.max_seconds = max_seconds or settings.POLL_MAX_SECONDS
+        self.jitter_ratio = settings.POLL_JITTER_RATIO if jitter_ratio is None else jitter_ratio
+
+
+    def get_due_repo_ids(self, repo_ids: List[int]) -> List[int]:
+        '''Filter repos which should be polled now. Never polled repos are due.'''
+        with self.redis_connection.pipeline(transaction=False) as pipe:
+            for repo_id in repo_ids:
+                pipe.zscore(NEXT_POLL_REDIS_KEY, repo_id)
+            next_poll_times = pipe.execute()
+
+        now = time.time()
+        return [repo_id for repo_id, next_poll_time in zip(repo_ids, next_poll_times)
+                if next_poll_time is None or next_poll_time <= now]
+
+
+    def schedule(self, repo_id: int, stars_changed: bool) -> float:
+        '''Schedule the next poll of the repo. Returns the new interval.'''
+        interval = self.redis_connection.hget(POLL_INTERVAL_REDIS_KEY, repo_id)
+        interval = float(interval) if interval is not None else self.min_seconds
+
+        if stars_changed:
+            interval = max(self.min_seconds, interval / 2)
+        else:
+            interval = min(self.max_seconds, interval * 2)
+
+        with self.redis_connection.pipeline() as pipe:
+            pipe.hset(POLL_INTERVAL_REDIS_KEY, repo_id, interval)
+            pipe.zadd(NEXT_POLL_REDIS_KEY, {
+                repo_id: time.time() + interval * (1 - random.uniform(0, self.jitter_ratio))
+            })
+            pipe.execute()
+
+        return interval
+
+
+    def remove(self, repo_ids: List[int]):
+        '''Forget the repos schedule'''
+        if len(repo_ids) == 0:
+            return
+
+        with self.redis_connection.pipeline() as pipe:
+            pipe.hdel(POLL_INTERVAL_REDIS_KEY, *repo_ids)
+            pipe.zrem(NEXT_POLL_REDIS_KEY, *repo_ids)
+            pipe.execute()
@@ -0,0 +1,77 @@
+import time
+import unittest
+from poll_scheduler import NEXT_POLL_REDIS_KEY, PollScheduler
+from redis_pool import get_redis_connection
+from testing import use_test_redis_db
+
+
+class PollSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        use_test_redis_db()
+        self.redis_connection = get_redis_connection()
+        self.redis_connection.flushdb()
+
+    def tearDown(self):
+        self.redis_connection.flushdb()
+
+    def test_schedule_doubles_interval_of_quiet_repo(self):
+        # Arrange
+        scheduler = PollScheduler(min_seconds=60, max_seconds=200, jitter_ratio=0)
+
+        # Act
+        intervals = [scheduler.schedule(1, stars_changed=False) for _ in range(3)]
+
+        # Assert
+        assert intervals == [120, 200, 200]
+
+    def test_schedule_halves_interval_when_stars_are_changed(self):
+        # Arrange
+        scheduler = PollScheduler(min_seconds=60, max_seconds=1000, jitter_ratio=0)
+        for _ in range(3):
+            scheduler.schedule(1, stars_changed=False)
+
+        # Act
+        intervals = [scheduler.schedule(1, stars_changed=True) for _ in range(4)]
+
+        # Assert
+        assert intervals == [240, 120, 60, 60]
+
+    def test_schedule_jitters_next_poll_time(self):
+        # Arrange
+        scheduler = PollScheduler(min_seconds=100, max_seconds=100, jitter_ratio=0.5)
+        now = time.time()
+
+        # Act
+        for repo_id in range(20):
+            scheduler.schedule(repo_id, stars_changed=False)
+
+        # Assert
+        next_poll_times = [next_poll_time for _, next_poll_time
+                           in self.redis_connection.zrange(NEXT_POLL_REDIS_KEY, 0, -1,
+                                                           withscores=True)]
+        assert all(now + 50 <= next_poll_time <= time.time() + 100
+                   for next_poll_time in next_poll_times)
+        assert len(set(next_poll_times)) > 1
+
+    def test_get_due_repo_ids(self):
+        # Arrange
+        scheduler = PollScheduler(jitter_ratio=0)
+        scheduler.schedule(1, stars_changed=False)
+        self.redis_connection.zadd(NEXT_POLL_REDIS_KEY, {2: time.time() - 1})
+
+        # Act
+        due_repo_ids = scheduler.get_due_repo_ids([1, 2, 3])
+
+        # Assert
+        assert due_repo_ids == [2, 3]
+
+    def test_remove(self):
+        # Arrange
+        scheduler = PollScheduler(jitter_ratio=0)
+        scheduler.schedule(1, stars_changed=False)
+
+        # Act
+        scheduler.remove([1])
+
+        # Assert
+        assert scheduler.get_due_repo_ids([1]) == [1]
@@ -0,0 +1,233 @@
+'''Opt-in sampling profiler of celery tasks and bot handlers.
+
+Profiles are written to PROFILING_DIR as collapsed stacks, one "frame;frame;frame count"
+line per stack, which is the input of flamegraph.pl and speedscope. Only the last
+PROFILING_MAX_FILES profiles younger than PROFILING_MAX_AGE_SECONDS are kept.
+
+    python profiling.py list
+    python profiling.py aggregate --name handle_repo --output handle_repo.collapsed
+'''
+import argparse
+import contextlib
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+import settings
+
+
+PROFILE_EXTENSION = '.collapsed'
+
+_profile_numbers = itertools.count()
+
+
+class SamplingProfiler:
+    '''Samples stacks of the profiled thread by the background thread and writes
+    the collapsed stacks on exit. With all_threads every thread is sampled, it's
+    used for the bot where the handler work is spread between the event loop and executors.'''
+
+    def __init__(self,
+                 name: str,
+                 interval_seconds: float = None,
+                 profiles_dir: str = None,
+                 all_threads: bool = False) -> None:
+        self.name = name
+        self.interval_seconds = interval_seconds or settings.PROFILING_INTERVAL_SECONDS
+        self.profiles_dir = profiles_dir or settings.PROFILING_DIR
+        self.all_threads = all_threads
+        self.stacks = Counter()
+        self.profile_path = None
+        self.__target_thread_id = None
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+
+    def start(self):
+        '''Start sampling of the current thread'''
+        self.__target_thread_id = threading.get_ident()
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+        self.__thread.start()
+
+
+    def stop(self) -> str:
+        '''Stop sampling and write the profile. Returns the profile path.'''
+        self.__stopped.set()
+        self.__thread.join()
+
+        os.makedirs(self.profiles_dir, exist_ok=True)
+        self.profile_path = os.path.join(
+            self.profiles_dir,
+            f'{time.strftime("%Y%m%d-%H%M%S")}-{self.name}-{os.getpid()}-{next(_profile_numbers)}'
+            f'{PROFILE_EXTENSION}')
+        with open(self.profile_path, 'w') as profile_file:
+            write_collapsed_stacks(profile_file, self.stacks)
+
+        prune_profiles(self.profiles_dir)
+        return self.profile_path
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+    def __sample(self):
+        profiler_thread_id = threading.get_ident()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        while not self.__stopped.wait(self.interval_seconds):
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            if not self.all_threads:
+                frames = {self.__target_thread_id: frames.get(self.__target_thread_id)}
+
+            for thread_id, frame in frames.items():
+                if frame is None or thread_id == profiler_thread_id:
+                    continue
+
+                stack = collapse_frame(frame)
+                if self.all_threads:
+                    thread_name = thread_names.get(thread_id)
+                    if thread_name is None:
+                        thread_names = {thread.ident: thread.name
+                                        for thread in threading.enumerate()}
+                        thread_name = thread_names.get(thread_id, str(thread_id))
+                    stack = f'{thread_name};{stack}'
+
+                self.stacks[stack] += 1
+
+
+def collapse_frame(frame) -> str:
+    '''Collapse the stack of the frame to the "outer;...;inner" line'''
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+
+def write_collapsed_stacks(profile_file, stacks: Dict[str, int]):
+    '''Write stacks with their counts'''
+    for stack, count in sorted(stacks.items()):
+        profile_file.write(f'{stack} {count}\n')
+
+
+def read_collapsed_stacks(lines: Iterable[str]) -> Counter:
+    '''Read stacks with their counts'''
+    stacks = Counter()
+    for line in lines:
+        stack, _, count = line.rstrip('\n').rpartition(' ')
+        if stack:
+            stacks[stack] += int(count)
+
+    return stacks
+
+
+def should_profile(repo_ids: Optional[List[int]] = None) -> bool:
+    '''The run is profiled when its repo is chosen or it's sampled'''
+    if repo_ids and any(repo_id in settings.PROFILING_REPO_IDS for repo_id in repo_ids):
+        return True
+
+    return settings.PROFILING_ENABLED and random.random() < settings.PROFILING_SAMPLE_RATE
+
+
+def profile(name: str, repo_ids: Optional[List[int]] = None):
+    '''Get the profiler context of the run or the empty context when it isn't profiled'''
+    if should_profile(repo_ids):
+        return SamplingProfiler(name)
+
+    return contextlib.nullcontext()
+
+
+def get_profile_paths(profiles_dir: str, name: str = None) -> List[str]:
+    '''Get profile paths ordered by time. The name filters profiles of the task or handler.'''
+    if not os.path.isdir(profiles_dir):
+        return []
+
+    file_names = sorted(file_name for file_name in os.listdir(profiles_dir)
+                        if file_name.endswith(PROFILE_EXTENSION))
+    if name is not None:
+        file_names = [file_name for file_name in file_names if f'-{name}-' in file_name]
+
+    return [os.path.join(profiles_dir, file_name) for file_name in file_names]
+
+
+def prune_profiles(profiles_dir: str, max_files: int = None, max_age_seconds: int = None):
+    '''Remove the profiles older than the max age and the oldest ones above the max count'''
+    max_files = settings.PROFILING_MAX_FILES if max_files is None else max_files
+    max_age_seconds = settings.PROFILING_MAX_AGE_SECONDS if max_age_seconds is None \
+                      else max_age_seconds
+
+    profile_paths = get_profile_paths(profiles_dir)
+    expired_time = time.time() - max_age_seconds
+    for index, profile_path in enumerate(profile_paths):
+        # The profile can be already removed by another process
+        with contextlib.suppress(FileNotFoundError):
+            if index < len(profile_paths) - max_files \
+                    or os.path.getmtime(profile_path) < expired_time:
+                os.remove(profile_path)
+
+
+def aggregate_profiles(profile_paths: List[str]) -> Counter:
+    '''Sum stacks of the profiles'''
+    stacks = Counter()
+    for profile_path in profile_paths:
+        with open(profile_path) as profile_file:
+            stacks.update(read_collapsed_stacks(profile_file))
+
+    return stacks
+
+
+def parse_args():
+    '''Parse the command line arguments'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=settings.PROFILING_DIR,
+                        help='the directory of profiles')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = subparsers.add_parser('list', help='list profiles')
+    list_parser.add_argument('--name', help='the task or handler name')
+
+    aggregate_parser = subparsers.add_parser('aggregate',
+                                             help='sum profiles into one collapsed stacks file')
+    aggregate_parser.add_argument('--name', help='the task or handler name')
+    aggregate_parser.add_argument('--last', type=int, help='aggregate only the last profiles')
+    aggregate_parser.add_argument('--output', help='the output file, stdout by default')
+    return parser.parse_args()
+
+
+def main():
+    '''Run the command'''
+    args = parse_args()
+    profile_paths = get_profile_paths(args.dir, args.name)
+
+    if args.command == 'list':
+        for profile_path in profile_paths:
+            with open(profile_path) as profile_file:
+                samples = sum(read_collapsed_stacks(profile_file).values())
+            print(f'{os.path.basename(profile_path)}\t{samples} samples')
+        return
+
+    if args.last:
+        profile_paths = profile_paths[-args.last:]
+
+    stacks = aggregate_profiles(profile_paths)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            write_collapsed_stacks(output_file, stacks)
+    else:
+        write_collapsed_stacks(sys.stdout, stacks)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import time
+import unittest
+from profiling import SamplingProfiler, aggregate_profiles, get_profile_paths, prune_profiles, \
+                      read_collapsed_stacks
+
+
+def busy_wait(seconds: float):
+    finish_time = time.perf_counter() + seconds
+    while time.perf_counter() < finish_time:
+        pass
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def test_profiler_writes_collapsed_stacks(self):
+        # Arrange
+        with tempfile.TemporaryDirectory() as profiles_dir:
+            profiler = SamplingProfiler('busy', interval_seconds=0.001, profiles_dir=profiles_dir)
+
+            # Act
+            with profiler:
+                busy_wait(0.1)
+
+            with open(profiler.profile_path) as profile_file:
+                stacks = read_collapsed_stacks(profile_file)
+
+            # Assert
+            assert get_profile_paths(profiles_dir, 'busy') == [profiler.profile_path]
+            assert any(stack.endswith('profiling_test.py:busy_wait') for stack in stacks)
+
+
+    def test_aggregate_profiles(self):
+        # Arrange
+        with tempfile.TemporaryDirectory() as profiles_dir:
+            for index, lines in enumerate([['a;b 2\n', 'a;c 1\n'], ['a;b 3\n']]):
+                profile_path = os.path.join(profiles_dir, f'{index}-task-1-0.collapsed')
+                with open(profile_path, 'w') as profile_file:
+                    profile_file.writelines(lines)
+
+            # Act
+            stacks = aggregate_profiles(get_profile_paths(profiles_dir, 'task'))
+
+            # Assert
+            assert stacks == {'a;b': 5, 'a;c': 1}
+
+
+    def test_prune_profiles(self):
+        # Arrange
+        with tempfile.TemporaryDirectory() as profiles_dir:
+            profile_paths = [os.path.join(profiles_dir, f'{index}-task-1-0.collapsed')
+                             for index in range(4)]
+            for profile_path in profile_paths:
+                with open(profile_path, 'w') as profile_file:
+                    profile_file.write('a;b 1\n')
+
+            expired_time = time.time() - 120
+            os.utime(profile_paths[3], (expired_time, expired_time))
+
+            # Act
+            prune_profiles(profiles_dir, max_files=3, max_age_seconds=60)
+
+            # Assert
+            assert get_profile_paths(profiles_dir) == profile_paths[1:3]
@@ -0,0 +1,48 @@
+'''The module with rate limiting primitives'''
+import asyncio
+import time
+
+
+class TokenBucket:
+    '''The token bucket which limits the rate of actions'''
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_time = time.monotonic()
+
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_time) * self.rate)
+        self.updated_time = now
+
+
+    def set_rate(self, rate: float):
+        '''Change the rate of the bucket'''
+        self.__refill()
+        self.rate = rate
+
+
+    def try_acquire(self) -> float:
+        '''Take a token. Returns 0 when it's taken or seconds to wait for the next one'''
+        self.__refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        if self.rate <= 0:
+            return 1
+
+        return (1 - self.tokens) / self.rate
+
+
+    async def acquire(self):
+        '''Wait for a token and take it'''
+        while True:
+            delay = self.try_acquire()
+            if delay <= 0:
+                return
+
+            await asyncio.sleep(delay)
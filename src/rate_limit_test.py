@@ -0,0 +1,28 @@
+import unittest
+from rate_limit import TokenBucket
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_try_acquire_within_capacity(self):
+        # Arrange
+        bucket = TokenBucket(rate=1, capacity=2)
+
+        # Act
+        first_delay = bucket.try_acquire()
+        second_delay = bucket.try_acquire()
+
+        # Assert
+        assert first_delay == 0
+        assert second_delay == 0
+
+    def test_try_acquire_when_bucket_is_empty(self):
+        # Arrange
+        bucket = TokenBucket(rate=1, capacity=1)
+        bucket.try_acquire()
+
+        # Act
+        delay = bucket.try_acquire()
+
+        # Assert
+        assert 0 < delay <= 1
+
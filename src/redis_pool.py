@@ -0,0 +1,66 @@
+'''The module with the redis connection pool shared by the process'''
+import asyncio
+import redis
+from redis import asyncio as aioredis
+import settings
+
+
+_connection_pool = None
+_async_connection_pool = None
+_async_connection_pool_loop = None
+
+
+def get_connection_pool() -> redis.ConnectionPool:
+    '''Get the pool of the process. The pool reconnects by itself after fork.'''
+    global _connection_pool  # pylint: disable=global-statement
+    if _connection_pool is None:
+        _connection_pool = redis.ConnectionPool(host=settings.REDIS_HOST,
+                                                port=settings.REDIS_PORT,
+                                                db=settings.REDIS_DB)
+
+    return _connection_pool
+
+
+def get_redis_connection() -> redis.Redis:
+    '''Get the client using the shared pool'''
+    return redis.Redis(connection_pool=get_connection_pool())
+
+
+def get_async_redis_connection() -> aioredis.Redis:
+    '''Get the asyncio client using the pool of the running event loop.
+    The asyncio connections are bound to the loop, so the pool is replaced with the loop.
+    The pool is bounded, the callers wait for the free connection.'''
+    global _async_connection_pool, _async_connection_pool_loop  # pylint: disable=global-statement
+    loop = asyncio.get_running_loop()
+    if _async_connection_pool is None or _async_connection_pool_loop is not loop:
+        _async_connection_pool = aioredis.BlockingConnectionPool(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=settings.REDIS_DB,
+            max_connections=settings.REDIS_ASYNC_MAX_CONNECTIONS,
+            timeout=None)
+        _async_connection_pool_loop = loop
+
+    return aioredis.Redis(connection_pool=_async_connection_pool)
+
+
+async def close_async_connection_pool():
+    '''Disconnect the asyncio connections pooled on the running event loop'''
+    global _async_connection_pool, _async_connection_pool_loop  # pylint: disable=global-statement
+    if _async_connection_pool is not None \
+            and _async_connection_pool_loop is asyncio.get_running_loop():
+        await _async_connection_pool.disconnect()
+
+    _async_connection_pool = None
+    _async_connection_pool_loop = None
+
+
+def close_connection_pool():
+    '''Disconnect the pooled connections. The asyncio pool is dropped,
+    since its connections can be closed only on its event loop.'''
+    global _connection_pool, _async_connection_pool  # pylint: disable=global-statement
+    if _connection_pool is not None:
+        _connection_pool.disconnect()
+        _connection_pool = None
+
+    _async_connection_pool = None
@@ -0,0 +1,107 @@
+'''The module with redis locks which keep a repo polled by one task at a time'''
+from typing import List
+import logging
+import threading
+from redis.exceptions import LockError
+from redis_pool import get_redis_connection
+import settings
+
+
+class RepoLease:
+    '''Leases of the repos held while they are polled. The leases are renewed
+    by the background thread, so they expire only when the worker is dead.'''
+
+    def __init__(self, redis_connection, repo_ids: List[int], seconds: int, logger=None) -> None:
+        self.redis_connection = redis_connection
+        self.repo_ids = repo_ids
+        self.seconds = seconds
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.locks = {}
+        self.stopped = threading.Event()
+        self.renew_thread = None
+
+
+    def __renew(self):
+        while not self.stopped.wait(self.seconds / 3):
+            for repo_id, lock in self.locks.items():
+                try:
+                    lock.reacquire()
+                except LockError:
+                    self.logger.warning('Lease of repo %s is lost.', repo_id)
+
+
+    def __enter__(self) -> List[int]:
+        for repo_id in self.repo_ids:
+            lock = self.redis_connection.lock(RepoLocks.get_lease_redis_key(repo_id),
+                                              timeout=self.seconds,
+                                              thread_local=False)
+            if lock.acquire(blocking=False):
+                self.locks[repo_id] = lock
+
+        self.renew_thread = threading.Thread(target=self.__renew, daemon=True)
+        self.renew_thread.start()
+
+        return list(self.locks)
+
+
+    def __exit__(self, *_):
+        self.stopped.set()
+        self.renew_thread.join()
+
+        for lock in self.locks.values():
+            try:
+                lock.release()
+            except LockError:
+                pass
+
+
+class RepoLocks:
+    '''Dedup of the queued repos and leases of the running ones'''
+
+    def __init__(self, redis_connection=None) -> None:
+        self.redis_connection = redis_connection or get_redis_connection()
+
+
+    @staticmethod
+    def get_lease_redis_key(repo_id: int) -> str:
+        '''Get the key of the running repo lease'''
+        return 'repo_lease_' + str(repo_id)
+
+
+    @staticmethod
+    def get_queued_redis_key(repo_id: int) -> str:
+        '''Get the key of the queued repo mark'''
+        return 'repo_queued_' + str(repo_id)
+
+
+    def mark_queued(self, repo_ids: List[int]) -> List[int]:
+        '''Mark repos as queued. Returns the ones which are neither queued nor running.'''
+        with self.redis_connection.pipeline(transaction=False) as pipe:
+            for repo_id in repo_ids:
+                pipe.exists(self.get_lease_redis_key(repo_id))
+            running = pipe.execute()
+
+        idle_repo_ids = [repo_id for repo_id, is_running in zip(repo_ids, running)
+                         if not is_running]
+
+        with self.redis_connection.pipeline(transaction=False) as pipe:
+            for repo_id in idle_repo_ids:
+                pipe.set(self.get_queued_redis_key(repo_id), 1,
+                         nx=True,
+                         ex=settings.REPO_QUEUED_SECONDS)
+            marked = pipe.execute()
+
+        return [repo_id for repo_id, is_marked in zip(idle_repo_ids, marked) if is_marked]
+
+
+    def unmark_queued(self, repo_ids: List[int]):
+        '''Remove queued marks of the handled repos'''
+        if len(repo_ids) > 0:
+            self.redis_connection.delete(*[self.get_queued_redis_key(repo_id)
+                                           for repo_id in repo_ids])
+
+
+    def lease(self, repo_ids: List[int]) -> RepoLease:
+        '''Lease repos for polling. The context manager gives ids of the leased repos.'''
+        return RepoLease(self.redis_connection, repo_ids, settings.REPO_LEASE_SECONDS)
@@ -0,0 +1,56 @@
+import unittest
+from repo_locks import RepoLocks
+from testing import use_test_redis_db
+
+
+class RepoLocksTestCase(unittest.TestCase):
+    def setUp(self):
+        use_test_redis_db()
+        self.repo_locks = RepoLocks()
+        self.repo_locks.redis_connection.flushdb()
+
+    def tearDown(self):
+        self.repo_locks.redis_connection.flushdb()
+
+    def test_mark_queued(self):
+        '''Test the queued repos aren't queued again till they are unmarked'''
+
+        # Arrange
+        self.repo_locks.mark_queued([1])
+
+        # Act
+        marked = self.repo_locks.mark_queued([1, 2])
+        self.repo_locks.unmark_queued([1])
+        marked_after_unmark = self.repo_locks.mark_queued([1, 2])
+
+        # Assert
+        assert marked == [2]
+        assert marked_after_unmark == [1]
+
+    def test_mark_queued_skips_leased_repos(self):
+        '''Test the running repos aren't queued'''
+
+        # Arrange
+        with self.repo_locks.lease([1]):
+            # Act
+            marked = self.repo_locks.mark_queued([1, 2])
+
+        # Assert
+        assert marked == [2]
+
+    def test_lease(self):
+        '''Test the repo is leased by one task at a time'''
+
+        # Arrange
+        with self.repo_locks.lease([1, 2]) as leased_repo_ids:
+            # Act
+            with self.repo_locks.lease([2, 3]) as concurrently_leased_repo_ids:
+                pass
+
+        with self.repo_locks.lease([2]) as leased_after_release_repo_ids:
+            pass
+
+        # Assert
+        assert leased_repo_ids == [1, 2]
+        assert concurrently_leased_repo_ids == [3]
+        assert leased_after_release_repo_ids == [2]
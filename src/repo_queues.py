@@ -0,0 +1,43 @@
+'''The module with celery queues of repos by their last known stars count'''
+from typing import Dict, List, Optional
+import settings
+
+
+SMALL_REPOS_QUEUE = 'repos_small'
+MEDIUM_REPOS_QUEUE = 'repos_medium'
+HUGE_REPOS_QUEUE = 'repos_huge'
+REPOS_QUEUES = [SMALL_REPOS_QUEUE, MEDIUM_REPOS_QUEUE, HUGE_REPOS_QUEUE]
+
+
+def get_repo_queue(stars_count: Optional[int]) -> str:
+    '''Get the queue of the repo. Never synced repos go to the medium queue,
+    since their size is unknown and the first sync is the full one.'''
+    if stars_count is None:
+        return MEDIUM_REPOS_QUEUE
+
+    if stars_count >= settings.HUGE_REPO_STARS:
+        return HUGE_REPOS_QUEUE
+
+    if stars_count >= settings.MEDIUM_REPO_STARS:
+        return MEDIUM_REPOS_QUEUE
+
+    return SMALL_REPOS_QUEUE
+
+
+def get_queue_batch_size(queue: str) -> int:
+    '''Get the number of repos handled by one task of the queue'''
+    return {
+        SMALL_REPOS_QUEUE: settings.REPOS_BATCH_SIZE,
+        MEDIUM_REPOS_QUEUE: settings.MEDIUM_REPOS_BATCH_SIZE,
+        HUGE_REPOS_QUEUE: settings.HUGE_REPOS_BATCH_SIZE,
+    }[queue]
+
+
+def group_repos_by_queue(repo_ids: List[int],
+                         stars_counts: List[Optional[int]]) -> Dict[str, List[int]]:
+    '''Group repos by their queues'''
+    queues_repo_ids = {}
+    for repo_id, stars_count in zip(repo_ids, stars_counts):
+        queues_repo_ids.setdefault(get_repo_queue(stars_count), []).append(repo_id)
+
+    return queues_repo_ids
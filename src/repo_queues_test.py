@@ -0,0 +1,23 @@
+import unittest
+from unittest import mock
+from repo_queues import HUGE_REPOS_QUEUE, MEDIUM_REPOS_QUEUE, SMALL_REPOS_QUEUE, \
+                        group_repos_by_queue
+
+
+class RepoQueuesTestCase(unittest.TestCase):
+    @mock.patch('settings.MEDIUM_REPO_STARS', 1000)
+    @mock.patch('settings.HUGE_REPO_STARS', 20000)
+    def test_group_repos_by_queue(self):
+        # Arrange
+        repo_ids = [1, 2, 3, 4, 5]
+        stars_counts = [10, None, 1000, 50000, 999]
+
+        # Act
+        queues_repo_ids = group_repos_by_queue(repo_ids, stars_counts)
+
+        # Assert
+        assert queues_repo_ids == {
+            SMALL_REPOS_QUEUE: [1, 5],
+            MEDIUM_REPOS_QUEUE: [2, 3],
+            HUGE_REPOS_QUEUE: [4],
+        }
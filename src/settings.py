@@ -4,6 +4,11 @@ import os
 TELEGRAM_API_TOKEN = os.getenv("TELEGRAM_API_TOKEN")
 REDIS_HOST = os.getenv("REDIS_HOST") or 'localhost'
 REDIS_PORT = os.getenv("REDIS_PORT") or '6379'
+REDIS_DB = int(os.getenv('REDIS_DB') or 0)
+# The db flushed by the tests
+TEST_REDIS_DB = int(os.getenv('TEST_REDIS_DB') or 15)
+# The concurrent github requests of the process wait for the free asyncio redis connection
+REDIS_ASYNC_MAX_CONNECTIONS = int(os.getenv('REDIS_ASYNC_MAX_CONNECTIONS') or 50)
 
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL") or 'localhost'
 CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND") or 'localhost'
@@ -13,6 +18,78 @@ POSTGRESQL_PASSWORD = os.getenv('POSTGRESQL_PASSWORD') or 'password'
 POSTGRESQL_HOST = os.getenv('POSTGRESQL_HOST') or 'localhost'
 POSTGRESQL_PORT = os.getenv('POSTGRESQL_PORT') or '5432'
 POSTGRESQL_DB = os.getenv('POSTGRESQL_DB') or 'db'
+DATABASE_URL = os.getenv('DATABASE_URL')
+DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE') or 10)
+DATABASE_MAX_OVERFLOW = int(os.getenv('DATABASE_MAX_OVERFLOW') or 5)
+DATABASE_POOL_TIMEOUT_SECONDS = int(os.getenv('DATABASE_POOL_TIMEOUT_SECONDS') or 10)
+BOT_DATABASE_THREADS = int(os.getenv('BOT_DATABASE_THREADS') or DATABASE_POOL_SIZE)
 
-SECONDS_UPDATE = os.getenv('SECONDS_UPDATE') or 1 * 60
+SECONDS_UPDATE = int(os.getenv('SECONDS_UPDATE') or 1 * 60)
+GITHUB_API_URL = os.getenv('GITHUB_API_URL') or 'https://api.github.com'
 GITHUB_KEY = os.getenv('GITHUB_KEY')
+GITHUB_KEYS = [key for key in (os.getenv('GITHUB_KEYS') or GITHUB_KEY or '').split(',') if key]
+SECONDS_FULL_SYNC = int(os.getenv('SECONDS_FULL_SYNC') or 60 * 60)
+GITHUB_CACHE_MAX_BYTES = int(os.getenv('GITHUB_CACHE_MAX_BYTES') or 64 * 1024 * 1024)
+GITHUB_CONNECTIONS_PER_HOST = int(os.getenv('GITHUB_CONNECTIONS_PER_HOST') or 20)
+GITHUB_DNS_CACHE_SECONDS = int(os.getenv('GITHUB_DNS_CACHE_SECONDS') or 5 * 60)
+GITHUB_KEEPALIVE_SECONDS = int(os.getenv('GITHUB_KEEPALIVE_SECONDS') or 30)
+GITHUB_MAX_IN_FLIGHT = int(os.getenv('GITHUB_MAX_IN_FLIGHT') or 10)
+GITHUB_MAX_REQUESTS_PER_SECOND = float(os.getenv('GITHUB_MAX_REQUESTS_PER_SECOND') or 10)
+# The token spends its quota at the max rate and it's paced to last till the reset
+# only when fewer requests remain
+GITHUB_PACING_REMAINING = int(os.getenv('GITHUB_PACING_REMAINING') or 500)
+GITHUB_MAX_RETRIES = int(os.getenv('GITHUB_MAX_RETRIES') or 5)
+GITHUB_RETRY_BACKOFF_SECONDS = float(os.getenv('GITHUB_RETRY_BACKOFF_SECONDS') or 1)
+REPOS_BATCH_SIZE = int(os.getenv('REPOS_BATCH_SIZE') or 50)
+MEDIUM_REPOS_BATCH_SIZE = int(os.getenv('MEDIUM_REPOS_BATCH_SIZE') or 10)
+HUGE_REPOS_BATCH_SIZE = int(os.getenv('HUGE_REPOS_BATCH_SIZE') or 1)
+MEDIUM_REPO_STARS = int(os.getenv('MEDIUM_REPO_STARS') or 1000)
+HUGE_REPO_STARS = int(os.getenv('HUGE_REPO_STARS') or 20000)
+LARGE_REPO_STARS = int(os.getenv('LARGE_REPO_STARS') or 40000)
+# The large repo is tracked exactly again only when it drops below the share of LARGE_REPO_STARS,
+# so the repo around the threshold doesn't switch the mode by every poll
+LARGE_REPO_EXIT_RATIO = float(os.getenv('LARGE_REPO_EXIT_RATIO') or 0.9)
+LARGE_REPO_WINDOW = int(os.getenv('LARGE_REPO_WINDOW') or 1000)
+# Stars are kept in the small redis hashes, the size must stay below hash-max-listpack-entries
+# (hash-max-ziplist-entries before redis 7), so the hashes keep the compact encoding
+STARS_BUCKET_SIZE = int(os.getenv('STARS_BUCKET_SIZE') or 64)
+TELEGRAM_MESSAGES_PER_SECOND = float(os.getenv('TELEGRAM_MESSAGES_PER_SECOND') or 25)
+TELEGRAM_CHAT_MESSAGES_PER_SECOND = float(os.getenv('TELEGRAM_CHAT_MESSAGES_PER_SECOND') or 1)
+TELEGRAM_MAX_QUEUED_MESSAGES = int(os.getenv('TELEGRAM_MAX_QUEUED_MESSAGES') or 1000)
+OUTBOX_MAX_LENGTH = int(os.getenv('OUTBOX_MAX_LENGTH') or 1000000)
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE') or 100)
+OUTBOX_CLAIM_IDLE_SECONDS = int(os.getenv('OUTBOX_CLAIM_IDLE_SECONDS') or 60)
+OUTBOX_MAX_DELIVERIES = int(os.getenv('OUTBOX_MAX_DELIVERIES') or 5)
+# The due repos are dispatched every SECONDS_UPDATE, so the shorter interval
+# is rounded up to it
+POLL_MIN_SECONDS = int(os.getenv('POLL_MIN_SECONDS') or SECONDS_UPDATE)
+POLL_MAX_SECONDS = int(os.getenv('POLL_MAX_SECONDS') or 60 * 60)
+# The share of the interval the next poll is randomly moved earlier by,
+# so the repos subscribed together don't stay due at the same tick
+POLL_JITTER_RATIO = float(os.getenv('POLL_JITTER_RATIO') or 0.1)
+GITHUB_API_BACKEND = os.getenv('GITHUB_API_BACKEND') or 'rest'
+METRICS_PORT = int(os.getenv('METRICS_PORT') or 0)
+GITHUB_PAGES_WINDOW = int(os.getenv('GITHUB_PAGES_WINDOW') or 20)
+REPO_LEASE_SECONDS = int(os.getenv('REPO_LEASE_SECONDS') or 60)
+REPO_QUEUED_SECONDS = int(os.getenv('REPO_QUEUED_SECONDS') or 10 * 60)
+DIGEST_SECONDS = int(os.getenv('DIGEST_SECONDS') or 0)
+DIGEST_FLUSH_SECONDS = int(os.getenv('DIGEST_FLUSH_SECONDS') or 60)
+BOT_MODE = os.getenv('BOT_MODE') or 'polling'
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST') or ''
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH') or '/webhook'
+WEBAPP_HOST = os.getenv('WEBAPP_HOST') or '0.0.0.0'
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT') or 8080)
+BOT_STATE_SECONDS = int(os.getenv('BOT_STATE_SECONDS') or 10 * 60)
+BOT_UPDATE_DEDUP_SECONDS = int(os.getenv('BOT_UPDATE_DEDUP_SECONDS') or 60 * 60)
+REPOS_SCAN_BATCH_SIZE = int(os.getenv('REPOS_SCAN_BATCH_SIZE') or 1000)
+ORPHAN_REPOS_GC_SECONDS = int(os.getenv('ORPHAN_REPOS_GC_SECONDS') or 60 * 60)
+PROFILING_ENABLED = (os.getenv('PROFILING_ENABLED') or '').lower() in ('1', 'true', 'yes')
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE') or 0.01)
+PROFILING_REPO_IDS = [int(repo_id)
+                      for repo_id in (os.getenv('PROFILING_REPO_IDS') or '').split(',')
+                      if repo_id]
+PROFILING_INTERVAL_SECONDS = float(os.getenv('PROFILING_INTERVAL_SECONDS') or 0.005)
+PROFILING_DIR = os.getenv('PROFILING_DIR') or '/tmp/profiles'
+# The older profiles are removed when the new one is written
+PROFILING_MAX_FILES = int(os.getenv('PROFILING_MAX_FILES') or 1000)
+PROFILING_MAX_AGE_SECONDS = int(os.getenv('PROFILING_MAX_AGE_SECONDS') or 7 * 24 * 60 * 60)
@@ -1,10 +1,22 @@
 '''The module with celery tasks'''
-import asyncio
-from aiogram import Bot
+from typing import Dict, List
+import os
+import time
 import celery
+from celery import signals
 from celery.utils.log import get_task_logger
-from notification import Notification
+from kombu import Queue
+from notification import Notification, UpdateRepoStarsResult
 from common import generate_notification_message
+from digest import NotificationDigest
+from outbox import NotificationOutbox
+from poll_scheduler import PollScheduler
+from profiling import profile
+from repo_locks import RepoLocks
+from repo_queues import REPOS_QUEUES, get_queue_batch_size, group_repos_by_queue
+import worker_resources
+from metrics import TASK_QUEUE_LAG_SECONDS, TASK_SECONDS, clean_multiprocess_dir, \
+                    is_multiprocess_mode, mark_process_dead, start_metrics_server
 import settings
 
 app = celery.Celery('github-notification')
@@ -12,8 +24,11 @@ app = celery.Celery('github-notification')
 app.conf.update(broker_url=settings.CELERY_BROKER_URL,
                 result_backend=settings.CELERY_RESULT_BACKEND)
 
+# Repos are handled in the queues by their size, so huge repos don't delay small ones.
+# The scheduled tasks stay in the default queue.
+app.conf.task_default_queue = 'celery'
+app.conf.task_queues = [Queue('celery')] + [Queue(queue) for queue in REPOS_QUEUES]
 
-bot = Bot(token=settings.TELEGRAM_API_TOKEN)
 
 app.conf.beat_schedule = {
     'add-every-2-seconds': {
@@ -22,46 +37,205 @@ app.conf.beat_schedule = {
     },
 }
 
+if settings.ORPHAN_REPOS_GC_SECONDS > 0:
+    app.conf.beat_schedule['collect-orphan-repos'] = {
+        'task': 'tasks.collect_orphan_repos',
+        'schedule': settings.ORPHAN_REPOS_GC_SECONDS,
+    }
+
+if settings.DIGEST_SECONDS > 0:
+    app.conf.beat_schedule['flush-digests'] = {
+        'task': 'tasks.flush_digests',
+        'schedule': settings.DIGEST_FLUSH_SECONDS,
+    }
+
 logger = get_task_logger(__name__)
 
-class Sender:
-    '''Sender'''
+tasks_started_times = {}
+
+
+@signals.worker_init.connect
+def start_worker_metrics_server(**_):
+    '''Expose metrics of all prefork processes by the main worker process'''
+    if is_multiprocess_mode():
+        clean_multiprocess_dir()
+
+    start_metrics_server()
+
+
+@signals.worker_init.connect
+def init_worker_resources(**_):
+    '''Create the database schema once before forking'''
+    worker_resources.init_worker()
+
+
+@signals.worker_process_init.connect
+def init_worker_process_resources(**_):
+    '''Drop the database connections inherited from the main worker process'''
+    worker_resources.init_process()
+
+
+@signals.worker_process_shutdown.connect
+def forget_worker_process_metrics(pid=None, **_):
+    '''Forget live gauges of the finished prefork process'''
+    mark_process_dead(pid or os.getpid())
+
+
+@signals.worker_process_shutdown.connect
+def shutdown_worker_process_resources(**_):
+    '''Close the event loop, the github session and the pooled connections'''
+    worker_resources.shutdown_process()
+
+
+@signals.before_task_publish.connect
+def set_task_published_time(headers=None, **_):
+    '''Keep the publishing time for the queue lag metric'''
+    headers['published_time'] = time.time()
+
+
+@signals.task_prerun.connect
+def observe_task_started(task_id=None, task=None, **_):
+    '''Observe the queue lag of the task'''
+    published_time = getattr(task.request, 'published_time', None)
+    if published_time is not None:
+        TASK_QUEUE_LAG_SECONDS.labels(task=task.name).observe(time.time() - published_time)
+
+    tasks_started_times[task_id] = time.perf_counter()
+
+
+@signals.task_postrun.connect
+def observe_task_finished(task_id=None, task=None, **_):
+    '''Observe the task duration'''
+    started_time = tasks_started_times.pop(task_id, None)
+    if started_time is not None:
+        TASK_SECONDS.labels(task=task.name).observe(time.perf_counter() - started_time)
 
-    def __init__(self, user, message) -> None:
-        self.user = user
-        self.message = message
 
-    async def send(self):
-        '''send message to user'''
-        await bot.send_message(self.user, self.message, disable_web_page_preview=True)
+def notify_users(repo_url: str, diff_result: UpdateRepoStarsResult):
+    '''Put the stars diff for the subscribed users to the outbox or their digests'''
+    if not diff_result.need_to_handle():
+        return
+
+    if settings.DIGEST_SECONDS > 0:
+        NotificationDigest().add(diff_result.teleg_subscribed_users,
+                                 repo_url,
+                                 diff_result.added_stars,
+                                 diff_result.removed_stars,
+                                 removed_stars_count=diff_result.removed_stars_count,
+                                 approximate=diff_result.approximate,
+                                 added_stars_count=diff_result.added_stars_count)
+        return
+
+    message = generate_notification_message(repo_url,
+                                            diff_result.added_stars,
+                                            diff_result.removed_stars,
+                                            removed_stars_count=diff_result.removed_stars_count,
+                                            approximate=diff_result.approximate,
+                                            added_stars_count=diff_result.added_stars_count)
+
+    NotificationOutbox().put(diff_result.teleg_subscribed_users, message)
 
 
 @app.task
 def handle_repo(repo_id: int):
     '''Handle repo by id'''
     logger.info('Handle repo with id %s is started.', repo_id)
-    notification = Notification()
-    diff_result = notification.update_repo_stars(repo_id)
+    repo_locks = RepoLocks()
+
+    try:
+        with profile('handle_repo', [repo_id]), repo_locks.lease([repo_id]) as leased_repo_ids:
+            if len(leased_repo_ids) == 0:
+                logger.info('Repo with id %s is already handled.', repo_id)
+                return
 
-    if diff_result.need_to_handle():
-        repo = notification.get_repo_by_id(repo_id)
-        message = generate_notification_message(repo.url,
-                                                diff_result.added_stars,
-                                                diff_result.removed_stars)
+            notification = Notification()
+            diff_result = notification.update_repo_stars(repo_id)
 
-        for user in diff_result.teleg_subscribed_users:
-            asyncio.run(Sender(user, message).send())
+            if diff_result.need_to_handle():
+                repo = notification.get_repo_by_id(repo_id)
+                notify_users(repo.url, diff_result)
+    finally:
+        repo_locks.unmark_queued([repo_id])
 
     logger.info('Handle repo with id %s is finished.', repo_id)
 
 
+@app.task
+def handle_repos(repo_ids: List[int]) -> Dict[str, dict]:
+    '''Handle the batch of repos by ids in one event loop.
+    Returns counts of added and removed stars by repo ids.'''
+    logger.info('Handle %s repos is started.', len(repo_ids))
+    repo_locks = RepoLocks()
+
+    try:
+        with profile('handle_repos', repo_ids), repo_locks.lease(repo_ids) as leased_repo_ids:
+            diff_results = Notification().update_repos_stars(leased_repo_ids) \
+                           if len(leased_repo_ids) > 0 else {}
+
+            for diff_result in diff_results.values():
+                notify_users(diff_result.repo_url, diff_result)
+    finally:
+        repo_locks.unmark_queued(repo_ids)
+
+    logger.info('Handle %s repos is finished, %s are already handled, %s failed.',
+                len(repo_ids),
+                len(repo_ids) - len(leased_repo_ids),
+                len(leased_repo_ids) - len(diff_results))
+
+    # The result is kept by the result backend, so it holds only counts instead of logins
+    return {str(repo_id): {'added': len(diff_result.added_stars) + diff_result.added_stars_count,
+                           'removed': len(diff_result.removed_stars)
+                                      + diff_result.removed_stars_count}
+            for repo_id, diff_result in diff_results.items()}
+
+
 @app.task
 def handle_urls():
-    '''Handle all urls from the DB'''
+    '''Handle all urls from the DB which are due to poll and aren't queued or running'''
+
+    notification = Notification()
+    poll_scheduler = PollScheduler()
+    repo_locks = RepoLocks()
 
-    repos = Notification().get_all_repos()
-    for repo in repos:
-        handle_repo.delay(repo.id)
+    with profile('handle_urls'):
+        for repo_ids in notification.iter_subscribed_repo_ids():
+            repo_ids = poll_scheduler.get_due_repo_ids(repo_ids)
+            repo_ids = repo_locks.mark_queued(repo_ids)
+            queues_repo_ids = group_repos_by_queue(repo_ids,
+                                                   notification.get_last_stars_counts(repo_ids))
+
+            for queue, queue_repo_ids in queues_repo_ids.items():
+                batch_size = get_queue_batch_size(queue)
+                for chunk_start in range(0, len(queue_repo_ids), batch_size):
+                    chunk = queue_repo_ids[chunk_start:chunk_start + batch_size]
+                    handle_repos.apply_async((chunk,), queue=queue)
+
+
+@app.task
+def collect_orphan_repos():
+    '''Remove repos without subscribers. The queued or running repos are left for the next run.'''
+    notification = Notification()
+    repo_locks = RepoLocks()
+    removed_count = 0
+
+    for repo_ids in notification.iter_orphan_repo_ids():
+        idle_repo_ids = repo_locks.mark_queued(repo_ids)
+        try:
+            with repo_locks.lease(idle_repo_ids) as leased_repo_ids:
+                removed_count += len(notification.remove_orphan_repos(leased_repo_ids))
+        finally:
+            repo_locks.unmark_queued(idle_repo_ids)
+
+    if removed_count > 0:
+        logger.info('%s orphan repos are removed.', removed_count)
+
+
+@app.task
+def flush_digests():
+    '''Send digests which window is over'''
+    flushed = NotificationDigest().flush_due()
+    if flushed > 0:
+        logger.info('%s digests are flushed.', flushed)
 
 
 app.conf.timezone = 'UTC'
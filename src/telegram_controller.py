@@ -1,35 +1,122 @@
 '''The telegram bot module'''
+import asyncio
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from aiogram import Bot, Dispatcher, executor, types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from redis import asyncio as aioredis
 import settings
+from bot_state import BotState
 from common import get_message_lines
+from metrics import BOT_HANDLER_SECONDS, start_metrics_server
 from notification import Notification, SubscribeResult, UnsubscribeResut
+from profiling import should_profile, SamplingProfiler
 
 logging.basicConfig(level=logging.INFO)
 
 bot = Bot(token=settings.TELEGRAM_API_TOKEN)
 dp = Dispatcher(bot)
+notification = Notification()
+redis_connection = aioredis.Redis(host=settings.REDIS_HOST,
+                                  port=settings.REDIS_PORT,
+                                  db=settings.REDIS_DB)
+bot_state = BotState(redis_connection)
+
+# The database calls are blocking, so they are run out of the event loop.
+# The executor is bounded by the size of the database connection pool.
+database_executor = ThreadPoolExecutor(max_workers=settings.BOT_DATABASE_THREADS,
+                                       thread_name_prefix='bot-database')
+
+
+async def run_blocking(func, *args, **kwargs):
+    '''Run the blocking call in the database executor'''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(database_executor, partial(func, *args, **kwargs))
+
+
+class MetricsMiddleware(BaseMiddleware):
+    '''Observe latency of the message handlers'''
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        '''Remember the handler and its start time'''
+        handler = current_handler.get(None)
+        data['metrics_handler'] = handler.__name__ if handler is not None else 'unknown'
+        data['metrics_started_time'] = time.perf_counter()
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        '''Observe the handler latency'''
+        if 'metrics_started_time' in data:
+            BOT_HANDLER_SECONDS\
+                .labels(handler=data['metrics_handler'])\
+                .observe(time.perf_counter() - data['metrics_started_time'])
+
+
+class DeduplicateUpdatesMiddleware(BaseMiddleware):
+    '''Skip the updates which are already handled by any bot replica.
+    The update is marked before the handler, so the replicas don't handle it concurrently,
+    and the mark of the failed update is removed by the errors handler.'''
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        '''Cancel handling of the repeated update'''
+        if not await bot_state.mark_update(update.update_id):
+            raise CancelHandler()
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    '''Profile the sampled message handlers'''
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        '''Start the profiler of the handler'''
+        if not should_profile():
+            return
+
+        handler = current_handler.get(None)
+        profiler = SamplingProfiler(handler.__name__ if handler is not None else 'unknown',
+                                    all_threads=True)
+        profiler.start()
+        data['profiler'] = profiler
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        '''Stop the profiler and write the profile'''
+        if 'profiler' in data:
+            await run_blocking(data['profiler'].stop)
+
+
+dp.middleware.setup(DeduplicateUpdatesMiddleware())
+dp.middleware.setup(MetricsMiddleware())
+dp.middleware.setup(ProfilingMiddleware())
+
+
+@dp.errors_handler()
+async def unmark_failed_update(update: types.Update, exception: Exception):
+    '''Forget the failed update, so it's handled again when telegram repeats it.
+    The error isn't handled here, so it's still raised.'''
+    await bot_state.unmark_update(update.update_id)
 
 REPOS_COMMAND = 'repos'
 UNSUBSCRIBE_COMMAND = 'unsubs'
+STATS_COMMAND = 'stats'
 
-unsubscribe_states_users_ids = set()
+async def clean_unsubscribe_states(message: types.Message) -> bool:
+    '''Clean unsubscribe state for user. Returns whether it was set'''
+    return await bot_state.pop_unsubscribe(message.from_user.id)
 
-def clean_unsubscribe_states(message: types.Message):
-    '''Clean unsubscribe state for user'''
-    unsubscribe_states_users_ids.discard(message.from_user.id)
 
 @dp.message_handler(commands=['start', 'help'])
 async def welcome(message: types.Message):
     '''Send the info about commands'''
-    clean_unsubscribe_states(message)
+    await clean_unsubscribe_states(message)
 
     await message.answer(get_message_lines([
         'The bot for tracking github starts.',
         '',
         f'See subscribed repos: /{REPOS_COMMAND}',
         'Subscribe repo: (repourl)',
-        f'Unsubscribe repo: /{UNSUBSCRIBE_COMMAND}'
+        f'Unsubscribe repo: /{UNSUBSCRIBE_COMMAND}',
+        f'See stars changes of repo: /{STATS_COMMAND} (repourl)'
     ]))
 
 
@@ -37,10 +124,9 @@ async def welcome(message: types.Message):
 async def get_user_subscribed_repos(message: types.Message):
     '''Send subscribed repos'''
     user_id = message.from_user.id
-    clean_unsubscribe_states(message)
+    await clean_unsubscribe_states(message)
 
-    notification = Notification()
-    user_repos = notification.get_user_repos(user_id)
+    user_repos = await run_blocking(notification.get_user_repos, user_id)
 
     if len(user_repos) == 0:
         await message.answer('There are no subscribed repos for you.')
@@ -56,24 +142,46 @@ async def get_user_subscribed_repos(message: types.Message):
 @dp.message_handler(commands=[UNSUBSCRIBE_COMMAND])
 async def unsubscribed_repo(message: types.Message):
     '''Send subscribed repos'''
-    unsubscribe_states_users_ids.add(message.from_user.id)
+    await bot_state.set_unsubscribe(message.from_user.id)
 
     await message.answer('Put a link of the repo for unsubscribing.')
 
+@dp.message_handler(commands=[STATS_COMMAND])
+async def get_repo_stats(message: types.Message):
+    '''Send stars changes of the repo'''
+    repo_url = message.get_args()
+    await clean_unsubscribe_states(message)
+
+    if not repo_url:
+        await message.answer('Put a link of the repo after the command: '
+                             f'/{STATS_COMMAND} (repourl)')
+        return
+
+    stats = await run_blocking(notification.get_repo_stats, repo_url)
+    if stats is None:
+        await message.answer(f'The repo {repo_url} is not tracked.',
+                             disable_web_page_preview=True)
+        return
+
+    answer = [f'Stars changes of {repo_url}:', '']
+    for title, changes in (('Today', stats.today),
+                           ('Last 7 days', stats.last_7_days),
+                           ('Last 4 weeks', stats.last_4_weeks)):
+        answer.append(f' - {title}: +{changes.added} / -{changes.removed}')
+
+    await message.answer(get_message_lines(answer), disable_web_page_preview=True)
+
+
 @dp.message_handler()
 async def send_url(message: types.Message):
     '''User sends url. Subscribe/unsubscribe'''
     repo_url = message.text
     user_id = message.from_user.id
 
-    unsubscribe = user_id in unsubscribe_states_users_ids
-    print(unsubscribe_states_users_ids)
-    clean_unsubscribe_states(message)
-
-    notification = Notification()
+    unsubscribe = await clean_unsubscribe_states(message)
 
     if unsubscribe:
-        unsubscribe_result = notification.unsubscribe(user_id, repo_url)
+        unsubscribe_result = await run_blocking(notification.unsubscribe, user_id, repo_url)
         if unsubscribe_result == UnsubscribeResut.REPO_MISSING:
             await message.answer(f'You are not subscribed for the repo {repo_url}',
                                 disable_web_page_preview=True)
@@ -82,7 +190,7 @@ async def send_url(message: types.Message):
         await message.answer('Unsubscribed successfully.')
         return
 
-    subscribe_result = notification.subscribe(user_id, repo_url)
+    subscribe_result = await run_blocking(notification.subscribe, user_id, repo_url)
     if subscribe_result == SubscribeResult.ALREADY_SUBSCRIBE:
         await message.answer(f'You are already subscribed to "{repo_url}" repo.',
                                 disable_web_page_preview=True)
@@ -91,5 +199,28 @@ async def send_url(message: types.Message):
     await message.answer('Subscribed successfully.')
 
 
+async def on_startup_webhook(dispatcher: Dispatcher):
+    '''Register the webhook. Every replica sets the same url'''
+    await bot.set_webhook(settings.WEBHOOK_HOST + settings.WEBHOOK_PATH)
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    '''Wait for the running database calls and close connections.
+    The webhook is kept because other replicas may still serve it.'''
+    database_executor.shutdown(wait=True)
+    await redis_connection.close()
+
+
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    start_metrics_server()
+    if settings.BOT_MODE == 'webhook':
+        executor.start_webhook(
+            dispatcher=dp,
+            webhook_path=settings.WEBHOOK_PATH,
+            on_startup=on_startup_webhook,
+            on_shutdown=on_shutdown,
+            host=settings.WEBAPP_HOST,
+            port=settings.WEBAPP_PORT
+        )
+    else:
+        executor.start_polling(dp, skip_updates=True, on_shutdown=on_shutdown)
@@ -0,0 +1,243 @@
+'''The service which delivers notifications from the outbox to telegram'''
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import Dict, List, Set, Tuple
+from aiogram import Bot
+from aiogram.utils import exceptions
+from redis import asyncio as aioredis
+from redis.exceptions import ResponseError
+import settings
+from metrics import TELEGRAM_SEND_ERRORS, TELEGRAM_SEND_SECONDS, start_metrics_server
+from outbox import OUTBOX_GROUP, OUTBOX_STREAM
+from rate_limit import TokenBucket
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# The errors after which the message can't be delivered at all
+UNDELIVERABLE_ERRORS = (
+    exceptions.BotBlocked,
+    exceptions.ChatNotFound,
+    exceptions.UserDeactivated,
+    exceptions.CantInitiateConversation,
+)
+
+
+class TelegramSender:
+    '''Reads the outbox by the consumer group and sends messages with the global
+    and per chat rate limits. Every chat has its queue and the worker task, so reading
+    and other chats don't wait for the slow chat. Not acknowledged messages are claimed
+    again later.'''
+
+    def __init__(self,
+                 bot: Bot,
+                 redis_connection,
+                 consumer_name: str = None,
+                 max_queued_messages: int = None) -> None:
+        self.bot = bot
+        self.redis_connection = redis_connection
+        self.consumer_name = consumer_name or f'{socket.gethostname()}-{os.getpid()}'
+        self.bucket = TokenBucket(settings.TELEGRAM_MESSAGES_PER_SECOND)
+        self.chat_send_interval = 1 / settings.TELEGRAM_CHAT_MESSAGES_PER_SECOND
+        # The idle worker stops after the chat send interval, so its next send time is passed
+        self.chat_idle_seconds = max(self.chat_send_interval, 1)
+        self.chats_next_send_time: Dict[str, float] = {}
+        self.chats_queues: Dict[str, asyncio.Queue] = {}
+        self.chats_workers: Dict[str, asyncio.Task] = {}
+        self.queued_entries_ids: Set[bytes] = set()
+        self.max_queued_messages = max_queued_messages or settings.TELEGRAM_MAX_QUEUED_MESSAGES
+        self._queued_messages = None
+
+
+    async def create_group(self):
+        '''Create the consumer group if it's missing'''
+        try:
+            await self.redis_connection.xgroup_create(OUTBOX_STREAM, OUTBOX_GROUP,
+                                                      id='0', mkstream=True)
+        except ResponseError as error:
+            if 'BUSYGROUP' not in str(error):
+                raise
+
+
+    async def __wait_for_chat(self, user: str):
+        now = time.monotonic()
+        next_send_time = self.chats_next_send_time.get(user, now)
+        self.chats_next_send_time[user] = max(next_send_time, now) + self.chat_send_interval
+
+        if next_send_time > now:
+            await asyncio.sleep(next_send_time - now)
+
+
+    def __get_queued_messages(self) -> asyncio.Semaphore:
+        # The semaphore is bound to the loop, so it's created by the running one
+        if self._queued_messages is None:
+            self._queued_messages = asyncio.Semaphore(self.max_queued_messages)
+
+        return self._queued_messages
+
+
+    async def send(self, user: str, message: str):
+        '''Send the message to user and wait when telegram asks to retry'''
+        while True:
+            await self.__wait_for_chat(user)
+            await self.bucket.acquire()
+
+            started_time = time.perf_counter()
+            try:
+                await self.bot.send_message(user, message, disable_web_page_preview=True)
+            except exceptions.RetryAfter as error:
+                TELEGRAM_SEND_ERRORS.labels(error=type(error).__name__).inc()
+                logger.warning('Telegram asks to retry after %s seconds.', error.timeout)
+                await asyncio.sleep(error.timeout)
+                continue
+            except Exception as error:
+                TELEGRAM_SEND_ERRORS.labels(error=type(error).__name__).inc()
+                raise
+
+            TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started_time)
+            return
+
+
+    async def __handle_entry(self, entry_id: bytes, fields: Dict[bytes, bytes]):
+        user = fields[b'user'].decode()
+
+        try:
+            await self.send(user, fields[b'message'].decode())
+        except UNDELIVERABLE_ERRORS as error:
+            logger.info('Message for %s is dropped: %s', user, error)
+        except Exception: # pylint: disable=broad-except
+            logger.exception('Message for %s is failed, it will be retried.', user)
+            return
+
+        await self.redis_connection.xack(OUTBOX_STREAM, OUTBOX_GROUP, entry_id)
+
+
+    async def __run_chat_worker(self, user: str):
+        '''Send messages of the chat in order till the chat is idle'''
+        queue = self.chats_queues[user]
+        try:
+            while True:
+                try:
+                    entry_id, fields = await asyncio.wait_for(queue.get(),
+                                                              self.chat_idle_seconds)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        return
+                    continue
+
+                try:
+                    await self.__handle_entry(entry_id, fields)
+                finally:
+                    self.queued_entries_ids.discard(entry_id)
+                    self.__get_queued_messages().release()
+        finally:
+            del self.chats_queues[user]
+            del self.chats_workers[user]
+            self.chats_next_send_time.pop(user, None)
+
+
+    async def handle_entries(self, entries: List[Tuple[bytes, Dict[bytes, bytes]]]):
+        '''Queue the messages to their chats without waiting for sending.
+        The messages of one chat are sent in order. Waits while too many messages are queued.'''
+        for entry_id, fields in entries:
+            if fields is None:
+                # The entry is trimmed from the stream
+                await self.redis_connection.xack(OUTBOX_STREAM, OUTBOX_GROUP, entry_id)
+                continue
+
+            if entry_id in self.queued_entries_ids:
+                continue
+
+            await self.__get_queued_messages().acquire()
+            self.queued_entries_ids.add(entry_id)
+
+            user = fields[b'user'].decode()
+            if user not in self.chats_queues:
+                self.chats_queues[user] = asyncio.Queue()
+                self.chats_workers[user] = asyncio.ensure_future(self.__run_chat_worker(user))
+
+            self.chats_queues[user].put_nowait((entry_id, fields))
+
+
+    async def __keep_queued_entries(self):
+        '''Reset the idle time of the queued entries, so the slow chats entries
+        aren't claimed by other senders'''
+        if len(self.queued_entries_ids) == 0:
+            return
+
+        await self.redis_connection.xclaim(OUTBOX_STREAM, OUTBOX_GROUP, self.consumer_name, 0,
+                                           list(self.queued_entries_ids), justid=True)
+
+
+    async def __claim_stale_entries(self) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+        idle_ms = settings.OUTBOX_CLAIM_IDLE_SECONDS * 1000
+        pending = await self.redis_connection.xpending_range(OUTBOX_STREAM, OUTBOX_GROUP,
+                                                             min='-',
+                                                             max='+',
+                                                             count=settings.OUTBOX_BATCH_SIZE,
+                                                             idle=idle_ms)
+
+        entries_ids = []
+        for pending_entry in pending:
+            if pending_entry['times_delivered'] >= settings.OUTBOX_MAX_DELIVERIES:
+                logger.error('Message %s is dropped after %s deliveries.',
+                             pending_entry['message_id'],
+                             pending_entry['times_delivered'])
+                await self.redis_connection.xack(OUTBOX_STREAM, OUTBOX_GROUP,
+                                                 pending_entry['message_id'])
+                continue
+
+            entries_ids.append(pending_entry['message_id'])
+
+        if len(entries_ids) == 0:
+            return []
+
+        return await self.redis_connection.xclaim(OUTBOX_STREAM, OUTBOX_GROUP,
+                                                  self.consumer_name, idle_ms, entries_ids)
+
+
+    async def __read_new_entries(self) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+        streams = await self.redis_connection.xreadgroup(OUTBOX_GROUP,
+                                                         self.consumer_name,
+                                                         {OUTBOX_STREAM: '>'},
+                                                         count=settings.OUTBOX_BATCH_SIZE,
+                                                         block=1000)
+        if not streams:
+            return []
+
+        _, entries = streams[0]
+        return entries
+
+
+    async def run(self):
+        '''Deliver messages forever'''
+        await self.create_group()
+
+        while True:
+            await self.__keep_queued_entries()
+            entries = await self.__claim_stale_entries()
+            entries.extend(await self.__read_new_entries())
+
+            await self.handle_entries(entries)
+
+
+async def main():
+    '''Run the sender'''
+    start_metrics_server()
+    bot = Bot(token=settings.TELEGRAM_API_TOKEN)
+    redis_connection = aioredis.Redis(host=settings.REDIS_HOST,
+                                      port=settings.REDIS_PORT,
+                                      db=settings.REDIS_DB)
+
+    try:
+        await TelegramSender(bot, redis_connection).run()
+    finally:
+        await bot.session.close()
+        await redis_connection.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
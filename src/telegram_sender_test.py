@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+from unittest import mock
+from redis import asyncio as aioredis
+import settings
+from outbox import OUTBOX_GROUP, OUTBOX_STREAM
+from telegram_sender import TelegramSender
+
+
+class FakeBot:
+    '''The bot which is slow to send messages to the slow chat'''
+
+    def __init__(self, slow_user: str, slow_seconds: float) -> None:
+        self.slow_user = slow_user
+        self.slow_seconds = slow_seconds
+        self.sent = []
+
+
+    async def send_message(self, user: str, message: str, **_):
+        if user == self.slow_user:
+            await asyncio.sleep(self.slow_seconds)
+
+        self.sent.append((user, message))
+
+
+class TelegramSenderTestCase(unittest.TestCase):
+    @staticmethod
+    def create_redis_connection():
+        '''Connect to the dedicated test db'''
+        return aioredis.Redis(host=settings.REDIS_HOST,
+                              port=settings.REDIS_PORT,
+                              db=settings.TEST_REDIS_DB)
+
+
+    def tearDown(self):
+        async def clean():
+            redis_connection = self.create_redis_connection()
+            await redis_connection.delete(OUTBOX_STREAM)
+            await redis_connection.close()
+
+        asyncio.run(clean())
+
+
+    @staticmethod
+    async def read_entries(sender: TelegramSender, messages):
+        '''Put messages to the outbox and read them by the sender group'''
+        await sender.create_group()
+        for user, message in messages:
+            await sender.redis_connection.xadd(OUTBOX_STREAM, {'user': user, 'message': message})
+
+        streams = await sender.redis_connection.xreadgroup(OUTBOX_GROUP, sender.consumer_name,
+                                                           {OUTBOX_STREAM: '>'})
+        return streams[0][1]
+
+
+    @mock.patch('settings.TELEGRAM_CHAT_MESSAGES_PER_SECOND', 1000)
+    def test_handle_entries_does_not_wait_for_slow_chat(self):
+        '''Test the slow chat doesn't delay reading and other chats'''
+
+        async def run():
+            # Arrange
+            redis_connection = self.create_redis_connection()
+            bot = FakeBot(slow_user='1', slow_seconds=0.5)
+            sender = TelegramSender(bot, redis_connection, consumer_name='test')
+            entries = await self.read_entries(sender, [('1', 'slow1'), ('2', 'fast1'),
+                                                       ('1', 'slow2'), ('2', 'fast2')])
+
+            # Act
+            await asyncio.wait_for(sender.handle_entries(entries), 0.1)
+            await asyncio.sleep(0.1)
+            sent_before_slow_chat = list(bot.sent)
+            await asyncio.gather(*sender.chats_workers.values())
+            pending = await redis_connection.xpending(OUTBOX_STREAM, OUTBOX_GROUP)
+            await redis_connection.close()
+
+            return sent_before_slow_chat, bot.sent, pending, sender
+
+        sent_before_slow_chat, sent, pending, sender = asyncio.run(run())
+
+        # Assert
+        assert sent_before_slow_chat == [('2', 'fast1'), ('2', 'fast2')]
+        assert [message for user, message in sent if user == '1'] == ['slow1', 'slow2']
+        assert pending['pending'] == 0
+        assert sender.chats_queues == {}
+        assert sender.queued_entries_ids == set()
+
+
+    @mock.patch('settings.TELEGRAM_CHAT_MESSAGES_PER_SECOND', 1000)
+    def test_handle_entries_skips_queued_entries(self):
+        '''Test the claimed again entry isn't sent twice while it's queued'''
+
+        async def run():
+            # Arrange
+            redis_connection = self.create_redis_connection()
+            bot = FakeBot(slow_user='1', slow_seconds=0.2)
+            sender = TelegramSender(bot, redis_connection, consumer_name='test')
+            entries = await self.read_entries(sender, [('1', 'slow1'), ('1', 'slow2')])
+
+            # Act
+            await sender.handle_entries(entries)
+            await sender.handle_entries(entries)
+            await asyncio.gather(*sender.chats_workers.values())
+            await redis_connection.close()
+
+            return bot.sent
+
+        sent = asyncio.run(run())
+
+        # Assert
+        assert sent == [('1', 'slow1'), ('1', 'slow2')]
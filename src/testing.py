@@ -0,0 +1,11 @@
+'''Helpers shared by the tests'''
+import redis_pool
+import settings
+
+
+def use_test_redis_db():
+    '''Switch the process to the dedicated redis db, so the tests which flush it
+    don't wipe the db of the running services'''
+    if settings.REDIS_DB != settings.TEST_REDIS_DB:
+        settings.REDIS_DB = settings.TEST_REDIS_DB
+        redis_pool.close_connection_pool()
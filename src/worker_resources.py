@@ -0,0 +1,49 @@
+'''The module with resources which live as long as the worker process:
+the event loop of github requests, the redis pool and the database engine'''
+import asyncio
+import github_api
+from models import create_schema, engine
+from redis_pool import close_async_connection_pool, close_connection_pool
+
+
+_event_loop = None
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    '''Get the event loop of the process. The pooled github sessions are bound to it.'''
+    global _event_loop  # pylint: disable=global-statement
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_event_loop)
+
+    return _event_loop
+
+
+def run_until_complete(awaitable):
+    '''Run the awaitable on the event loop of the process'''
+    return get_event_loop().run_until_complete(awaitable)
+
+
+def init_worker():
+    '''Prepare the main worker process before forking'''
+    create_schema()
+
+
+def init_process():
+    '''Prepare the forked worker process'''
+    # The pooled connections are inherited from the parent and must not be used by the child
+    engine.dispose(close=False)
+
+
+def shutdown_process():
+    '''Release resources of the process'''
+    global _event_loop  # pylint: disable=global-statement
+    if _event_loop is not None and not _event_loop.is_closed():
+        _event_loop.run_until_complete(github_api.close_default_client())
+        _event_loop.run_until_complete(close_async_connection_pool())
+        _event_loop.run_until_complete(_event_loop.shutdown_asyncgens())
+        _event_loop.close()
+    _event_loop = None
+
+    close_connection_pool()
+    engine.dispose()